@@ -1,5 +1,7 @@
 import click
 from pathlib import Path
+from collections import OrderedDict
+import os
 import json
 
 """Utils"""
@@ -23,6 +25,58 @@ def get_deon_config():
         deon_config = json.load(config_file)
     return deon_config
 
+def get_bucket_config(deon_config, s3path):
+    """Entry of the bucket of <bucket>/<prefix> in data_buckets, {} if none"""
+    bucket = s3path.split("/", 1)[0]
+    for x in (deon_config or {}).get("data_buckets", []):
+        if x.get("bucket_name", x.get("bucket")) == bucket:
+            return x
+    return {}
+
+def bucket_options(deon_config, s3path, quick=False, checksum=False, repack=False):
+    """SmartS3Sync options set per bucket in data_buckets, --quick turns on
+    and --checksum turns off the bucket's "quick" and "fingerprint" settings,
+    --repack turns on "repack", and "driver" picks the storage backend, e.g.
+    local:/mnt/mirror"""
+    from deon.backends import get_backend
+    bucket_config = get_bucket_config(deon_config, s3path)
+    options = dict(
+        compression = bucket_config.get("compression"),
+        delta = bool(bucket_config.get("delta")),
+        changefeed = bool(bucket_config.get("changefeed")),
+        quick = bool(quick or bucket_config.get("quick")) and not checksum,
+        fingerprint = None if checksum else bucket_config.get("fingerprint"),
+        repack = bool(repack or bucket_config.get("repack")),
+    )
+    backend = get_backend(bucket_config.get("driver"))
+    if backend is not None:
+        options["s3client"] = backend
+    return options
+
+def all_s3paths(deon_config):
+    """<bucket>/<prefix>/ of every data bucket and its "prefixes" in the config"""
+    s3paths = []
+    for x in deon_config.get("data_buckets", []):
+        bucket = x.get("bucket_name", x.get("bucket"))
+        for prefix in x.get("prefixes", [""]):
+            prefix = prefix.strip("/")
+            s3paths.append(bucket + "/" + (prefix + "/" if prefix else ""))
+    return s3paths
+
+def parse_shard_option(ctx, param, value):
+    from deon.shard import parse_shard
+    if value is None:
+        return None
+    try:
+        return parse_shard(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+def parse_datasets_option(ctx, param, value):
+    if not value:
+        return None
+    return [name.strip() for name in value.split(",") if name.strip()]
+
 def check_config():
     deon_config = get_deon_config()
     if deon_config is None:
@@ -42,24 +96,105 @@ def sync_s3(local, s3path, fromS3, interval, force, **kwargs):
 
     s3_sync.sync(interval = interval, force = force, fromS3 = fromS3)
 
-def sync_files_s3(list_of_files, force=False, **kwargs):
+def sync_s3_all(s3paths, fromS3, force, workers, bandwidth, deon_config,
+                stats_json=None, stats_prom=None, quick=False, checksum=False, repack=False,
+                **kwargs):
+    """Sync several <bucket>/<prefix>/ concurrently on one shared worker and
+    bandwidth budget, then print one summary"""
+    import logging
+    import threading
+    from deon.s3sync import SmartS3Sync
+    from deon.scheduler import FairScheduler
+    from deon.stats import merge_reports, format_summary, write_report
+    from deon.progress import get_progress
+
+    logger = logging.getLogger("deoncli")
+    scheduler = FairScheduler(workers=workers, bandwidth=bandwidth * 1e6 if bandwidth else None)
+    ## one progress line for all syncs
+    progress = get_progress(kwargs.pop("progress_mode", "auto"))
+    progress.start()
+    jobs = OrderedDict((s3path, ("pending", None)) for s3path in s3paths)
+
+    def run(s3path):
+        if not fromS3 and not os.path.isdir(s3path):
+            logger.warning("skipping " + s3path + ", no local directory")
+            jobs[s3path] = ("skipped", None)
+            return
+        options = dict(kwargs)
+        options.update(bucket_options(deon_config, s3path, quick, checksum, repack))
+        if options.get("trace"):
+            options["trace"] = options["trace"] + "." + s3path.strip("/").replace("/", "_")
+        try:
+            s3_sync = SmartS3Sync(local=s3path, s3path=s3path, scheduler=scheduler,
+                                  progress=progress, collect_stats=True, **options)
+            s3_sync.sync(force=force, fromS3=fromS3, show_progress=False)
+            jobs[s3path] = ("ok", s3_sync.last_report)
+        except (Exception, SystemExit):
+            logger.exception("sync of " + s3path + " failed")
+            jobs[s3path] = ("failed", None)
+
+    threads = [threading.Thread(target=run, args=(s3path,), name="sync-" + s3path)
+               for s3path in s3paths]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    scheduler.shutdown()
+    progress.close()
+
+    labels = OrderedDict([("bucket", "all"), ("prefix", ""),
+                          ("direction", "down" if fromS3 else "up")])
+    total = merge_reports([r for status, r in jobs.values() if r], labels=labels)
+    print(format_summary(jobs, total))
+    write_report(total, stats_json, stats_prom)
+    if any(status == "failed" for status, r in jobs.values()):
+        exit(1)
+
+def files_options(prefix, kwargs):
+    """SmartS3Sync options of deon_config.json for files under prefix,
+    kwargs take precedence"""
+    deon_config = get_deon_config()
+    if deon_config and 'objectstore' not in kwargs:
+        kwargs['objectstore'] = deon_config.get("object_store")
+    if deon_config and 'cache_endpoint' not in kwargs:
+        kwargs['cache_endpoint'] = deon_config.get("cache_endpoint")
+    if deon_config:
+        for k, v in bucket_options(deon_config, prefix).items():
+            kwargs.setdefault(k, v)
+    return kwargs
+
+def sync_files_s3(list_of_files, force=False, progress_mode="auto", datasets=None, **kwargs):
+    """Download list_of_files, with datasets only these hdf5 datasets as slim
+    files, see deon.slim"""
     from deon.s3sync import SmartS3Sync
+    from deon.dataset import common_prefix
+    from deon.progress import get_progress
 
     # s3 prefix to search is the minimum shared prefix of list of files
-    s_files = sorted(list_of_files)
-    first, last = s_files[0], s_files[-1]
-    for i in range(min(len(first), len(last))):
-        if first[i] != last[i]:
-            break
-    result = first[:i]
-    prefix = result[:-result[::-1].index('/')]
+    prefix = common_prefix(list_of_files)
+    kwargs = files_options(prefix, kwargs)
+    progress = get_progress(progress_mode)
 
     s3_sync = SmartS3Sync(
-        local = list(list_of_files),
+        # slim downloads don't need the local files to exist
+        local = [] if datasets else list(list_of_files),
         s3path = prefix,
+        progress = progress,
+        datasets = datasets,
         **kwargs
     )
-    s3_sync.sync_files_fromS3(force=force)
+    progress.start()
+    if datasets:
+        s3_sync.sync_slim_fromS3(force=force, files=list(list_of_files))
+    else:
+        s3_sync.sync_files_fromS3(force=force)
+    progress.close()
+
+def load_dataset(list_of_files, **kwargs):
+    """deon.dataset.Dataset of list_of_files with the options of
+    deon_config.json, files are fetched while they are read"""
+    from deon.dataset import Dataset, common_prefix
+    return Dataset(list_of_files, **files_options(common_prefix(list_of_files), kwargs))
 
 """Google cloud link: TODO"""
 
@@ -75,13 +210,38 @@ def cli():
 @cli.command()
 @click.argument("path")
 @click.option("--data_buckets", default="rail-robot-data-sharing-v1", help="Data buckets, comma separated")
-def init(path, data_buckets):
+@click.option("--object_store", default=None, help="Shared content-addressed object store directory, e.g. ~/.deon/objects")
+@click.option("--compression", default=None, type=click.Choice(["zstd", "gzip"]), help="Compress objects in the data buckets with this codec")
+@click.option("--delta", is_flag=True, help="Upload large files as deduplicated content-defined chunks")
+@click.option("--changefeed", is_flag=True, help="Record uploads in a changefeed so downloads only read new changes")
+@click.option("--cache_endpoint", default=None, help="deoncli cache-serve endpoint to download through, e.g. http://cachehost:8910")
+@click.option("--quick", is_flag=True, help="Compare size and mtime instead of md5sums by default, see up/down --quick")
+@click.option("--fingerprint", default=None, type=click.Choice(["xxh3", "crc32"]), help="Compare and verify files by this fast fingerprint, stored in the object metadata, instead of md5sums")
+@click.option("--driver", default=None, help="Storage of the buckets, s3 (default) or local:<root> for a directory mirror, e.g. on NFS")
+def init(path, data_buckets, object_store, compression, delta, changefeed, cache_endpoint, quick, fingerprint, driver):
     """Initialize a local dataset at <path>"""
     data_buckets_list = data_buckets.split(",")
     data_buckets_dict = [dict(bucket_name=bucket_name) for bucket_name in data_buckets_list]
+    for x in data_buckets_dict:
+        if compression:
+            x["compression"] = compression
+        if delta:
+            x["delta"] = True
+        if changefeed:
+            x["changefeed"] = True
+        if quick:
+            x["quick"] = True
+        if fingerprint:
+            x["fingerprint"] = fingerprint
+        if driver:
+            x["driver"] = driver
     config = dict(
         data_buckets=data_buckets_dict,
     )
+    if object_store:
+        config["object_store"] = object_store
+    if cache_endpoint:
+        config["cache_endpoint"] = cache_endpoint
 
     # set up directory structure
     base_path = Path(path)
@@ -96,39 +256,289 @@ def init(path, data_buckets):
 
 
 @cli.command()
-@click.argument("local_path")
+@click.argument("local_path", required=False)
+@click.option('--all', 'sync_all', is_flag=True, help="Sync every data bucket and prefix in deon_config.json concurrently")
+@click.option('--workers', default=8, help="Concurrent transfers shared by all syncs with --all")
+@click.option('--bandwidth', default=0.0, help="MB/s shared by all syncs with --all, 0 for unlimited")
 @click.option('--interval', is_flag=True)
 @click.option('--force', is_flag=True)
 @click.option('--metadata', is_flag=True)
-@click.option('--profile', is_flag=True)
+@click.option('--profile', default=None, help="AWS profile name")
 @click.option('--log', default=20) # 10=DEBUG, 20=INFO, 30=WARNING, 40=ERROR, 50=CRITICAL
-def up(local_path, interval, force, **kwargs):
+@click.option('--stats', 'stats_json', default=None, help="Write a JSON report of sync metrics to this path, - for stdout")
+@click.option('--stats_prom', default=None, help="Write sync metrics as a Prometheus textfile to this path")
+@click.option('--trace', default=None, help="Write a Chrome trace-event timeline of the sync to this path")
+@click.option('--trace_memory', is_flag=True, help="Add tracemalloc current/peak memory to the trace")
+@click.option('--trace_cprofile', is_flag=True, help="Also write a cProfile of the main thread to <trace>.prof")
+@click.option('--quick', is_flag=True, help="Skip hashing files whose size and mtime match the ones recorded for the object")
+@click.option('--checksum', is_flag=True, help="Always compare md5sums, overrides --quick and the bucket's quick and fingerprint settings")
+@click.option('--resume', is_flag=True, help="Continue an interrupted sync from its journal, only transferring unfinished files")
+@click.option('--repack', is_flag=True, help="Upload repacked copies of new and changed hdf5 files for cheaper remote reads, the local files are kept as they are")
+@click.option('--progress', 'progress_mode', default="auto", type=click.Choice(["auto", "bar", "log", "off"]), help="Progress of the transfers: a status line, a log line every 30s, or none; auto picks bar on a terminal")
+def up(local_path, sync_all, workers, bandwidth, interval, force, quick, checksum, repack, **kwargs):
     """Sync data up: local -> remote"""
     local = local_path
     s3path = local_path
     fromS3 = False
 
-    check_config()
+    deon_config = check_config()
+    if sync_all:
+        if interval:
+            print("--interval is not supported with --all")
+            exit()
+        sync_s3_all(all_s3paths(deon_config), fromS3, force, workers, bandwidth, deon_config,
+                    quick=quick, checksum=checksum, repack=repack, **kwargs)
+        return
+    if local_path is None:
+        print("Pass <bucket>/<prefix> or --all")
+        exit()
+    kwargs.update(bucket_options(deon_config, s3path, quick, checksum, repack))
 
     sync_s3(local, s3path, fromS3, interval, force, **kwargs)
 
 
 @cli.command()
-@click.argument("local_path")
+@click.argument("local_path", required=False)
+@click.option('--all', 'sync_all', is_flag=True, help="Sync every data bucket and prefix in deon_config.json concurrently")
+@click.option('--workers', default=8, help="Concurrent transfers shared by all syncs with --all")
+@click.option('--bandwidth', default=0.0, help="MB/s shared by all syncs with --all, 0 for unlimited")
 @click.option('--force', is_flag=True)
 @click.option('--interval', is_flag=True)
 @click.option('--metadata', is_flag=True)
-@click.option('--profile', is_flag=True)
+@click.option('--profile', default=None, help="AWS profile name")
 @click.option('--log', default=20) # 10=DEBUG, 20=INFO, 30=WARNING, 40=ERROR, 50=CRITICAL
-def down(local_path, force, interval, **kwargs):
+@click.option('--stats', 'stats_json', default=None, help="Write a JSON report of sync metrics to this path, - for stdout")
+@click.option('--stats_prom', default=None, help="Write sync metrics as a Prometheus textfile to this path")
+@click.option('--trace', default=None, help="Write a Chrome trace-event timeline of the sync to this path")
+@click.option('--trace_memory', is_flag=True, help="Add tracemalloc current/peak memory to the trace")
+@click.option('--trace_cprofile', is_flag=True, help="Also write a cProfile of the main thread to <trace>.prof")
+@click.option('--object_store', default=None, help="Object store directory, overrides object_store in deon_config.json")
+@click.option('--reconcile', is_flag=True, help="List the whole prefix instead of reading the changefeed")
+@click.option('--shard', default=None, callback=parse_shard_option, help="Only sync shard i/N of the keys, e.g. 0/4 on the first of 4 nodes")
+@click.option('--quick', is_flag=True, help="Skip hashing files whose size and mtime match the ones recorded for the object")
+@click.option('--checksum', is_flag=True, help="Always compare md5sums, overrides --quick and the bucket's quick and fingerprint settings")
+@click.option('--resume', is_flag=True, help="Continue an interrupted sync from its journal, only transferring unfinished files")
+@click.option('--progress', 'progress_mode', default="auto", type=click.Choice(["auto", "bar", "log", "off"]), help="Progress of the transfers: a status line, a log line every 30s, or none; auto picks bar on a terminal")
+@click.option('--datasets', default=None, callback=parse_datasets_option, help="Comma separated hdf5 datasets (or group names) to download, e.g. actions,states; hdf5 files are written as slim files without the other datasets")
+def down(local_path, sync_all, workers, bandwidth, force, interval, object_store, shard, quick, checksum, **kwargs):
     """Sync data down: remote -> local"""
     local = local_path
     s3path = local_path
     fromS3 = True
 
+    deon_config = check_config()
+    kwargs['objectstore'] = object_store or deon_config.get("object_store")
+    kwargs['cache_endpoint'] = deon_config.get("cache_endpoint")
+    if sync_all:
+        if interval or shard:
+            print("--interval and --shard are not supported with --all")
+            exit()
+        sync_s3_all(all_s3paths(deon_config), fromS3, force, workers, bandwidth, deon_config,
+                    quick=quick, checksum=checksum, **kwargs)
+        return
+    if local_path is None:
+        print("Pass <bucket>/<prefix> or --all")
+        exit()
+    if shard and not s3path.endswith("/"):
+        print("--shard needs a <bucket>/<prefix>/ directory")
+        exit()
+    kwargs.update(bucket_options(deon_config, s3path, quick, checksum))
+
+    sync_s3(local, s3path, fromS3, interval, force, shard=shard, **kwargs)
+
+
+@cli.command()
+@click.argument("local_path")
+@click.argument("num_shards", type=int)
+@click.option('--wait', is_flag=True, help="Wait until all shards are complete")
+@click.option('--timeout', default=0.0, help="Seconds to wait with --wait, 0 for no limit")
+def shards(local_path, num_shards, wait, timeout):
+    """Check the completion markers of a sync down with --shard i/NUM_SHARDS"""
+    import time
+    from deon.shard import ShardMarkers
+
     check_config()
+    bucket, prefix = local_path.split("/", 1)
+    markers = ShardMarkers(bucket, prefix, num_shards)
+    started = time.time()
+    while True:
+        status = markers.status()
+        complete, message = markers.is_complete(status)
+        if complete or not wait or (timeout and time.time() - started > timeout):
+            break
+        time.sleep(5)
+    for i, marker in status.items():
+        if marker is None:
+            print("shard %d/%d: pending" % (i, num_shards))
+        else:
+            print("shard %d/%d: done on %s, %d files, %d bytes, listing %s" % (
+                i, num_shards, marker["host"], marker["files"], marker["bytes"], marker["digest"][:12]))
+    print(message)
+    if not complete:
+        exit(1)
+
+
+@cli.command("cache-serve")
+@click.option('--cache_dir', default="~/.deon/cache", help="Directory of the cached objects")
+@click.option('--host', default="0.0.0.0", help="Address to listen on")
+@click.option('--port', default=8910, help="Port to listen on")
+@click.option('--ttl', default=30.0, help="Seconds a cached object is served without asking s3, for reads without If-Match")
+@click.option('--max_size', default=0.0, help="Cache size in GB, least recently used objects are evicted beyond it, 0 for unlimited")
+@click.option('--buckets', default=None, help="Buckets served, comma separated, default the data buckets in deon_config.json if there is one")
+@click.option('--profile', default=None, help="AWS profile name")
+@click.option('--log', default=20) # 10=DEBUG, 20=INFO, 30=WARNING, 40=ERROR, 50=CRITICAL
+def cache_serve(cache_dir, host, port, ttl, max_size, buckets, profile, log):
+    """Serve s3 reads to the LAN from a read-through disk cache"""
+    import logging
+    import boto3
+    from deon.cacheserve import ObjectCache, CacheServer
+
+    logging.basicConfig(level=log, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    if buckets:
+        buckets = buckets.split(",")
+    elif get_deon_config():
+        buckets = [x.get("bucket_name", x.get("bucket")) for x in get_deon_config().get("data_buckets", [])]
+    s3cl = boto3.Session(profile_name=profile).client("s3")
+    cache = ObjectCache(s3cl, os.path.expanduser(cache_dir), ttl=ttl,
+                        max_bytes=int(max_size * 1e9) or None)
+    server = CacheServer(cache, host=host, port=port, buckets=buckets)
+    print("serving s3 reads on http://%s:%d from %s, buckets: %s" % (
+        host, port, cache.cache_dir, ", ".join(buckets) if buckets else "all"))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+def lazy_cache_options(cache_dir, max_size):
+    """Cache directory and size in bytes, from the options or "lazy_cache"
+    in deon_config.json"""
+    from deon.lazy import CACHE_DIR
+    lazy_config = (get_deon_config() or {}).get("lazy_cache", {})
+    cache_dir = cache_dir or lazy_config.get("dir") or CACHE_DIR
+    if max_size is None:
+        max_size = lazy_config.get("max_size", 0)
+    return os.path.expanduser(cache_dir), int(float(max_size) * 1e9) or None
 
-    sync_s3(local, s3path, fromS3, interval, force, **kwargs)
+
+@cli.group()
+def lazy():
+    """Open repo files on demand through a size-bounded disk cache"""
+    pass
+
+
+@lazy.command("open")
+@click.argument("local_paths", nargs=-1, required=True)
+@click.option('--cache_dir', default=None, help="Cache directory, default lazy_cache.dir in deon_config.json or ~/.deon/lazy")
+@click.option('--max_size', default=None, type=float, help="Cache size in GB, default lazy_cache.max_size in deon_config.json, 0 for unlimited")
+@click.option('--profile', default=None, help="AWS profile name")
+@click.option('--log', default=30) # 10=DEBUG, 20=INFO, 30=WARNING, 40=ERROR, 50=CRITICAL
+def lazy_open(local_paths, cache_dir, max_size, profile, log):
+    """Download <bucket>/<key> files into the cache if needed and print their cache paths"""
+    from deon.lazy import LazyRepo
+    from deon.dataset import common_prefix
+
+    cache_dir, max_bytes = lazy_cache_options(cache_dir, max_size)
+    prefix = common_prefix(local_paths)
+    with LazyRepo(prefix, cache_dir=cache_dir, max_bytes=max_bytes,
+                  **files_options(prefix, dict(profile=profile, log=log))) as repo:
+        for local in local_paths:
+            print(repo.path(local))
+
+
+@lazy.command()
+@click.argument("prefix")
+@click.option('--fetch', is_flag=True, help="Also download the files under the prefix now")
+@click.option('--cache_dir', default=None, help="Cache directory, default lazy_cache.dir in deon_config.json or ~/.deon/lazy")
+@click.option('--max_size', default=None, type=float, help="Cache size in GB, default lazy_cache.max_size in deon_config.json, 0 for unlimited")
+@click.option('--profile', default=None, help="AWS profile name")
+@click.option('--log', default=30) # 10=DEBUG, 20=INFO, 30=WARNING, 40=ERROR, 50=CRITICAL
+def pin(prefix, fetch, cache_dir, max_size, profile, log):
+    """Never evict the cached files under <bucket>/<prefix>"""
+    from deon.lazy import LazyCache, LazyRepo
+
+    cache_dir, max_bytes = lazy_cache_options(cache_dir, max_size)
+    if not fetch:
+        LazyCache(cache_dir, max_bytes).pin(prefix)
+        return
+    s3path = prefix[:prefix.rfind("/") + 1]
+    with LazyRepo(s3path, cache_dir=cache_dir, max_bytes=max_bytes,
+                  **files_options(s3path, dict(profile=profile, log=log))) as repo:
+        repo.pin(prefix, fetch=True)
+
+
+@lazy.command()
+@click.argument("prefix")
+@click.option('--cache_dir', default=None, help="Cache directory, default lazy_cache.dir in deon_config.json or ~/.deon/lazy")
+def unpin(prefix, cache_dir):
+    """Let the cached files under <bucket>/<prefix> be evicted again"""
+    from deon.lazy import LazyCache
+
+    cache_dir, max_bytes = lazy_cache_options(cache_dir, None)
+    LazyCache(cache_dir, max_bytes).unpin(prefix)
+
+
+@lazy.command()
+@click.option('--cache_dir', default=None, help="Cache directory, default lazy_cache.dir in deon_config.json or ~/.deon/lazy")
+def status(cache_dir):
+    """Print the size and pins of the cache"""
+    from deon.lazy import LazyCache
+
+    cache_dir, max_bytes = lazy_cache_options(cache_dir, None)
+    print(json.dumps(LazyCache(cache_dir, max_bytes).status(), indent=4))
+
+
+@cli.command()
+@click.argument("local_dir")
+@click.argument("out_dir")
+@click.option('--fields', required=True, help="Comma separated hdf5 datasets to pack, e.g. images,actions")
+@click.option('--where', default=None, help="Metadata filter, a pandas query, e.g. \"robot == 'sawyer'\"")
+@click.option('--shard_size', default=1.0, type=float, help="GB of rows per shard")
+@click.option('--rebuild', is_flag=True, help="Pack all files again instead of only new and changed ones")
+@click.option('--workers', default=4, type=int, help="Files fetched and read concurrently")
+@click.option('--profile', default=None, help="AWS profile name")
+@click.option('--log', default=20) # 10=DEBUG, 20=INFO, 30=WARNING, 40=ERROR, 50=CRITICAL
+def pack(local_dir, out_dir, fields, where, shard_size, rebuild, workers, profile, log):
+    """Pack datasets of the files under <local_dir> matching the metadata filter into memory-mappable shards in <out_dir>"""
+    from deon.pack import Pack, metadata_table
+    from deon.dataset import common_prefix
+
+    check_config()
+    table = metadata_table(local_dir)
+    if where and len(table):
+        table = table.query(where)
+    print("packing %d files" % len(table))
+    options = dict(profile=profile, log=log, workers=workers)
+    if len(table):
+        options = files_options(common_prefix(table.index), options)
+    summary = Pack(out_dir).update(table, fields.split(","), shard_bytes=int(shard_size * 1e9),
+                                   rebuild=rebuild, **options)
+    print(json.dumps(summary, indent=4))
+
+
+@cli.command()
+@click.argument("paths", nargs=-1, required=True)
+@click.option('--dry_run', is_flag=True, help="Only report the expected change, keep the files")
+@click.option('--page_size', default=256, type=int, help="KB of the file space pages of repacked files")
+@click.option('--chunk_size', default=2048, type=int, help="KB of the chunks of compressed datasets")
+def repack(paths, dry_run, page_size, chunk_size):
+    """Repack hdf5 files (or the hdf5 files under directories) in place for cheaper remote reads, and report the range requests a remote reader needs before and after"""
+    import logging
+    from deon.repack import Repacker, EXTENSIONS, summarize, format_report
+
+    logging.basicConfig(level=logging.INFO)
+    fnames = []
+    for path in paths:
+        if os.path.isdir(path):
+            fnames += sorted(str(p) for p in Path(path).glob("**/*") if str(p).endswith(EXTENSIONS))
+        else:
+            fnames.append(path)
+    repacker = Repacker(page_size=page_size * 1024, chunk_bytes=chunk_size * 1024)
+    reports = [r for r in (repacker.repack(fname, dry_run=dry_run) for fname in OrderedDict.fromkeys(fnames)) if r]
+    for r in reports:
+        print(json.dumps(r))
+    print(format_report(summarize(reports)))
 
 
 @cli.group()
@@ -142,38 +552,43 @@ def metadata():
 @click.option('--force', is_flag=True)
 @click.option('--interval', is_flag=True)
 @click.option('--metadata', is_flag=True)
-@click.option('--profile', is_flag=True)
+@click.option('--profile', default=None, help="AWS profile name")
 @click.option('--log', default=20) # 10=DEBUG, 20=INFO, 30=WARNING, 40=ERROR, 50=CRITICAL
+@click.option('--stats', 'stats_json', default=None, help="Write a JSON report of sync metrics to this path, - for stdout")
+@click.option('--stats_prom', default=None, help="Write sync metrics as a Prometheus textfile to this path")
+@click.option('--trace', default=None, help="Write a Chrome trace-event timeline of the sync to this path")
+@click.option('--trace_memory', is_flag=True, help="Add tracemalloc current/peak memory to the trace")
+@click.option('--trace_cprofile', is_flag=True, help="Also write a cProfile of the main thread to <trace>.prof")
+@click.option('--reconcile', is_flag=True, help="List the whole prefix instead of reading the changefeed")
 def down(local_dir, force, interval, **kwargs):
     """Sync metadata of data path <local_dir> down"""
+    from deon.s3sync import SmartS3Sync
     local = local_dir
     s3path = local_dir
 
-    check_config()
+    deon_config = check_config()
+    kwargs.update(bucket_options(deon_config, s3path))
 
     s3_sync = SmartS3Sync(local = local, s3path = s3path, **kwargs)
+    s3_sync.stats.label(direction = 'metadata')
     s3_sync.sync_metadata_fromS3(force = force, show_progress = False)
+    s3_sync.stats.write()
+    s3_sync.tracer.write()
 
 
 @metadata.command()
 @click.argument("local_dir")
 def load(local_dir):
     """Load metadata and put it in a data frame, then start a ipdb session"""
+    ## pd and Pack are unused here, they are kept in scope for the ipdb
+    ## session, see the example usage below
     import pandas as pd
-    import json
 
-    check_config()
+    from deon.pack import Pack, metadata_table
 
-    path = Path("metadata") / local_dir
-    metadatas = []
-    paths = list(path.glob('**/*.json'))
-    for metadata_path in paths:
-        with metadata_path.open("r") as metadata_file:
-            metadata = json.load(metadata_file)
-        metadatas.append(metadata)
+    check_config()
 
-    filenames = [str(path)[len("metadata/"):-5] for path in paths]
-    df = pd.DataFrame(metadatas, index=filenames)
+    df = metadata_table(local_dir)
     print("loaded data frame df")
     print("rows", len(df))
     print("keys", df.keys())
@@ -182,6 +597,8 @@ example usage:
 filtered_df = df[df['robot'] == "sawyer"]
 print(filtered_df.index)
 sync_files_s3(filtered_df.index, force=False)
+for path, arrays in load_dataset(filtered_df.index, fields=["images"], shuffle=True, seed=0): ...
+Pack("packs/sawyer").update(filtered_df, fields=["images", "actions"])
 """
     )
     import ipdb; ipdb.set_trace()
@@ -194,6 +611,72 @@ def show(local_dir):
     pass
 
 
+@cli.group()
+def daemon():
+    """Warm background process running deoncli commands, see deon.daemon"""
+    pass
+
+
+@daemon.command()
+@click.option('--socket', 'socket_path', default=None, help="Socket path, default ~/.deon/daemon.sock or $DEON_DAEMON_SOCKET")
+@click.option('--listing_ttl', default=30.0, help="Seconds a listing is reused by later commands, 0 to always list again")
+@click.option('--idle_timeout', default=0.0, help="Exit after this many seconds without commands, 0 to run until stopped")
+@click.option('--detach', is_flag=True, help="Run in the background, logging to ~/.deon/daemon.log")
+@click.option('--log', default=20) # 10=DEBUG, 20=INFO, 30=WARNING, 40=ERROR, 50=CRITICAL
+def start(socket_path, listing_ttl, idle_timeout, detach, log):
+    """Start a daemon, deoncli then runs commands in it while it's running"""
+    import sys
+    import time
+    import subprocess
+    from deon.daemon import serve, control
+
+    if detach:
+        log_path = os.path.expanduser("~/.deon/daemon.log")
+        os.makedirs(os.path.dirname(log_path), exist_ok=True)
+        argv = [sys.executable, "-m", "deon", "daemon", "start", "--listing_ttl", str(listing_ttl),
+                "--idle_timeout", str(idle_timeout), "--log", str(log)]
+        if socket_path:
+            argv += ["--socket", socket_path]
+        with open(log_path, "a") as log_file:
+            process = subprocess.Popen(argv, stdin=subprocess.DEVNULL, stdout=log_file,
+                                       stderr=log_file, start_new_session=True)
+        for i in range(100):
+            status = control("status", socket_path)
+            if status is not None or process.poll() is not None:
+                break
+            time.sleep(0.1)
+        if status is None:
+            print("daemon did not start, see " + log_path)
+            exit(1)
+        print("daemon pid %d listening on %s" % (status["pid"], status["socket"]))
+        return
+    try:
+        serve(cli, socket_path, listing_ttl=listing_ttl, idle_timeout=idle_timeout, log=log)
+    except RuntimeError as e:
+        print(e)
+        exit(1)
+
+
+@daemon.command()
+@click.option('--socket', 'socket_path', default=None, help="Socket path, default ~/.deon/daemon.sock or $DEON_DAEMON_SOCKET")
+def stop(socket_path):
+    """Stop the daemon"""
+    from deon.daemon import control
+
+    reply = control("stop", socket_path)
+    print("no daemon is running" if reply is None else "stopped daemon pid %d" % reply["stopping"])
+
+
+@daemon.command("status")
+@click.option('--socket', 'socket_path', default=None, help="Socket path, default ~/.deon/daemon.sock or $DEON_DAEMON_SOCKET")
+def daemon_status(socket_path):
+    """Show the daemon's pid, uptime, commands run and caches"""
+    from deon.daemon import control
+
+    status = control("status", socket_path)
+    print("no daemon is running" if status is None else json.dumps(status, indent=4))
+
+
 @cli.command()
 def buckets():
     """Print list of accessible buckets from S3"""
@@ -206,5 +689,17 @@ def buckets():
         print(bucket["Name"])
 
 
+def main():
+    """deoncli, runs the command in deoncli daemon if one is running"""
+    import sys
+    from deon.daemon import delegate
+
+    code = delegate(sys.argv[1:])
+    if code is None:
+        cli()
+    else:
+        sys.exit(code)
+
+
 if __name__ == "__main__":
-    cli()
+    main()
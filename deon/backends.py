@@ -0,0 +1,584 @@
+"""
+Pluggable storage backends.
+
+SmartS3Sync talks to storage through the subset of the boto3 s3 client it
+uses.  A StorageBackend provides that subset on top of six primitives,
+
+    list(bucket, prefix, start_after)     listing entries in key order
+    head(bucket, key)                     ETag, size, metadata of an object
+    get_range(bucket, key, start, end)    bytes of an object
+    put(bucket, key, source, ...)         store bytes, a file or a reader
+    copy_key(bucket, key, src_bucket, src_key, ...)
+    delete(bucket, key)
+
+so a new backend only implements those and is passed to SmartS3Sync as
+s3client.  Like a boto3 client a backend emits the botocore before-call and
+after-call events, so deon.stats and deon.trace can be attached to it.
+
+LocalBackend stores the objects of a bucket as plain files under
+<root>/<bucket>/<key>, e.g. an on-prem mirror on NFS, or a deterministic
+store for tests and benchmarks.  Uploads and downloads of local files are
+reflinks or copy_file_range(2) calls where the filesystem supports them,
+server side copies are hardlinks.  Stored files are only ever replaced,
+never modified in place, so they may share an inode; don't edit files of
+the mirror in place either.
+
+Set "driver" of a data bucket in deon_config.json to "local:<root>" to sync
+the bucket with a mirror, "s3" (the default) syncs with s3.
+"""
+
+import os
+import io
+import abc
+import json
+import uuid
+import shutil
+import hashlib
+import datetime
+from binascii import unhexlify
+
+from types import SimpleNamespace
+
+from botocore.exceptions import ClientError
+from botocore.hooks import HierarchicalEmitter
+from boto3.s3.transfer import TransferConfig
+
+from deon.objectstore import reflink, FICLONE
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+## default multipart threshold and chunk size of boto3's TransferConfig
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+CHUNK_SIZE = 8 * 1024 * 1024
+PAGE_SIZE = 1000
+META_DIR = '.deon-meta'
+TMP_DIR = '.deon-tmp'
+META_SUFFIX = '.json'
+
+
+def client_error(code, message, operation):
+    return ClientError({'Error': {'Code': code, 'Message': message}}, operation)
+
+
+def multipart_etag(md5s):
+    """ETag of a multipart object from the hex md5 of each part."""
+    if len(md5s) == 1:
+        return '"' + md5s[0] + '"'
+    digest = hashlib.md5(unhexlify(''.join(md5s))).hexdigest()
+    return '"' + digest + '-' + str(len(md5s)) + '"'
+
+
+def part_sizes(size, config):
+    """Part sizes a managed transfer of size bytes would use."""
+    threshold = getattr(config, 'multipart_threshold', DEFAULT_PART_SIZE)
+    chunk = getattr(config, 'multipart_chunksize', DEFAULT_PART_SIZE)
+    if size < threshold:
+        return [size]
+    sizes = [chunk] * (size // chunk)
+    if size % chunk:
+        sizes.append(size % chunk)
+    return sizes
+
+
+def file_etag(path, sizes):
+    """s3 ETag of a file stored in parts of sizes."""
+    md5s = []
+    with open(path, 'rb') as f:
+        for size in sizes:
+            h = hashlib.md5()
+            while size > 0:
+                data = f.read(min(size, CHUNK_SIZE))
+                if not data:
+                    break
+                h.update(data)
+                size -= len(data)
+            md5s.append(h.hexdigest())
+    return multipart_etag(md5s)
+
+
+def real_file(fileobj):
+    """
+    True if fileobj is a regular file opened by open(), whose descriptor can
+    be used directly.  Wrappers like codec writers are not, even if they
+    pass fileno() through.
+    """
+    if not isinstance(fileobj, (io.BufferedReader, io.BufferedWriter, io.FileIO)):
+        return False
+    try:
+        return os.path.isfile(fileobj.name) if isinstance(fileobj.name, str) else False
+    except (AttributeError, ValueError):
+        return False
+
+
+def fast_copy(src_fd, dst_fd, size, callback = None):
+    """
+    Copy size bytes from the current offset of src_fd to dst_fd, a reflink
+    of the whole file if possible, else copy_file_range(2), else read and
+    write.
+
+    Returns:
+        (str): method used, 'reflink', 'copy_file_range' or 'copy'
+    """
+    if fcntl is not None and os.lseek(src_fd, 0, os.SEEK_CUR) == 0 \
+            and os.lseek(dst_fd, 0, os.SEEK_CUR) == 0:
+        try:
+            fcntl.ioctl(dst_fd, FICLONE, src_fd)
+            os.lseek(dst_fd, size, os.SEEK_SET)
+            if callback:
+                callback(size)
+            return 'reflink'
+        except OSError:
+            pass
+    method = 'copy_file_range' if hasattr(os, 'copy_file_range') else 'copy'
+    left = size
+    while left > 0:
+        n = 0
+        if method == 'copy_file_range':
+            try:
+                n = os.copy_file_range(src_fd, dst_fd, min(left, CHUNK_SIZE))
+            except OSError:
+                ## e.g. across filesystems on older kernels
+                method = 'copy'
+        if method == 'copy':
+            data = os.read(src_fd, min(left, CHUNK_SIZE))
+            n = len(data)
+            while data:
+                data = data[os.write(dst_fd, data):]
+        if not n:
+            break
+        left -= n
+        if callback:
+            callback(n)
+    return method
+
+
+class Paginator():
+
+    def __init__(self, backend, page_size = PAGE_SIZE):
+        self.backend = backend
+        self.page_size = page_size
+
+    def paginate(self, Bucket = None, Prefix = '', StartAfter = ''):
+        """Pages of list_objects_v2 from a single pass over the keys."""
+        entries = self.backend.list(Bucket, Prefix, StartAfter)
+        while True:
+            self.backend.request('ListObjectsV2')
+            contents = []
+            for entry in entries:
+                contents.append(entry)
+                if len(contents) == self.page_size:
+                    break
+            page = self.backend.page(Bucket, Prefix, contents, self.page_size)
+            yield page
+            if not page['IsTruncated']:
+                return
+
+
+class StorageBackend(abc.ABC):
+
+    def __init__(self):
+        self.meta = SimpleNamespace(events = HierarchicalEmitter())
+
+    """Primitives"""
+
+    @abc.abstractmethod
+    def list(self, bucket, prefix = '', start_after = ''):
+        """
+        Yields:
+            (dict): 'Key', 'ETag', 'Size' and 'LastModified' of the objects
+                    under prefix after start_after, in key order.
+        """
+
+    @abc.abstractmethod
+    def head(self, bucket, key):
+        """
+        Returns:
+            (dict): 'ETag', 'Size', 'LastModified', 'Metadata', 'ContentType'
+
+        Raises:
+            ClientError: 404 if there is no such object.
+        """
+
+    @abc.abstractmethod
+    def get_range(self, bucket, key, start = 0, end = None):
+        """
+        Returns:
+            (bytes): object bytes [start, end), to the end if end is None.
+        """
+
+    @abc.abstractmethod
+    def put(self, bucket, key, source, metadata = None, content_type = None,
+            callback = None, config = None):
+        """
+        Store an object.
+
+        Args:
+            source: bytes or a readable file object.
+            callback (function): called with the number of bytes stored.
+            config (TransferConfig): part sizes of a managed upload, for the
+                                     ETag, None for a single part.
+
+        Returns:
+            (str): ETag of the object.
+        """
+
+    @abc.abstractmethod
+    def copy_key(self, bucket, key, src_bucket, src_key, metadata = None,
+                 content_type = None, sizes = None):
+        """
+        Copy an object, with new metadata and content type if they aren't
+        None.
+
+        Returns:
+            (str): ETag of the copy.
+        """
+
+    @abc.abstractmethod
+    def delete(self, bucket, key):
+        """Remove an object, if it exists."""
+
+    """Client API"""
+
+    def request(self, api):
+        """Emit the botocore events of a request, for deon.stats and deon.trace."""
+        model = SimpleNamespace(name = api)
+        self.meta.events.emit('before-call.s3.' + api, model = model, params = {},
+                              context = {})
+        self.meta.events.emit('after-call.s3.' + api, http_response = None,
+                              model = model, context = {},
+                              parsed = {'ResponseMetadata': {'RetryAttempts': 0}})
+
+    def page(self, bucket, prefix, contents, max_keys):
+        """list_objects_v2 response of a page of listing entries."""
+        contents = [dict(e, StorageClass = 'STANDARD') for e in contents]
+        page = {'Name': bucket, 'Prefix': prefix, 'KeyCount': len(contents),
+                'MaxKeys': max_keys, 'IsTruncated': len(contents) == max_keys}
+        ## like s3, an empty result has no 'Contents'
+        if contents:
+            page['Contents'] = contents
+        if page['IsTruncated']:
+            page['NextContinuationToken'] = contents[-1]['Key']
+        return page
+
+    def get_paginator(self, operation_name):
+        assert operation_name == 'list_objects_v2'
+        return Paginator(self)
+
+    def list_objects_v2(self, Bucket = None, Prefix = '', StartAfter = '',
+                        ContinuationToken = None, MaxKeys = PAGE_SIZE):
+        self.request('ListObjectsV2')
+        contents = []
+        for entry in self.list(Bucket, Prefix, max(StartAfter or '', ContinuationToken or '')):
+            contents.append(entry)
+            if len(contents) == MaxKeys:
+                break
+        return self.page(Bucket, Prefix, contents, MaxKeys)
+
+    def head_object(self, Bucket = None, Key = None, IfMatch = None):
+        self.request('HeadObject')
+        obj = self.head(Bucket, Key)
+        if IfMatch and IfMatch != obj['ETag']:
+            raise client_error('412', 'Precondition Failed', 'HeadObject')
+        return {'ETag': obj['ETag'], 'ContentLength': obj['Size'],
+                'LastModified': obj['LastModified'],
+                'Metadata': dict(obj['Metadata']),
+                'ContentType': obj['ContentType']}
+
+    def get_object(self, Bucket = None, Key = None, Range = None, IfMatch = None):
+        self.request('GetObject')
+        obj = self.head(Bucket, Key)
+        if IfMatch and IfMatch != obj['ETag']:
+            raise client_error('412', 'Precondition Failed', 'GetObject')
+        start, end = 0, obj['Size']
+        if Range:
+            first, last = Range.split('=', 1)[1].split('-')
+            start = int(first)
+            end = min(int(last) + 1, obj['Size']) if last else obj['Size']
+        data = self.get_range(Bucket, Key, start, end)
+        return {'Body': io.BytesIO(data), 'ETag': obj['ETag'],
+                'ContentLength': len(data),
+                'LastModified': obj['LastModified'],
+                'Metadata': dict(obj['Metadata']),
+                'ContentType': obj['ContentType']}
+
+    def put_object(self, Bucket = None, Key = None, Body = b'', Metadata = None,
+                   ContentType = None):
+        self.request('PutObject')
+        if isinstance(Body, str):
+            Body = Body.encode()
+        return {'ETag': self.put(Bucket, Key, Body, Metadata, ContentType)}
+
+    def delete_object(self, Bucket = None, Key = None):
+        self.request('DeleteObject')
+        self.delete(Bucket, Key)
+        return {}
+
+    def copy_object(self, Bucket = None, Key = None, CopySource = None,
+                    Metadata = None, MetadataDirective = 'COPY',
+                    ContentType = None):
+        self.request('CopyObject')
+        if MetadataDirective == 'REPLACE':
+            Metadata = Metadata or {}
+        else:
+            Metadata = ContentType = None
+        ## like s3, a copy is stored as a single part object
+        etag = self.copy_key(Bucket, Key, CopySource['Bucket'], CopySource['Key'],
+                             Metadata, ContentType)
+        return {'CopyObjectResult': {'ETag': etag}}
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, ExtraArgs = None,
+                       Callback = None, Config = None):
+        self.request('PutObject')
+        extra = ExtraArgs or {}
+        self.put(Bucket, Key, Fileobj, extra.get('Metadata'), extra.get('ContentType'),
+                 callback = Callback, config = Config or TransferConfig())
+
+    def download_fileobj(self, Bucket, Key, Fileobj, ExtraArgs = None,
+                         Callback = None, Config = None):
+        self.request('GetObject')
+        size = self.head(Bucket, Key)['Size']
+        offset = 0
+        while offset < size:
+            data = self.get_range(Bucket, Key, offset, min(offset + CHUNK_SIZE, size))
+            if not data:
+                break
+            Fileobj.write(data)
+            offset += len(data)
+            if Callback:
+                Callback(len(data))
+
+    def copy(self, CopySource, Bucket, Key, ExtraArgs = None, Callback = None,
+             Config = None):
+        self.request('CopyObject')
+        extra = ExtraArgs or {}
+        replace = extra.get('MetadataDirective') == 'REPLACE'
+        size = self.head(CopySource['Bucket'], CopySource['Key'])['Size']
+        self.copy_key(Bucket, Key, CopySource['Bucket'], CopySource['Key'],
+                      extra.get('Metadata') if replace else None,
+                      extra.get('ContentType') if replace else None,
+                      sizes = part_sizes(size, Config))
+        if Callback:
+            Callback(size)
+
+
+class LocalBackend(StorageBackend):
+
+    def __init__(self, root):
+        """
+        Args:
+            root (str): directory of the buckets, <root>/<bucket>/<key>.
+        """
+        super().__init__()
+        self.root = os.path.expanduser(root)
+        os.makedirs(os.path.join(self.root, TMP_DIR), exist_ok = True)
+
+    def body_path(self, bucket, key):
+        return os.path.join(self.root, bucket, key)
+
+    def meta_path(self, bucket, key):
+        ## '<key>.json', 'dir/.json' for a directory key 'dir/'
+        return os.path.join(self.root, META_DIR, bucket, key + META_SUFFIX)
+
+    def tmp_path(self):
+        return os.path.join(self.root, TMP_DIR, str(uuid.uuid4()))
+
+    def read_meta(self, bucket, key, operation = 'HeadObject'):
+        try:
+            with open(self.meta_path(bucket, key)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            raise client_error('404', 'Not Found', operation)
+
+    def write_meta(self, bucket, key, entry):
+        path = self.meta_path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        tmp = self.tmp_path()
+        with open(tmp, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp, path)
+
+    def entry(self, etag, size, metadata, content_type):
+        return {'ETag': etag, 'Size': size, 'LastModified': datetime.datetime.now(
+                    datetime.timezone.utc).isoformat(),
+                'Metadata': dict(metadata or {}),
+                'ContentType': content_type or 'binary/octet-stream'}
+
+    def install(self, bucket, key, tmp, entry):
+        """Move a staged body into place, then its metadata."""
+        if key.endswith('/'):
+            ## directory keys only have metadata
+            os.makedirs(self.body_path(bucket, key), exist_ok = True)
+            os.remove(tmp)
+        else:
+            path = self.body_path(bucket, key)
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok = True)
+                os.replace(tmp, path)
+            except (FileExistsError, IsADirectoryError, NotADirectoryError):
+                ## unlike s3, a file system can't have both 'a' and 'a/b'
+                os.remove(tmp)
+                raise client_error('InvalidRequest', key + ' conflicts with a key'
+                                   + ' of the same name as a directory', 'PutObject')
+        self.write_meta(bucket, key, entry)
+
+    def prune(self, path, top):
+        """Remove empty directories from path up to top."""
+        while os.path.normpath(path) != os.path.normpath(top):
+            try:
+                os.rmdir(path)
+            except OSError:
+                return
+            path = os.path.dirname(path)
+
+    """Primitives"""
+
+    def list(self, bucket, prefix = '', start_after = ''):
+        top = os.path.join(self.root, META_DIR, bucket)
+        base = prefix[:prefix.rfind('/') + 1]
+        return self.walk(top, base, prefix, start_after or '')
+
+    def walk(self, top, base, prefix, start_after):
+        """Entries under directory base of the metadata tree, in key order."""
+        try:
+            names = os.listdir(os.path.join(top, base))
+        except OSError:
+            return
+        ## a directory sorts as '<name>/', so the walk yields keys in order
+        children = []
+        for name in names:
+            if os.path.isdir(os.path.join(top, base, name)):
+                children.append((base + name + '/', True))
+            elif name.endswith(META_SUFFIX):
+                children.append((base + name[:-len(META_SUFFIX)], False))
+        for key, is_dir in sorted(children):
+            if is_dir:
+                if not (key.startswith(prefix) or prefix.startswith(key)):
+                    continue
+                if key <= start_after and not start_after.startswith(key):
+                    continue
+                for entry in self.walk(top, key, prefix, start_after):
+                    yield entry
+            elif key.startswith(prefix) and key > start_after:
+                try:
+                    with open(os.path.join(top, key + META_SUFFIX)) as f:
+                        meta = json.load(f)
+                except (OSError, ValueError):
+                    ## deleted while listing
+                    continue
+                yield {'Key': key, 'ETag': meta['ETag'], 'Size': meta['Size'],
+                       'LastModified': datetime.datetime.fromisoformat(meta['LastModified'])}
+
+    def head(self, bucket, key):
+        meta = self.read_meta(bucket, key)
+        meta['LastModified'] = datetime.datetime.fromisoformat(meta['LastModified'])
+        return meta
+
+    def get_range(self, bucket, key, start = 0, end = None):
+        if key.endswith('/'):
+            return b''
+        try:
+            with open(self.body_path(bucket, key), 'rb') as f:
+                f.seek(start)
+                return f.read() if end is None else f.read(end - start)
+        except OSError:
+            raise client_error('404', 'Not Found', 'GetObject')
+
+    def put(self, bucket, key, source, metadata = None, content_type = None,
+            callback = None, config = None):
+        tmp = self.tmp_path()
+        with open(tmp, 'wb') as f:
+            if real_file(source):
+                ## a local file, copied without passing through python if possible
+                offset = source.tell()
+                os.lseek(source.fileno(), offset, os.SEEK_SET)
+                size = os.fstat(source.fileno()).st_size - offset
+                fast_copy(source.fileno(), f.fileno(), size, callback)
+            else:
+                if isinstance(source, (bytes, bytearray)):
+                    source = io.BytesIO(source)
+                size = 0
+                while True:
+                    data = source.read(CHUNK_SIZE)
+                    if not data:
+                        break
+                    f.write(data)
+                    size += len(data)
+                    if callback:
+                        callback(len(data))
+        ## hashed from the page cache, like s3 computes the ETag on its side
+        etag = file_etag(tmp, part_sizes(size, config) if config else [size])
+        self.install(bucket, key, tmp, self.entry(etag, size, metadata, content_type))
+        return etag
+
+    def copy_key(self, bucket, key, src_bucket, src_key, metadata = None,
+                 content_type = None, sizes = None):
+        src = self.read_meta(src_bucket, src_key, 'CopyObject')
+        if metadata is None:
+            metadata = src['Metadata']
+        if content_type is None:
+            content_type = src['ContentType']
+        tmp = self.tmp_path()
+        if src_key.endswith('/'):
+            open(tmp, 'wb').close()
+        else:
+            try:
+                ## stored bodies are never modified in place, so they can
+                ## share an inode
+                os.link(self.body_path(src_bucket, src_key), tmp)
+            except OSError:
+                try:
+                    reflink(self.body_path(src_bucket, src_key), tmp)
+                except OSError:
+                    shutil.copyfile(self.body_path(src_bucket, src_key), tmp)
+        if sizes and len(sizes) > 1 or '-' in src['ETag']:
+            etag = file_etag(tmp, sizes or [src['Size']])
+        else:
+            ## a single part copy of a single part object
+            etag = src['ETag']
+        self.install(bucket, key, tmp, self.entry(etag, src['Size'], metadata, content_type))
+        return etag
+
+    def delete(self, bucket, key):
+        paths = [(self.meta_path(bucket, key), os.path.join(self.root, META_DIR, bucket))]
+        if not key.endswith('/'):
+            paths.append((self.body_path(bucket, key), os.path.join(self.root, bucket)))
+        for path, top in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self.prune(os.path.dirname(path), top)
+
+    """Client API"""
+
+    def download_fileobj(self, Bucket, Key, Fileobj, ExtraArgs = None,
+                         Callback = None, Config = None):
+        if not real_file(Fileobj) or Key.endswith('/'):
+            return super().download_fileobj(Bucket, Key, Fileobj, ExtraArgs = ExtraArgs,
+                                             Callback = Callback, Config = Config)
+        self.request('GetObject')
+        size = self.head(Bucket, Key)['Size']
+        Fileobj.flush()
+        with open(self.body_path(Bucket, Key), 'rb') as f:
+            fast_copy(f.fileno(), Fileobj.fileno(), size, Callback)
+        ## the buffered writer continues after the copied bytes
+        Fileobj.seek(0, os.SEEK_END)
+
+
+def get_backend(driver):
+    """
+    Storage backend of a "driver" setting, None for s3.
+
+    Args:
+        driver (str): "s3" or "local:<root>"
+    """
+    if not driver or driver == 's3':
+        return None
+    name, _, arg = driver.partition(':')
+    if name == 'local' and arg:
+        return LocalBackend(arg)
+    raise ValueError('unknown storage driver: ' + str(driver)
+                     + ', available: s3, local:<root>')
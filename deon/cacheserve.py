@@ -0,0 +1,447 @@
+"""
+Read-through cache server for s3 objects on a LAN.
+
+`deoncli cache-serve` answers the s3 read API (GetObject with Range,
+HeadObject and ListObjectsV2, path-style urls) for the workstations of a lab.
+The first GET of an object fills the disk cache from s3, concurrent GETs of
+the same object wait for that one fill, later GETs are served from disk.
+
+Clients set "cache_endpoint" in deon_config.json.  SmartS3Sync then sends
+object downloads to the cache with the ETag of its listing as If-Match.  The
+cache uses If-Match as a freshness hint: a cached copy with that ETag is
+served without asking s3, otherwise the object is read from s3 again with
+the same If-Match, and a request for a version s3 doesn't have anymore gets
+412 Precondition Failed like from s3, never another version.  Requests without If-Match are revalidated with a HEAD to s3 once the cached
+copy is older than ttl seconds.  Listings are passed through to s3.
+
+Requests are not authenticated, the cache reads with its own credentials,
+run it on a trusted network and limit it to the data buckets with --buckets.
+"""
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import threading
+import contextlib
+import urllib.request
+from urllib.parse import urlsplit, parse_qs, unquote
+from collections import OrderedDict
+from email.utils import formatdate
+from xml.sax.saxutils import escape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from botocore.exceptions import ClientError
+
+CHUNK_SIZE = 1024 * 1024
+DEFAULT_TTL = 30
+S3_XMLNS = 'http://s3.amazonaws.com/doc/2006-03-01/'
+
+
+def cache_reachable(endpoint, timeout = 2):
+    """True if a cache server answers at endpoint, e.g. http://cachehost:8910"""
+    try:
+        with urllib.request.urlopen(endpoint.rstrip('/') + '/', timeout = timeout) as r:
+            return r.status == 200
+    except (OSError, ValueError):
+        return False
+
+
+def http_date(timestamp):
+    return formatdate(timestamp, usegmt = True)
+
+
+def iso_date(timestamp):
+    return time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(timestamp))
+
+
+def timestamp(value):
+    """LastModified of a boto3 response (datetime) as seconds since epoch."""
+    if hasattr(value, 'timestamp'):
+        return value.timestamp()
+    return float(value or 0)
+
+
+def parse_range(header, size):
+    """
+    Args:
+        header (str): Range header, e.g. 'bytes=0-1023', 'bytes=-100'.
+        size (int): object size.
+
+    Returns:
+        (tuple): first and last byte (inclusive), None if the header is not a
+                 single byte range or can't be satisfied.
+    """
+    try:
+        unit, spec = header.split('=', 1)
+        first, last = spec.split('-')
+        if unit.strip() != 'bytes' or ',' in spec:
+            return None
+        if not first:
+            first, last = max(0, size - int(last)), size - 1
+        else:
+            first, last = int(first), min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        return None
+    if first > last or first >= size:
+        return None
+    return first, last
+
+
+class ObjectCache():
+
+    def __init__(self, s3cl, cache_dir, ttl = DEFAULT_TTL, max_bytes = None):
+        """
+        Args:
+            s3cl: boto3 s3 client, reads the objects from s3.
+            cache_dir (str): directory of the cached objects.
+            ttl (float): seconds a cached object is served without asking s3,
+                         for requests without If-Match.
+            max_bytes (int): cache size, least recently used objects are
+                             evicted beyond it, None for unlimited.
+        """
+        self.s3cl = s3cl
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.fills = {}
+        self.logger = logging.getLogger(self.__class__.__name__)
+        os.makedirs(cache_dir, exist_ok = True)
+        self.sizes, self.total = self.scan()
+
+    def scan(self):
+        """
+        Sizes of the cached bodies, least recently used first, kept in memory
+        for eviction.
+
+        Returns:
+            (tuple): OrderedDict {path: size}, total bytes.
+        """
+        entries = []
+        for root, dirs, files in os.walk(self.cache_dir):
+            for name in files:
+                if '.' in name:
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, path, st.st_size))
+        sizes = OrderedDict((path, size) for mtime, path, size in sorted(entries))
+        return sizes, sum(sizes.values())
+
+    def path(self, bucket, key):
+        h = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.cache_dir, bucket, h[:2], h)
+
+    def load(self, bucket, key):
+        """Cached metadata of an object, None if it isn't cached."""
+        try:
+            with open(self.path(bucket, key) + '.json') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not os.path.isfile(self.path(bucket, key)):
+            return None
+        return meta
+
+    def save(self, bucket, key, meta):
+        path = self.path(bucket, key) + '.json'
+        tmp = path + '.tmp.' + str(threading.get_ident())
+        with open(tmp, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp, path)
+
+    def fresh(self, meta, if_match = None):
+        if meta is None:
+            return False
+        if if_match:
+            return meta['ETag'] == if_match.replace('"', '')
+        return time.time() - meta['checked'] < self.ttl
+
+    @contextlib.contextmanager
+    def fill_lock(self, bucket, key):
+        """Lock of the fill of an object, dropped when no thread holds or waits for it."""
+        with self.lock:
+            entry = self.fills.setdefault((bucket, key), [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.fills[(bucket, key)]
+
+    def head(self, bucket, key):
+        """
+        Returns:
+            (dict): object metadata, {'ETag', 'ContentLength', 'LastModified',
+                    'ContentType', 'Metadata', 'checked'}
+        """
+        meta = self.load(bucket, key)
+        if self.fresh(meta):
+            return meta
+        response = self.s3cl.head_object(Bucket = bucket, Key = key)
+        head = self.meta(response)
+        if meta is not None and meta['ETag'] == head['ETag']:
+            meta['checked'] = head['checked']
+            self.save(bucket, key, meta)
+        return head
+
+    def get(self, bucket, key, if_match = None):
+        """
+        Cached metadata and open body of an object, filled from s3 if it
+        isn't cached or stale.  Concurrent calls for one object share a fill.
+        The body stays readable if the object is evicted, close it.
+        """
+        path = self.path(bucket, key)
+        meta = self.load(bucket, key)
+        while True:
+            if not self.fresh(meta, if_match):
+                with self.fill_lock(bucket, key):
+                    meta = self.load(bucket, key)
+                    if not self.fresh(meta, if_match):
+                        meta = self.revalidate(bucket, key, meta, if_match)
+            ## evict removes bodies under self.lock
+            with self.lock:
+                try:
+                    f = open(path, 'rb')
+                except FileNotFoundError:
+                    f = None
+                else:
+                    self.used(path)
+            if f is not None:
+                return meta, f
+            ## evicted by another fill since, fill again
+            meta = None
+
+    def used(self, path, size = None):
+        """Mark a body recently used, with its size if it's new, under self.lock."""
+        if size is not None:
+            self.total += size - self.sizes.get(path, 0)
+            self.sizes[path] = size
+        if path in self.sizes:
+            self.sizes.move_to_end(path)
+        try:
+            ## recency across restarts
+            os.utime(path)
+        except OSError:
+            pass
+
+    def revalidate(self, bucket, key, meta, if_match = None):
+        if meta is not None and not if_match:
+            head = self.meta(self.s3cl.head_object(Bucket = bucket, Key = key))
+            if head['ETag'] == meta['ETag']:
+                meta['checked'] = head['checked']
+                self.save(bucket, key, meta)
+                return meta
+        return self.fill(bucket, key, if_match)
+
+    def fill(self, bucket, key, if_match = None):
+        """
+        Download an object into the cache.
+
+        Raises:
+            ClientError: 412 if the object isn't the version if_match names
+                         anymore, nothing is cached then.
+        """
+        path = self.path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        args = {'IfMatch': if_match} if if_match else {}
+        response = self.s3cl.get_object(Bucket = bucket, Key = key, **args)
+        tmp = path + '.tmp.' + str(threading.get_ident())
+        try:
+            with open(tmp, 'wb') as f:
+                shutil.copyfileobj(response['Body'], f, CHUNK_SIZE)
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        meta = self.meta(response)
+        self.save(bucket, key, meta)
+        with self.lock:
+            self.used(path, meta['ContentLength'])
+        self.logger.info('filled ' + bucket + '/' + key + ' (' + str(meta['ContentLength'])
+                         + ' bytes)')
+        if self.max_bytes:
+            self.evict(keep = path)
+        return meta
+
+    def meta(self, response):
+        return {'ETag': response['ETag'].replace('"', ''),
+                'ContentLength': int(response['ContentLength']),
+                'LastModified': timestamp(response.get('LastModified')),
+                'ContentType': response.get('ContentType') or 'binary/octet-stream',
+                'Metadata': response.get('Metadata') or {},
+                'checked': time.time()}
+
+    def evict(self, keep = None):
+        """Remove least recently used objects until the cache fits max_bytes."""
+        with self.lock:
+            for path in list(self.sizes):
+                if self.total <= self.max_bytes:
+                    break
+                if path == keep:
+                    continue
+                for p in (path + '.json', path):
+                    try:
+                        os.remove(p)
+                    except FileNotFoundError:
+                        pass
+                self.total -= self.sizes.pop(path)
+
+
+class CacheHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    server_version = 'deon-cache'
+
+    def parse(self):
+        url = urlsplit(self.path)
+        bucket, _, key = unquote(url.path).lstrip('/').partition('/')
+        return bucket, key, parse_qs(url.query)
+
+    def do_HEAD(self):
+        self.handle_read(body = False)
+
+    def do_GET(self):
+        self.handle_read(body = True)
+
+    def handle_read(self, body):
+        bucket, key, query = self.parse()
+        if not bucket:
+            return self.send_body(200, b'deon cache\n', 'text/plain')
+        if self.server.buckets and bucket not in self.server.buckets:
+            return self.send_error_xml(403, 'AccessDenied', 'bucket is not served by this cache')
+        try:
+            if not key:
+                if not body:
+                    return self.send_body(200, b'', 'application/xml')
+                return self.send_listing(bucket, query)
+            if not body and not self.headers.get('If-Match'):
+                return self.send_object(self.server.cache.head(bucket, key), None)
+            ## a HEAD with If-Match comes from a deon download, the GETs of
+            ## the object follow
+            meta, f = self.server.cache.get(bucket, key, self.headers.get('If-Match'))
+            with f:
+                return self.send_object(meta, f if body else None)
+        except ClientError as e:
+            error = e.response.get('Error', {})
+            code = str(error.get('Code', 'InternalError'))
+            status = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+            if not status:
+                status = int(code) if code.isdigit() else {'NoSuchKey': 404, 'NoSuchBucket': 404,
+                                                           'AccessDenied': 403,
+                                                           'PreconditionFailed': 412}.get(code, 500)
+            if code.isdigit():
+                code = {404: 'NoSuchKey', 403: 'AccessDenied',
+                        412: 'PreconditionFailed'}.get(status, code)
+            return self.send_error_xml(status, code, error.get('Message', ''), body = body)
+
+    def send_object(self, meta, f):
+        """Send an object's headers, and its body from the open file f unless it's None."""
+        size = meta['ContentLength']
+        status = 200
+        first, last = 0, size - 1
+        if self.headers.get('Range') and size:
+            byte_range = parse_range(self.headers['Range'], size)
+            if byte_range is None:
+                return self.send_error_xml(416, 'InvalidRange', 'the requested range is not satisfiable',
+                                           body = f is not None)
+            status = 206
+            first, last = byte_range
+        self.send_response(status)
+        self.send_header('Content-Length', str(last - first + 1 if size else 0))
+        self.send_header('ETag', '"' + meta['ETag'] + '"')
+        self.send_header('Last-Modified', http_date(meta['LastModified']))
+        self.send_header('Content-Type', meta['ContentType'])
+        self.send_header('Accept-Ranges', 'bytes')
+        if status == 206:
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (first, last, size))
+        for k, v in meta['Metadata'].items():
+            self.send_header('x-amz-meta-' + k, v)
+        self.end_headers()
+        if f is None or not size:
+            return
+        f.seek(first)
+        remaining = last - first + 1
+        while remaining > 0:
+            data = f.read(min(CHUNK_SIZE, remaining))
+            if not data:
+                break
+            self.wfile.write(data)
+            remaining -= len(data)
+
+    def send_listing(self, bucket, query):
+        args = {'Bucket': bucket}
+        for param, arg in [('prefix', 'Prefix'), ('start-after', 'StartAfter'),
+                           ('continuation-token', 'ContinuationToken'),
+                           ('delimiter', 'Delimiter')]:
+            if query.get(param):
+                args[arg] = query[param][0]
+        if query.get('max-keys'):
+            args['MaxKeys'] = int(query['max-keys'][0])
+        page = self.server.cache.s3cl.list_objects_v2(**args)
+        xml = ['<?xml version="1.0" encoding="UTF-8"?>',
+               '<ListBucketResult xmlns="' + S3_XMLNS + '">',
+               '<Name>' + escape(bucket) + '</Name>',
+               '<Prefix>' + escape(page.get('Prefix', '')) + '</Prefix>',
+               '<KeyCount>' + str(page.get('KeyCount', 0)) + '</KeyCount>',
+               '<MaxKeys>' + str(page.get('MaxKeys', 1000)) + '</MaxKeys>',
+               '<IsTruncated>' + str(bool(page.get('IsTruncated'))).lower() + '</IsTruncated>']
+        for param in ('ContinuationToken', 'NextContinuationToken', 'StartAfter', 'Delimiter'):
+            if page.get(param):
+                xml.append('<' + param + '>' + escape(page[param]) + '</' + param + '>')
+        for item in page.get('Contents', []):
+            xml.append('<Contents><Key>' + escape(item['Key']) + '</Key>'
+                       + '<LastModified>' + iso_date(timestamp(item.get('LastModified')))
+                       + '</LastModified><ETag>' + escape(item['ETag']) + '</ETag>'
+                       + '<Size>' + str(item['Size']) + '</Size><StorageClass>'
+                       + item.get('StorageClass', 'STANDARD') + '</StorageClass></Contents>')
+        for item in page.get('CommonPrefixes', []):
+            xml.append('<CommonPrefixes><Prefix>' + escape(item['Prefix'])
+                       + '</Prefix></CommonPrefixes>')
+        xml.append('</ListBucketResult>')
+        self.send_body(200, '\n'.join(xml).encode(), 'application/xml')
+
+    def send_error_xml(self, status, code, message, body = True):
+        xml = ('<?xml version="1.0" encoding="UTF-8"?>\n<Error><Code>' + escape(code)
+               + '</Code><Message>' + escape(message) + '</Message></Error>').encode()
+        self.send_body(status, xml if body else b'', 'application/xml')
+
+    def send_body(self, status, data, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if data and self.command != 'HEAD':
+            self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        self.server.logger.debug('%s %s' % (self.address_string(), format % args))
+
+
+class CacheServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, cache, host = '0.0.0.0', port = 8910, buckets = None):
+        """
+        Args:
+            cache (ObjectCache): object cache.
+            host (str): address to listen on.
+            port (int): port to listen on.
+            buckets (list): buckets served, None for all buckets the cache's
+                            credentials can read.
+        """
+        ThreadingHTTPServer.__init__(self, (host, port), CacheHandler)
+        self.cache = cache
+        self.buckets = set(buckets) if buckets else None
+        self.logger = logging.getLogger(self.__class__.__name__)
@@ -0,0 +1,199 @@
+"""
+Append-only changefeed per s3 prefix.
+
+Uploaders append one segment object per sync to the changefeed of the synced
+prefix and of each parent prefix.  A segment holds one change record per
+uploaded or copied object (key, ETag, size, codec and metajson) as gzipped
+JSON lines, at
+
+    <prefix>.deon/changefeed/<milliseconds since epoch>-<random>.jsonl.gz
+
+so segments are ordered by name and appending never needs a listing.
+Downloaders keep a cursor in the deon repo (.deon/changefeed/) and only list
+segments written after it, so a sync with few new files costs a few small
+requests instead of a listing of the entire prefix.
+
+Segments from uploaders with clocks up to OVERLAP behind are still picked
+up: the segments of the last OVERLAP before the cursor are listed again and
+the ones already applied are skipped.  A full listing every
+RECONCILE_INTERVAL (or with --reconcile) catches anything else.
+"""
+
+import os
+import io
+import json
+import gzip
+import time
+import uuid
+import logging
+from collections import OrderedDict
+
+FEED_DIR = '.deon/changefeed/'
+CURSOR_DIR = os.path.join('.deon', 'changefeed')
+
+## milliseconds
+OVERLAP = 60 * 60 * 1000
+## seconds
+RECONCILE_INTERVAL = 24 * 60 * 60
+
+
+def feed_prefix(prefix):
+    return prefix + FEED_DIR
+
+
+def is_feed_key(key):
+    return key.startswith(FEED_DIR) or ('/' + FEED_DIR) in key
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+def make_record(key, remote, metajson = None):
+    """
+    Args:
+        key (str): s3 key.
+        remote (dict): object in the form of SmartS3Sync.resolve_plain_etags,
+                       {'ETag': plain md5sum, 'Size':..., 'StoredETag':...,
+                       'Codec':..., 'Fingerprint':...}
+        metajson (str): metajson metadata of the object.
+
+    Returns:
+        (OrderedDict): change record.
+    """
+    record = OrderedDict([('Key', key),
+                          ('ETag', remote['ETag'].replace('"', '')),
+                          ('Size', int(remote['Size']))])
+    if remote.get('Codec'):
+        record['Codec'] = remote['Codec']
+    if remote.get('StoredETag'):
+        record['StoredETag'] = remote['StoredETag'].replace('"', '')
+    if remote.get('Fingerprint'):
+        record['Fingerprint'] = remote['Fingerprint']
+    if metajson is not None:
+        record['metajson'] = metajson
+    return record
+
+
+class Changefeed():
+
+    def __init__(self, s3cl, bucket, prefix, cursor_dir = CURSOR_DIR,
+                 cursor_name = 'cursor.json'):
+        """
+        Args:
+            s3cl: boto3 s3 client.
+            bucket (str): bucket name.
+            prefix (str): s3 prefix the feed belongs to, e.g. 'home/user/' or
+                          '' for the bucket.
+            cursor_dir (str): local cursor directory, in the deon repo.
+            cursor_name (str): one cursor per consumer of the feed, e.g. data
+                               and metadata syncs.
+        """
+        self.s3cl = s3cl
+        self.bucket = bucket
+        self.prefix = prefix
+        self.cursor_path = os.path.join(cursor_dir, bucket, prefix, cursor_name)
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    """Writing"""
+
+    def append(self, records):
+        """
+        Write records as a new segment.
+
+        Returns:
+            (str): segment key, None if there were no records.
+        """
+        if not records:
+            return None
+        buf = io.BytesIO()
+        with gzip.GzipFile(fileobj = buf, mode = 'wb') as f:
+            for record in records:
+                f.write((json.dumps(record) + '\n').encode())
+        key = (feed_prefix(self.prefix) + '%013d' % now_ms() + '-'
+               + uuid.uuid4().hex[:8] + '.jsonl.gz')
+        self.logger.info('appending ' + str(len(records)) + ' changes to ' + key)
+        self.s3cl.put_object(Bucket = self.bucket, Key = key, Body = buf.getvalue(),
+                             ContentType = 'application/gzip')
+        return key
+
+    """Reading"""
+
+    def load_cursor(self):
+        """
+        Returns:
+            (dict): {'position': ms, 'applied': [segment names],
+                     'reconciled': seconds}, None if there is no cursor.
+        """
+        if not os.path.isfile(self.cursor_path):
+            return None
+        with open(self.cursor_path) as f:
+            return json.load(f)
+
+    def save_cursor(self, cursor):
+        os.makedirs(os.path.dirname(self.cursor_path), exist_ok = True)
+        tmp = self.cursor_path + '.tmp.' + str(os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(cursor, f)
+        os.replace(tmp, self.cursor_path)
+
+    def needs_reconcile(self, cursor = None, interval = RECONCILE_INTERVAL):
+        cursor = cursor or self.load_cursor()
+        return cursor is None or time.time() - cursor.get('reconciled', 0) > interval
+
+    def reconciled(self, started):
+        """
+        Save the cursor after a full listing.
+
+        Args:
+            started (float): time.time() before the listing started, changes
+                             after it are read from the feed next time.
+        """
+        self.save_cursor({'position': int(started * 1000), 'applied': [],
+                          'reconciled': started})
+
+    def segments(self, after):
+        """Segment names written at or after position after (ms)."""
+        paginator = self.s3cl.get_paginator('list_objects_v2')
+        start = feed_prefix(self.prefix) + '%013d' % max(0, after)
+        names = []
+        for page in paginator.paginate(Bucket = self.bucket,
+                                       Prefix = feed_prefix(self.prefix),
+                                       StartAfter = start):
+            for item in page.get('Contents', []):
+                names.append(item['Key'][len(feed_prefix(self.prefix)):])
+        return sorted(names)
+
+    def read(self, cursor):
+        """
+        Read the records of the segments after the cursor.
+
+        Args:
+            cursor (dict): see load_cursor.
+
+        Returns:
+            records (OrderedDict): {'s3key/path': record}, the latest record
+                                   per key.
+            cursor (dict): the cursor after these records, save it with
+                           save_cursor once they are applied.
+        """
+        applied = set(cursor.get('applied', []))
+        position = cursor['position']
+        records = OrderedDict()
+        names = []
+        for name in self.segments(position - OVERLAP):
+            names.append(name)
+            if name in applied:
+                continue
+            body = self.s3cl.get_object(Bucket = self.bucket,
+                                        Key = feed_prefix(self.prefix) + name)['Body'].read()
+            for line in gzip.decompress(body).decode().splitlines():
+                if line:
+                    record = json.loads(line)
+                    records.pop(record['Key'], None)
+                    records[record['Key']] = record
+            position = max(position, int(name.split('-', 1)[0]))
+        new_cursor = dict(cursor, position = position,
+                          applied = [n for n in names
+                                     if int(n.split('-', 1)[0]) >= position - OVERLAP])
+        return records, new_cursor
@@ -0,0 +1,183 @@
+"""
+Streaming compression codecs for objects stored in s3.
+
+Objects are compressed while they are read for upload and decompressed while
+they are written on download, nothing is staged on disk.  The codec name is
+recorded in the object metadata ('codec') together with the md5sum of the
+plain file ('plain-etag'), so ETags can be compared against local files.
+
+zstd needs the zstandard package (pip install zstandard), gzip only needs the
+standard library.
+"""
+
+import zlib
+import hashlib
+from binascii import unhexlify
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class CompressReader():
+    """File-like object returning the compressed contents of fileobj."""
+
+    def __init__(self, fileobj, compressor, chunk_size = CHUNK_SIZE):
+        self.fileobj = fileobj
+        self.compressor = compressor
+        self.chunk_size = chunk_size
+        self.buffer = b''
+        self.eof = False
+
+    def read(self, size = -1):
+        while not self.eof and (size is None or size < 0 or len(self.buffer) < size):
+            chunk = self.fileobj.read(self.chunk_size)
+            if chunk:
+                self.buffer += self.compressor.compress(chunk)
+            else:
+                self.buffer += self.compressor.flush()
+                self.eof = True
+        if size is None or size < 0:
+            data, self.buffer = self.buffer, b''
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+class DecompressWriter():
+    """File-like object writing the decompressed data to fileobj."""
+
+    def __init__(self, fileobj, decompressor):
+        self.fileobj = fileobj
+        self.decompressor = decompressor
+
+    def write(self, data):
+        out = self.decompressor.decompress(data)
+        if out:
+            self.fileobj.write(out)
+        return len(data)
+
+    def flush(self):
+        out = self.decompressor.flush()
+        if out:
+            self.fileobj.write(out)
+        self.fileobj.flush()
+
+
+class CodecWriter():
+    """
+    File-like object for downloads whose codec is only known once the
+    transfer started, resolve() is called at the first write and returns the
+    codec name, None to write the data as it is.
+    """
+
+    def __init__(self, fileobj, resolve):
+        self.fileobj = fileobj
+        self.resolve = resolve
+        self.writer = None
+
+    def write(self, data):
+        if self.writer is None:
+            codec = self.resolve()
+            self.writer = get_codec(codec).decompress_writer(self.fileobj) if codec else self.fileobj
+        return self.writer.write(data)
+
+    def flush(self):
+        (self.writer or self.fileobj).flush()
+
+
+class ETagReader():
+    """
+    Passes reads through and computes the s3 ETag of the bytes read, for
+    uploads of streams whose ETag can't be computed from a file, i.e.
+    compressed streams.
+    """
+
+    def __init__(self, fileobj, part_size):
+        self.fileobj = fileobj
+        self.part_size = part_size
+        self.part = hashlib.md5()
+        self.part_bytes = 0
+        self.md5s = []
+        self.size = 0
+
+    def read(self, size = -1):
+        data = self.fileobj.read(size)
+        view = memoryview(data)
+        while len(view):
+            n = min(len(view), self.part_size - self.part_bytes)
+            self.part.update(view[:n])
+            self.part_bytes += n
+            view = view[n:]
+            if self.part_bytes == self.part_size:
+                self.md5s.append(self.part.hexdigest())
+                self.part = hashlib.md5()
+                self.part_bytes = 0
+        self.size += len(data)
+        return data
+
+    def etag(self):
+        """Same as S3SyncUtility.md5 of the bytes read so far."""
+        md5s = list(self.md5s)
+        if self.part_bytes or not md5s:
+            md5s.append(self.part.hexdigest())
+        if len(md5s) == 1:
+            return md5s[0]
+        return (hashlib.md5(unhexlify(''.join(md5s))).hexdigest()
+                + '-' + str(len(md5s)))
+
+
+class GzipCodec():
+
+    name = 'gzip'
+
+    def __init__(self, level = 6):
+        self.level = level
+
+    def compress_reader(self, fileobj):
+        ## wbits 31: gzip container
+        return CompressReader(fileobj, zlib.compressobj(self.level, zlib.DEFLATED, 31))
+
+    def decompress_writer(self, fileobj):
+        return DecompressWriter(fileobj, zlib.decompressobj(31))
+
+
+class ZstdCodec():
+
+    name = 'zstd'
+
+    def __init__(self, level = 3):
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError('zstd compression needs the zstandard package, '
+                              'pip install zstandard')
+        self.zstandard = zstandard
+        self.level = level
+
+    def compress_reader(self, fileobj):
+        compressor = self.zstandard.ZstdCompressor(level = self.level)
+        return CompressReader(fileobj, compressor.compressobj())
+
+    def decompress_writer(self, fileobj):
+        return DecompressWriter(fileobj, self.zstandard.ZstdDecompressor().decompressobj())
+
+
+CODECS = {
+    'gzip': GzipCodec,
+    'zstd': ZstdCodec,
+}
+
+
+def get_codec(name, level = None):
+    """
+    Args:
+        name (str): codec name, one of CODECS.
+        level (int): compression level, codec default if None.
+    """
+    try:
+        codec = CODECS[name]
+    except KeyError:
+        raise ValueError('unknown compression codec: ' + str(name) + ', available: '
+                         + ', '.join(sorted(CODECS)))
+    if level is None:
+        return codec()
+    return codec(level = level)
@@ -0,0 +1,522 @@
+"""
+Warm background daemon for deoncli.
+
+Every deoncli command pays for importing boto3, resolving credentials, TLS
+handshakes and loading the hash caches from disk.  `deoncli daemon start`
+keeps a process with all of that warm and runs commands sent to it over a
+Unix socket (~/.deon/daemon.sock, only accessible to its user):
+
+    deoncli daemon start --detach
+    deoncli up rail-robot-data-sharing-v1/robot1   # runs in the daemon
+    deoncli daemon status
+    deoncli daemon stop
+
+While a daemon is listening, deoncli sends its command line, working
+directory and AWS_* environment variables to it and prints what the command
+prints; without one, or with DEON_NO_DAEMON=1, commands run as before.
+Commands that are interactive or don't return (daemon, cache-serve,
+metadata load, --interval) always run in the calling process.
+
+The daemon keeps between commands:
+
+  - a boto3 session and s3 client (with its connection pool) per profile and
+    AWS_* environment,
+  - the gzipped json caches of SmartS3Sync (localcache, quick stats,
+    fingerprints, part and codec ETags), reloaded only when their file
+    changed,
+  - listings of the pooled clients for listing_ttl seconds.  Any write
+    through a pooled client drops all of them, writes by other processes or
+    machines are seen once the ttl passed, --listing_ttl 0 turns this off.
+
+Commands run one at a time, in the order they arrive, since they change the
+working directory and the environment of the daemon.  Interrupting deoncli
+doesn't stop a command the daemon already started.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import logging
+import threading
+import traceback
+from collections import OrderedDict, Counter
+from contextlib import redirect_stdout, redirect_stderr
+from socketserver import ThreadingUnixStreamServer, StreamRequestHandler
+
+SOCKET_PATH = '~/.deon/daemon.sock'
+LISTING_TTL = 30.0
+## commands that are interactive or don't return, always run locally
+LOCAL_COMMANDS = (('daemon',), ('cache-serve',), ('metadata', 'load'))
+LOCAL_OPTIONS = ('--interval',)
+## requests after which cached listings may be stale
+WRITES = ('PutObject', 'CopyObject', 'DeleteObject', 'DeleteObjects',
+          'CompleteMultipartUpload')
+
+_warm = None
+
+
+def warm_state():
+    """WarmState of this process if it's a deoncli daemon, else None."""
+    return _warm
+
+
+def socket_path(path = None):
+    return os.path.expanduser(path or os.environ.get('DEON_DAEMON_SOCKET') or SOCKET_PATH)
+
+
+def copy_listing(matches):
+    """Listings are translated in place, e.g. by resolve_plain_etags."""
+    if matches is None:
+        return None
+    return OrderedDict((k, dict(v)) for k, v in matches.items())
+
+
+class WarmState():
+
+    def __init__(self, listing_ttl = LISTING_TTL):
+        """
+        Args:
+            listing_ttl (float): seconds a listing is reused, 0 to always
+                                 list again.
+        """
+        self.listing_ttl = listing_ttl
+        self.lock = threading.Lock()
+        ## client key: (session, s3 client, s3 resource)
+        self.clients = OrderedDict()
+        ## syncs of the running command using pooled clients
+        self.borrowers = []
+        ## path: ((mtime_ns, size), contents)
+        self.json_caches = {}
+        ## (client key, bucket, prefix): (time, matches)
+        self.listings = {}
+        self.generation = 0
+        self.hits = Counter()
+
+    """boto3"""
+
+    def client_key(self, profile):
+        return (profile,) + tuple(sorted((k, v) for k, v in os.environ.items()
+                                         if k.startswith('AWS_')))
+
+    def boto3_clients(self, profile, sync):
+        """
+        Session, s3 client and s3 resource of a profile, created by the first
+        sync that asks for them.
+
+        Args:
+            profile (str): aws profile name.
+            sync (SmartS3Sync): its stats and tracer are detached from the
+                                client once the command finished.
+
+        Returns:
+            (tuple): client key, session, s3 client, s3 resource
+        """
+        import boto3
+
+        key = self.client_key(profile)
+        with self.lock:
+            if key in self.clients:
+                self.hits['session'] += 1
+            else:
+                session = boto3.Session(profile_name = profile) if profile else boto3.Session()
+                s3cl = session.client('s3')
+                for event in ('before-call.s3', 'after-call.s3'):
+                    s3cl.meta.events.register(event, self.written,
+                                              unique_id = 'deon-daemon-' + event)
+                self.clients[key] = (session, s3cl, session.resource('s3'))
+            self.borrowers.append(sync)
+            return (key,) + self.clients[key]
+
+    def release(self):
+        """Detach the stats and tracers of the finished command from the pooled clients."""
+        with self.lock:
+            borrowers, self.borrowers = self.borrowers, []
+        for sync in borrowers:
+            sync.stats.detach(sync.s3cl)
+            sync.tracer.detach(sync.s3cl)
+
+    """json caches"""
+
+    def load_json(self, path, load):
+        """
+        Contents of a json cache file, read again only if it changed.
+
+        Args:
+            load (function): reads the file, e.g. load_json_cache.
+
+        Returns:
+            (dict): a copy, callers update it.
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return load(path)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            cached = self.json_caches.get(path)
+        if cached is not None and cached[0] == stamp:
+            self.hits['json'] += 1
+            return dict(cached[1])
+        contents = load(path)
+        with self.lock:
+            self.json_caches[path] = (stamp, contents)
+        return dict(contents)
+
+    def saved_json(self, path, contents):
+        """Remember the contents of a json cache file just written."""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return
+        with self.lock:
+            self.json_caches[path] = ((stat.st_mtime_ns, stat.st_size), dict(contents))
+
+    """listings"""
+
+    def listing(self, key, bucket, prefix):
+        """
+        Returns:
+            (OrderedDict): a copy of a listing younger than listing_ttl.
+
+        Raises:
+            KeyError: there is none.
+        """
+        with self.lock:
+            listed, matches = self.listings[(key, bucket, prefix)]
+        if time.time() - listed > self.listing_ttl:
+            raise KeyError(prefix)
+        self.hits['listing'] += 1
+        return copy_listing(matches)
+
+    def store_listing(self, key, bucket, prefix, matches, listed, generation):
+        """
+        Args:
+            listed (float): time.time() before listing.
+            generation (int): self.generation before listing, the listing
+                              isn't kept if there were writes since.
+        """
+        if not self.listing_ttl:
+            return
+        with self.lock:
+            if generation == self.generation:
+                self.listings[(key, bucket, prefix)] = (listed, copy_listing(matches))
+
+    def written(self, model = None, **kwargs):
+        if model is not None and model.name in WRITES:
+            with self.lock:
+                self.generation += 1
+                self.listings.clear()
+
+    def status(self):
+        with self.lock:
+            return OrderedDict([('sessions', len(self.clients)),
+                                ('json_caches', len(self.json_caches)),
+                                ('listings', len(self.listings)),
+                                ('listing_ttl', self.listing_ttl),
+                                ('hits', dict(self.hits))])
+
+
+class StreamWriter():
+    """Text stream sending what a command prints to the client."""
+
+    encoding = 'utf-8'
+
+    def __init__(self, wfile, name, tty = False):
+        self.wfile = wfile
+        self.name = name
+        self.tty = tty
+        self.lock = threading.Lock()
+        self.broken = False
+
+    def write(self, data):
+        if not isinstance(data, str):
+            ## like a text stream, click probes write(b'') for binary streams
+            raise TypeError('write() argument must be str, not ' + type(data).__name__)
+        if data and not self.broken:
+            line = (json.dumps({self.name: data}) + '\n').encode()
+            with self.lock:
+                try:
+                    self.wfile.write(line)
+                    self.wfile.flush()
+                except OSError:
+                    ## the client went away, the command still finishes
+                    self.broken = True
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return self.tty
+
+
+class CurrentStderr():
+    """Log handler stream following sys.stderr, so log records of a command go to its client."""
+
+    def write(self, data):
+        return sys.stderr.write(data)
+
+    def flush(self):
+        sys.stderr.flush()
+
+
+def invoke(cli, argv):
+    """Run a click command line, returns its exit code."""
+    import click
+
+    try:
+        ## the return value of the command, or the code of ctx.exit
+        code = cli.main(args = argv, prog_name = 'deoncli', standalone_mode = False)
+        return code if isinstance(code, int) else 0
+    except click.ClickException as e:
+        e.show()
+        return e.exit_code
+    except click.exceptions.Abort:
+        sys.stderr.write('Aborted!\n')
+        return 1
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+        sys.stderr.write(str(e.code) + '\n')
+        return 1
+    except Exception:
+        traceback.print_exc()
+        return 1
+
+
+class DaemonHandler(StreamRequestHandler):
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode())
+        except ValueError:
+            return
+        self.server.touch()
+        if request.get('control') == 'status':
+            self.reply(self.server.status())
+        elif request.get('control') == 'stop':
+            self.reply({'stopping': os.getpid()})
+            threading.Thread(target = self.server.shutdown).start()
+        elif 'argv' in request:
+            code = self.server.run(request, self.wfile)
+            self.reply({'exit': code})
+        self.server.touch()
+
+    def reply(self, message):
+        try:
+            self.wfile.write((json.dumps(message) + '\n').encode())
+        except OSError:
+            pass
+
+
+class DaemonServer(ThreadingUnixStreamServer):
+
+    daemon_threads = True
+
+    def __init__(self, path, state, cli, idle_timeout = 0):
+        """
+        Args:
+            path (str): socket path.
+            state (WarmState): caches kept between commands.
+            cli (click.Group): deoncli.
+            idle_timeout (float): seconds without commands after which the
+                                  daemon exits, 0 to run until stopped.
+        """
+        self.path = path
+        self.state = state
+        self.cli = cli
+        self.idle_timeout = idle_timeout
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.command_lock = threading.Lock()
+        self.started = time.time()
+        self.active = time.time()
+        self.commands = 0
+        ## the socket runs commands with the user's credentials, bind it
+        ## owner-only instead of narrowing it after it's reachable
+        umask = os.umask(0o077)
+        try:
+            ThreadingUnixStreamServer.__init__(self, path, DaemonHandler)
+        finally:
+            os.umask(umask)
+        os.chmod(path, 0o600)
+        if idle_timeout:
+            threading.Thread(target = self.watch_idle, daemon = True).start()
+
+    def touch(self):
+        self.active = time.time()
+
+    def watch_idle(self):
+        while True:
+            time.sleep(min(self.idle_timeout, 10.0))
+            if not self.command_lock.locked() and time.time() - self.active > self.idle_timeout:
+                self.logger.info('idle for %ds, exiting' % self.idle_timeout)
+                self.shutdown()
+                return
+
+    def run(self, request, wfile):
+        """Run a command line in the client's working directory and environment."""
+        out = StreamWriter(wfile, 'out', request.get('stdout_tty', False))
+        err = StreamWriter(wfile, 'err', request.get('stderr_tty', False))
+        with self.command_lock:
+            self.commands += 1
+            started = time.time()
+            cwd = os.getcwd()
+            environ = dict(os.environ)
+            try:
+                os.chdir(request.get('cwd') or cwd)
+                for k in list(os.environ):
+                    if k.startswith('AWS_'):
+                        del os.environ[k]
+                os.environ.update(request.get('env') or {})
+                with redirect_stdout(out), redirect_stderr(err):
+                    code = invoke(self.cli, request['argv'])
+            except OSError as e:
+                err.write(str(e) + '\n')
+                code = 1
+            finally:
+                os.environ.clear()
+                os.environ.update(environ)
+                os.chdir(cwd)
+                self.state.release()
+            self.logger.info('deoncli %s: exit %d in %.2fs'
+                             % (' '.join(request['argv']), code, time.time() - started))
+            return code
+
+    def status(self):
+        status = OrderedDict([('pid', os.getpid()), ('socket', self.path),
+                              ('uptime', round(time.time() - self.started, 1)),
+                              ('commands', self.commands),
+                              ('busy', self.command_lock.locked())])
+        status.update(self.state.status())
+        return status
+
+
+"""Client"""
+
+
+def connect(path = None):
+    """Socket connected to a daemon, None if none is listening."""
+    path = socket_path(path)
+    if not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+
+def control(message, path = None):
+    """
+    Send 'status' or 'stop' to a daemon.
+
+    Returns:
+        (dict): its reply, None if no daemon is listening.
+    """
+    sock = connect(path)
+    if sock is None:
+        return None
+    with sock:
+        sock.sendall((json.dumps({'control': message}) + '\n').encode())
+        line = sock.makefile('rb').readline()
+    return json.loads(line.decode()) if line else None
+
+
+def delegable(argv):
+    if not argv or any(a in LOCAL_OPTIONS for a in argv):
+        return False
+    return not any(tuple(argv[:len(c)]) == c for c in LOCAL_COMMANDS)
+
+
+def delegate(argv, path = None):
+    """
+    Run a deoncli command line in the daemon if one is listening.
+
+    Returns:
+        (int): exit code of the command, None if it has to run locally.
+    """
+    if os.environ.get('DEON_NO_DAEMON') or not delegable(argv):
+        return None
+    sock = connect(path)
+    if sock is None:
+        return None
+    request = OrderedDict([('argv', list(argv)), ('cwd', os.getcwd()),
+                           ('env', dict((k, v) for k, v in os.environ.items()
+                                        if k.startswith('AWS_'))),
+                           ('stdout_tty', sys.stdout.isatty()),
+                           ('stderr_tty', sys.stderr.isatty())])
+    with sock:
+        sock.sendall((json.dumps(request) + '\n').encode())
+        for line in sock.makefile('rb'):
+            message = json.loads(line.decode())
+            if 'out' in message:
+                sys.stdout.write(message['out'])
+                sys.stdout.flush()
+            elif 'err' in message:
+                sys.stderr.write(message['err'])
+                sys.stderr.flush()
+            elif 'exit' in message:
+                return message['exit']
+    sys.stderr.write('deoncli daemon closed the connection\n')
+    return 1
+
+
+"""Server"""
+
+
+def serve(cli, path = None, listing_ttl = LISTING_TTL, idle_timeout = 0, log = logging.INFO):
+    """
+    Run a daemon until it's stopped.
+
+    Args:
+        cli (click.Group): deoncli.
+        path (str): socket path, default ~/.deon/daemon.sock or
+                    $DEON_DAEMON_SOCKET.
+        listing_ttl (float): seconds a listing is reused.
+        idle_timeout (float): seconds without commands after which the
+                              daemon exits, 0 to run until stopped.
+
+    Raises:
+        RuntimeError: a daemon is already listening on path.
+    """
+    global _warm
+
+    path = socket_path(path)
+    sock = connect(path)
+    if sock is not None:
+        sock.close()
+        raise RuntimeError('a daemon is already listening on ' + path)
+    if os.path.exists(path):
+        ## left behind by a daemon that was killed
+        os.remove(path)
+    os.makedirs(os.path.dirname(path), mode = 0o700, exist_ok = True)
+
+    ## daemon messages go to its own stderr, command output to the client
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter('%(asctime)s %(name)s %(levelname)s %(message)s'))
+    logger = logging.getLogger('DaemonServer')
+    logger.addHandler(handler)
+    logger.setLevel(log)
+    logger.propagate = False
+    logging.basicConfig(level = log, stream = CurrentStderr())
+
+    ## imported once here instead of by every command
+    import boto3
+    import deon.s3sync
+
+    _warm = WarmState(listing_ttl)
+    server = DaemonServer(path, _warm, cli, idle_timeout = idle_timeout)
+    logger.info('listening on ' + path + ', pid %d' % os.getpid())
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(path):
+            os.remove(path)
+        _warm = None
@@ -0,0 +1,194 @@
+"""
+Prefetching reader for training on a filtered list of files.
+
+Instead of waiting for sync_files_s3 to download a whole selection before the
+first file is read, a Dataset yields the files of the selection one by one,
+in order or shuffled by a seed, while worker threads fetch the next ones in
+the background:
+
+    from deon.dataset import Dataset
+
+    dataset = Dataset(filtered_df.index, fields = ['images', 'actions'],
+                      shuffle = True, seed = 0)
+    for path, arrays in dataset:
+        train(arrays['images'], arrays['actions'])
+
+Files are fetched like sync_files_s3 does, local files that are up to date
+are not downloaded again.  The fetched but not yet consumed files are
+bounded by prefetch_bytes of listed object size, a file larger than the
+budget is fetched alone.  Without fields, the items are read-only h5py
+handles that are closed when the next item is requested; with fields, the
+items are the selected datasets read into numpy arrays by the workers, so
+reading overlaps compute too.
+"""
+
+import os
+import random
+import logging
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import h5py
+
+from deon.s3sync import SmartS3Sync, S3SyncUtility
+
+PREFETCH_BYTES = 2 * 1024 ** 3
+WORKERS = 4
+
+
+def common_prefix(files):
+    """
+    <bucket>/<prefix>/ shared by all local paths of files, the s3 prefix
+    to list for them.
+    """
+    prefix = os.path.commonprefix(sorted(files))
+    return prefix[:prefix.rfind('/') + 1]
+
+
+class Dataset():
+
+    def __init__(self, files, fields = None, shuffle = False, seed = None,
+                 prefetch_bytes = PREFETCH_BYTES, workers = WORKERS, force = False,
+                 **kwargs):
+        """
+        Args:
+            files (list): local paths <bucket>/<key>, e.g. the index of a
+                          filtered metadata DataFrame.
+            fields (list): hdf5 datasets to read, None to yield h5py handles.
+            shuffle (boolean): yield the files in a random order.
+            seed (int): seed of the shuffle, the order of each epoch is
+                        reproducible with the same seed.
+            prefetch_bytes (int): bytes fetched ahead of the consumer.
+            workers (int): fetch threads.
+            force (boolean): download files even if they are up to date.
+            kwargs: SmartS3Sync options, e.g. profile, objectstore.
+        """
+        self.files = list(files)
+        self.fields = list(fields) if fields else None
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.prefetch_bytes = prefetch_bytes
+        self.workers = workers
+        self.force = force
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.sync = SmartS3Sync(local = [], s3path = common_prefix(self.files), **kwargs)
+        self.bucket = self.sync.bucket
+        ## local file -> s3 key, as in DirectoryWalk.toS3Keys
+        self.keys = OrderedDict((f, "/".join(Path(f).parts[1:])) for f in self.files)
+        self.listing = self.sync.queryS3(self.sync.s3path[len(self.bucket) + 1:]) or OrderedDict()
+        self.check_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.files)
+
+    def set_epoch(self, epoch):
+        """Shuffle with another order, seeded by seed and epoch."""
+        self.epoch = epoch
+
+    def order(self):
+        """Local paths in the order of the next iteration."""
+        files = list(self.files)
+        if self.shuffle:
+            seed = None if self.seed is None else self.seed * 1000003 + self.epoch
+            random.Random(seed).shuffle(files)
+        return files
+
+    def size(self, local):
+        """Listed size of a file, counted against prefetch_bytes."""
+        remote = self.listing.get(self.keys[local])
+        if remote is not None:
+            return int(remote.get('Size', 0))
+        return os.path.getsize(local) if os.path.isfile(local) else 0
+
+    def up_to_date(self, key, local, remote):
+        """
+        Compare a local file with its object like sync_files_fromS3.  The
+        file is hashed outside of check_lock, which guards the shared caches,
+        so workers hash files concurrently.
+        """
+        listing = OrderedDict([(key, remote)])
+        keys = OrderedDict()
+        if os.path.isfile(local) and not self.force:
+            keys[key] = S3SyncUtility().dzip_meta(local)
+            with self.check_lock:
+                rest = self.sync.cached_etags(keys, remote = listing)
+            for k, v in rest.items():
+                with self.sync.phase('hash'):
+                    self.sync.stats.add('hash', files = 1, nbytes = int(v.get('size') or 0))
+                    v['ETag'] = self.sync.local_etag(v['local'])
+            if rest and self.sync.fingerprint is None:
+                with self.check_lock:
+                    self.sync.update_localcache(rest)
+        with self.check_lock:
+            self.sync.resolve_plain_etags(listing, keys, fromS3 = True)
+            if not keys:
+                return False
+            if self.sync.compare_etag(keys, listing, fromS3 = True):
+                return False
+            self.sync.learn_quick_stats(keys, listing)
+            return True
+
+    def fetch(self, local):
+        """
+        Download a file if it isn't up to date, and read the selected fields.
+
+        Returns:
+            (OrderedDict): field arrays, None without fields.
+        """
+        key = self.keys[local]
+        remote = self.listing.get(key)
+        if remote is None:
+            if not os.path.isfile(local):
+                raise FileNotFoundError(key + ' is neither in s3 nor local')
+            self.logger.warning(key + ' is not in s3, reading the local file')
+        elif not self.up_to_date(key, local, remote):
+            os.makedirs(os.path.dirname(local) or '.', exist_ok = True)
+            self.sync.download_object(key, local, remote = remote)
+        if self.fields is None:
+            return None
+        with h5py.File(local, 'r') as hf:
+            return OrderedDict((name, hf[name][()]) for name in self.fields)
+
+    def __iter__(self):
+        """
+        Yields:
+            (tuple): (local path, h5py handle or OrderedDict of arrays)
+        """
+        files = self.order()
+        self.epoch += 1
+        pool = ThreadPoolExecutor(max_workers = self.workers,
+                                  thread_name_prefix = 'deon-prefetch')
+        pending = deque()
+        budget = {'used': 0, 'next': 0}
+
+        def fill():
+            ## always fetch the next file, even if it is larger than the budget
+            while budget['next'] < len(files):
+                local = files[budget['next']]
+                nbytes = self.size(local)
+                if pending and budget['used'] + nbytes > self.prefetch_bytes:
+                    break
+                pending.append((local, nbytes, pool.submit(self.fetch, local)))
+                budget['used'] += nbytes
+                budget['next'] += 1
+
+        try:
+            fill()
+            while pending:
+                local, nbytes, future = pending.popleft()
+                arrays = future.result()
+                if self.fields is None:
+                    with h5py.File(local, 'r') as hf:
+                        yield local, hf
+                else:
+                    yield local, arrays
+                budget['used'] -= nbytes
+                fill()
+            self.sync.save_quick_stats()
+        finally:
+            for local, nbytes, future in pending:
+                future.cancel()
+            pool.shutdown(wait = True)
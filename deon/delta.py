@@ -0,0 +1,197 @@
+"""
+Chunk-level delta sync.
+
+Large files are split into content-defined chunks: chunk boundaries are
+placed where a rolling hash of the last WINDOW bytes has its top bits set to
+zero, so inserting or appending data only changes the chunks around the
+edit.  Chunks are stored once per bucket under CHUNK_PREFIX, named by their
+sha256, and the object at the file's key is a JSON manifest listing the
+chunks of the file.  Uploads skip chunks that are already stored, downloads
+reuse the chunks of the local copy of the file and only fetch the rest.
+
+Manifests are recorded in the object metadata like compressed objects
+(see deon.compression), with 'codec' set to DELTA_CODEC and 'plain-etag' set
+to the md5sum of the file, so ETags compare against plain local files.
+
+Chunks are never garbage-collected, chunks that no manifest lists anymore
+stay in the bucket.
+"""
+
+import json
+import hashlib
+
+import numpy as np
+
+DELTA_CODEC = 'delta'
+CHUNK_PREFIX = '.deon-chunks/'
+MANIFEST_VERSION = 1
+
+## files smaller than this are uploaded whole
+MIN_DELTA_SIZE = 16 * 1024 * 1024
+
+MIN_CHUNK = 256 * 1024
+## boundary probability per byte is 2**-AVG_BITS, chunks average
+## MIN_CHUNK + 2**AVG_BITS bytes
+AVG_BITS = 20
+MAX_CHUNK = 4 * 1024 * 1024
+
+WINDOW = 64
+BLOCK = 1024 * 1024
+
+_MASK = (1 << 64) - 1
+## odd multiplier, invertible modulo 2**64
+_P = 0x9E3779B97F4A7C15
+
+
+def _inverse(p):
+    """Inverse of an odd number modulo 2**64 (Newton's iteration)."""
+    x = p
+    for _ in range(6):
+        x = (x * (2 - p * x)) & _MASK
+    return x
+
+
+## random byte values so runs of zeros still hash well
+_TABLE = np.random.RandomState(0x6465).randint(0, 2 ** 63, 256, dtype = np.int64).astype(np.uint64) * np.uint64(2) + np.uint64(1)
+
+
+def _powers(base, n):
+    powers = np.full(n, base, dtype = np.uint64)
+    powers[0] = 1
+    return np.cumprod(powers, dtype = np.uint64)
+
+
+class _Powers():
+    """P**i and P**-i for one block, cached between blocks."""
+
+    def __init__(self):
+        self.n = 0
+
+    def get(self, n):
+        if n > self.n:
+            self.n = n
+            self.up = _powers(np.uint64(_P), n)
+            self.down = _powers(np.uint64(_inverse(_P)), n)
+        return self.up[:n], self.down[:n]
+
+
+def rolling_hash(data, powers = None):
+    """
+    Polynomial hash of the WINDOW bytes ending at every position of data,
+    h[i] = sum(T[data[k]] * P**(i - k), k = i - WINDOW + 1 .. i) mod 2**64,
+    computed with prefix sums instead of a loop over bytes.
+
+    Args:
+        data (np.ndarray): uint8 bytes.
+
+    Returns:
+        (np.ndarray): uint64 hashes, only positions >= WINDOW - 1 cover a
+                      full window.
+    """
+    powers = powers or _Powers()
+    up, down = powers.get(len(data))
+    with np.errstate(over = 'ignore'):
+        prefix = np.cumsum(_TABLE[data] * down, dtype = np.uint64)
+        window = prefix.copy()
+        window[WINDOW:] -= prefix[:-WINDOW]
+        return window * up
+
+
+def candidates(data):
+    """
+    End offsets of all positions whose rolling hash has its top AVG_BITS
+    bits set to zero.
+
+    Args:
+        data (np.ndarray): uint8 bytes, e.g. a np.memmap of a file.
+
+    Returns:
+        (np.ndarray): sorted int64 offsets.
+    """
+    powers = _Powers()
+    shift = np.uint64(64 - AVG_BITS)
+    found = []
+    for start in range(0, len(data), BLOCK):
+        ## overlap blocks so every window is complete
+        lo = max(0, start - WINDOW + 1)
+        h = rolling_hash(data[lo:start + BLOCK], powers)
+        idx = np.flatnonzero((h >> shift) == 0)
+        idx = idx[idx + lo >= max(start, WINDOW - 1)]
+        found.append(idx + lo + 1)
+    if not found:
+        return np.zeros(0, dtype = np.int64)
+    return np.concatenate(found).astype(np.int64)
+
+
+def boundaries(data):
+    """
+    Returns:
+        (list): chunk end offsets, the last one is len(data).
+    """
+    n = len(data)
+    cand = candidates(data)
+    ends = []
+    last = 0
+    while n - last > MIN_CHUNK:
+        j = np.searchsorted(cand, last + MIN_CHUNK)
+        if j < len(cand) and cand[j] <= last + MAX_CHUNK:
+            end = int(cand[j])
+        else:
+            end = last + MAX_CHUNK
+        if end >= n:
+            break
+        ends.append(end)
+        last = end
+    if n:
+        ends.append(n)
+    return ends
+
+
+def file_chunks(path):
+    """
+    Split a file into content-defined chunks.
+
+    Args:
+        path (str): local file path.
+
+    Returns:
+        (list): [(sha256, offset, size), ...]
+    """
+    with open(path, 'rb') as f:
+        f.seek(0, 2)
+        if f.tell() == 0:
+            return []
+    data = np.memmap(path, dtype = np.uint8, mode = 'r')
+    chunks = []
+    offset = 0
+    for end in boundaries(data):
+        chunks.append((hashlib.sha256(data[offset:end]).hexdigest(), offset, end - offset))
+        offset = end
+    del data
+    return chunks
+
+
+def chunk_key(sha):
+    return CHUNK_PREFIX + sha
+
+
+def make_manifest(chunks, size, etag):
+    """
+    Args:
+        chunks (list): file_chunks of the file.
+        size (int): file size.
+        etag (str): md5sum of the file.
+
+    Returns:
+        (bytes): manifest object body.
+    """
+    return json.dumps({'version': MANIFEST_VERSION, 'size': size, 'etag': etag,
+                       'chunks': [[sha, n] for sha, offset, n in chunks]},
+                      separators = (',', ':')).encode()
+
+
+def load_manifest(body):
+    manifest = json.loads(body.decode())
+    if manifest.get('version') != MANIFEST_VERSION:
+        raise ValueError('unsupported delta manifest version: ' + str(manifest.get('version')))
+    return manifest
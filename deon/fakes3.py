@@ -0,0 +1,361 @@
+"""
+Offline stand-in for the boto3 s3 client, used by the benchmarks.
+
+FakeS3Client implements the subset of the boto3 s3 client that SmartS3Sync
+uses.  Object bodies are kept as files under a local directory, everything
+else in memory.  Latency, bandwidth limits and throttling can be injected,
+and every request is counted per API so benchmarks can assert request
+budgets.  Like a boto3 client it emits the botocore before-call, needs-retry
+and after-call events, so deon.stats can be attached to it.
+
+e.g.
+    s3cl = FakeS3Client('/tmp/fakes3', latency = 0.02, bandwidth = 50e6)
+    s3_sync = SmartS3Sync(local = 'mybucket/docs', s3path = 'mybucket/docs/',
+                          s3client = s3cl)
+    s3_sync.sync()
+    print(s3cl.request_counts())
+"""
+
+import os
+import io
+import time
+import random
+import hashlib
+import datetime
+import threading
+from collections import Counter, OrderedDict
+
+from types import SimpleNamespace
+
+from botocore.hooks import HierarchicalEmitter
+
+from deon.backends import DEFAULT_PART_SIZE, client_error, multipart_etag, part_sizes
+
+## api name -> request class reported by request_counts()
+REQUEST_CLASSES = {
+    'ListObjectsV2': 'LIST',
+    'ListBuckets': 'LIST',
+    'HeadObject': 'HEAD',
+    'GetObject': 'GET',
+    'PutObject': 'PUT',
+    'CreateMultipartUpload': 'PUT',
+    'UploadPart': 'PUT',
+    'CompleteMultipartUpload': 'PUT',
+    'CopyObject': 'PUT',
+    'UploadPartCopy': 'PUT',
+    'DeleteObject': 'DELETE',
+}
+
+MAX_ATTEMPTS = 5
+
+
+class FakePaginator():
+
+    def __init__(self, client, page_size = 1000):
+        self.client = client
+        self.page_size = page_size
+
+    def paginate(self, Bucket = None, Prefix = '', StartAfter = ''):
+        token = None
+        while True:
+            page = self.client.list_objects_v2(Bucket = Bucket, Prefix = Prefix,
+                                               StartAfter = StartAfter,
+                                               ContinuationToken = token,
+                                               MaxKeys = self.page_size)
+            yield page
+            if not page['IsTruncated']:
+                return
+            token = page['NextContinuationToken']
+
+
+class FakeS3Client():
+
+    def __init__(self, root, latency = 0.0, bandwidth = None,
+                 throttle_rate = 0.0, seed = 0):
+        """
+        Args:
+            root (str): directory in which object bodies are stored.
+            latency (float): seconds added to every request.
+            bandwidth (float): bytes per second per request, None for no limit.
+            throttle_rate (float): probability that a request is answered with
+                                   SlowDown, throttled requests are retried
+                                   like botocore does.
+            seed (int): seed for the throttling decisions.
+        """
+        self.root = root
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.throttle_rate = throttle_rate
+        self.random = random.Random(seed)
+        self.objects = {}
+        self.requests = Counter()
+        self.throttled = Counter()
+        self.throttles = 0
+        self.retries = 0
+        self.lock = threading.Lock()
+        self.meta = SimpleNamespace(events = HierarchicalEmitter())
+        os.makedirs(root, exist_ok = True)
+
+    """Accounting"""
+
+    def request_counts(self, throttled = True):
+        """
+        Args:
+            throttled (boolean): include requests answered with SlowDown.
+
+        Returns:
+            (dict): request counts per class, {'LIST':1, 'HEAD':0, ...}
+        """
+        counts = OrderedDict((c, 0) for c in ('LIST', 'HEAD', 'GET', 'PUT', 'DELETE'))
+        with self.lock:
+            for api, n in self.requests.items():
+                if not throttled:
+                    n -= self.throttled[api]
+                counts[REQUEST_CLASSES[api]] += n
+        return counts
+
+    def reset_counts(self):
+        with self.lock:
+            self.requests.clear()
+            self.throttled.clear()
+            self.throttles = 0
+            self.retries = 0
+
+    def _request(self, api, nbytes = 0, parsed = None):
+        """
+        Account for and delay a single request, retrying throttles.
+
+        Args:
+            parsed (dict): response passed to after-call handlers, like
+                           botocore's parsed response.
+        """
+        events = self.meta.events
+        model = SimpleNamespace(name = api)
+        events.emit('before-call.s3.' + api, model = model, params = {}, context = {})
+        for attempt in range(MAX_ATTEMPTS):
+            with self.lock:
+                self.requests[api] += 1
+                throttled = self.random.random() < self.throttle_rate
+                if throttled:
+                    self.throttled[api] += 1
+                    self.throttles += 1
+                    if attempt + 1 < MAX_ATTEMPTS:
+                        self.retries += 1
+            delay = self.latency
+            if not throttled and self.bandwidth and nbytes:
+                delay += nbytes / float(self.bandwidth)
+            if delay:
+                time.sleep(delay)
+            if not throttled:
+                events.emit('after-call.s3.' + api, http_response = None, model = model,
+                            context = {},
+                            parsed = dict(parsed or {},
+                                          ResponseMetadata = {'RetryAttempts': attempt}))
+                return
+            error = {'Error': {'Code': 'SlowDown'}}
+            events.emit('needs-retry.s3.' + api, response = (None, error),
+                        endpoint = None, operation = model, attempts = attempt + 1,
+                        caught_exception = None, request_dict = {})
+            ## botocore style exponential backoff, scaled down
+            time.sleep(min(0.001 * 2 ** attempt, 0.05))
+        raise client_error('SlowDown', 'Please reduce your request rate.', api)
+
+    """Storage"""
+
+    def _body_path(self, bucket, key):
+        digest = hashlib.sha1((bucket + '/' + key).encode()).hexdigest()
+        return os.path.join(self.root, digest[:2], digest)
+
+    def _store(self, bucket, key, data, etag, metadata, content_type):
+        path = self._body_path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        with self.lock:
+            self.objects.setdefault(bucket, {})[key] = {
+                'ETag': etag,
+                'Size': len(data),
+                'LastModified': datetime.datetime.now(datetime.timezone.utc),
+                'Metadata': dict(metadata or {}),
+                'ContentType': content_type or 'binary/octet-stream',
+            }
+
+    def _get(self, bucket, key, operation):
+        try:
+            return self.objects[bucket][key]
+        except KeyError:
+            raise client_error('404', 'Not Found', operation)
+
+    def _read(self, bucket, key, start = 0, end = None):
+        with open(self._body_path(bucket, key), 'rb') as f:
+            f.seek(start)
+            if end is None:
+                return f.read()
+            return f.read(end - start)
+
+    """Client API"""
+
+    def get_paginator(self, operation_name):
+        assert operation_name == 'list_objects_v2'
+        return FakePaginator(self)
+
+    def list_buckets(self):
+        self._request('ListBuckets')
+        return {'Buckets': [{'Name': b} for b in sorted(self.objects)]}
+
+    def list_objects_v2(self, Bucket = None, Prefix = '', StartAfter = '',
+                        ContinuationToken = None, MaxKeys = 1000):
+        self._request('ListObjectsV2')
+        with self.lock:
+            keys = sorted(k for k in self.objects.get(Bucket, {})
+                          if k.startswith(Prefix))
+            start = max(StartAfter or '', ContinuationToken or '')
+            keys = [k for k in keys if k > start]
+            page_keys = keys[:MaxKeys]
+            contents = [{'Key': k,
+                         'ETag': self.objects[Bucket][k]['ETag'],
+                         'Size': self.objects[Bucket][k]['Size'],
+                         'LastModified': self.objects[Bucket][k]['LastModified'],
+                         'StorageClass': 'STANDARD'} for k in page_keys]
+        page = {'Name': Bucket, 'Prefix': Prefix, 'KeyCount': len(contents),
+                'MaxKeys': MaxKeys, 'IsTruncated': len(keys) > MaxKeys}
+        ## like s3, an empty result has no 'Contents'
+        if contents:
+            page['Contents'] = contents
+        if page['IsTruncated']:
+            page['NextContinuationToken'] = page_keys[-1]
+        return page
+
+    def head_object(self, Bucket = None, Key = None):
+        obj = self.objects.get(Bucket, {}).get(Key)
+        response = None
+        if obj is not None:
+            response = {'ETag': obj['ETag'], 'ContentLength': obj['Size'],
+                        'LastModified': obj['LastModified'],
+                        'Metadata': dict(obj['Metadata']),
+                        'ContentType': obj['ContentType']}
+        self._request('HeadObject', parsed = response)
+        if response is None:
+            raise client_error('404', 'Not Found', 'HeadObject')
+        return response
+
+    def get_object(self, Bucket = None, Key = None, Range = None, IfMatch = None):
+        obj = self._get(Bucket, Key, 'GetObject')
+        if IfMatch and IfMatch != obj['ETag']:
+            self._request('GetObject')
+            raise client_error('412', 'Precondition Failed', 'GetObject')
+        start, end = 0, obj['Size']
+        if Range:
+            first, last = Range.split('=', 1)[1].split('-')
+            start = int(first)
+            end = min(int(last) + 1, obj['Size']) if last else obj['Size']
+        self._request('GetObject', end - start)
+        data = self._read(Bucket, Key, start, end)
+        return {'Body': io.BytesIO(data), 'ETag': obj['ETag'],
+                'ContentLength': len(data),
+                'LastModified': obj['LastModified'],
+                'Metadata': dict(obj['Metadata']),
+                'ContentType': obj['ContentType']}
+
+    def put_object(self, Bucket = None, Key = None, Body = b'', Metadata = None,
+                   ContentType = None):
+        if hasattr(Body, 'read'):
+            Body = Body.read()
+        if isinstance(Body, str):
+            Body = Body.encode()
+        self._request('PutObject', len(Body))
+        etag = '"' + hashlib.md5(Body).hexdigest() + '"'
+        self._store(Bucket, Key, Body, etag, Metadata, ContentType)
+        return {'ETag': etag}
+
+    def delete_object(self, Bucket = None, Key = None):
+        self._request('DeleteObject')
+        with self.lock:
+            self.objects.get(Bucket, {}).pop(Key, None)
+        return {}
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, ExtraArgs = None,
+                       Callback = None, Config = None):
+        extra = ExtraArgs or {}
+        data = Fileobj.read()
+        if len(data) < getattr(Config, 'multipart_threshold', DEFAULT_PART_SIZE):
+            self.put_object(Bucket = Bucket, Key = Key, Body = data,
+                            Metadata = extra.get('Metadata'),
+                            ContentType = extra.get('ContentType'))
+            if Callback:
+                Callback(len(data))
+            return
+
+        self._request('CreateMultipartUpload')
+        md5s = []
+        offset = 0
+        for size in part_sizes(len(data), Config):
+            self._request('UploadPart', size)
+            md5s.append(hashlib.md5(data[offset:offset + size]).hexdigest())
+            offset += size
+            if Callback:
+                Callback(size)
+        self._request('CompleteMultipartUpload')
+        self._store(Bucket, Key, data, multipart_etag(md5s),
+                    extra.get('Metadata'), extra.get('ContentType'))
+
+    def download_fileobj(self, Bucket, Key, Fileobj, ExtraArgs = None,
+                         Callback = None, Config = None):
+        head = self.head_object(Bucket = Bucket, Key = Key)
+        size = head['ContentLength']
+        sizes = part_sizes(size, Config)
+        if size < getattr(Config, 'multipart_threshold', DEFAULT_PART_SIZE):
+            body = self.get_object(Bucket = Bucket, Key = Key)['Body'].read()
+            Fileobj.write(body)
+            if Callback:
+                Callback(len(body))
+            return
+        offset = 0
+        for part in sizes:
+            byte_range = 'bytes=%d-%d' % (offset, offset + part - 1)
+            body = self.get_object(Bucket = Bucket, Key = Key,
+                                   Range = byte_range)['Body'].read()
+            Fileobj.write(body)
+            offset += part
+            if Callback:
+                Callback(len(body))
+
+    def copy_object(self, Bucket = None, Key = None, CopySource = None,
+                    Metadata = None, MetadataDirective = 'COPY',
+                    ContentType = None):
+        src = self._get(CopySource['Bucket'], CopySource['Key'], 'CopyObject')
+        self._request('CopyObject')
+        data = self._read(CopySource['Bucket'], CopySource['Key'])
+        if MetadataDirective != 'REPLACE':
+            Metadata = src['Metadata']
+            ContentType = src['ContentType']
+        ## like s3, a copy is stored as a single part object
+        etag = '"' + hashlib.md5(data).hexdigest() + '"'
+        self._store(Bucket, Key, data, etag, Metadata, ContentType)
+        return {'CopyObjectResult': {'ETag': etag}}
+
+    def copy(self, CopySource, Bucket, Key, ExtraArgs = None, Callback = None,
+             Config = None):
+        extra = ExtraArgs or {}
+        head = self.head_object(Bucket = CopySource['Bucket'],
+                                Key = CopySource['Key'])
+        sizes = part_sizes(head['ContentLength'], Config)
+        if head['ContentLength'] < getattr(Config, 'multipart_threshold', DEFAULT_PART_SIZE):
+            self.copy_object(Bucket = Bucket, Key = Key, CopySource = CopySource,
+                             Metadata = extra.get('Metadata'),
+                             MetadataDirective = extra.get('MetadataDirective', 'COPY'),
+                             ContentType = extra.get('ContentType'))
+            return
+
+        data = self._read(CopySource['Bucket'], CopySource['Key'])
+        self._request('CreateMultipartUpload')
+        md5s = []
+        offset = 0
+        for size in sizes:
+            self._request('UploadPartCopy')
+            md5s.append(hashlib.md5(data[offset:offset + size]).hexdigest())
+            offset += size
+        self._request('CompleteMultipartUpload')
+        metadata = extra.get('Metadata', head['Metadata'])
+        self._store(Bucket, Key, data, multipart_etag(md5s), metadata,
+                    extra.get('ContentType', head['ContentType']))
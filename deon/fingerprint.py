@@ -0,0 +1,96 @@
+"""
+Fast content fingerprints of files, instead of md5sums.
+
+md5 hashes a few hundred MB/s per core, xxh3 and crc32 several GB/s.  With
+"fingerprint" set for a bucket, uploads store the fingerprint of each file in
+the object metadata ('fingerprint', e.g. 'xxh3:<hex>'), and syncs compare
+and verify files by fingerprint instead of md5sum.  Objects uploaded without
+a fingerprint are still compared by ETag.
+
+xxh3 needs the xxhash package (pip install xxhash), crc32 only needs the
+standard library.
+"""
+
+import zlib
+
+CHUNK_SIZE = 8 * 1024 * 1024
+
+
+class Crc32():
+
+    name = 'crc32'
+
+    def new(self):
+        return Crc32State()
+
+
+class Crc32State():
+
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+    def hexdigest(self):
+        return '%08x' % (self.value & 0xffffffff)
+
+
+class Xxh3():
+
+    name = 'xxh3'
+
+    def __init__(self):
+        try:
+            import xxhash
+        except ImportError:
+            raise ImportError('xxh3 fingerprints need the xxhash package, '
+                              'pip install xxhash')
+        self.xxhash = xxhash
+
+    def new(self):
+        return self.xxhash.xxh3_128()
+
+
+ALGORITHMS = {
+    'crc32': Crc32,
+    'xxh3': Xxh3,
+}
+
+
+def get_algorithm(name):
+    """
+    Args:
+        name (str): fingerprint algorithm, one of ALGORITHMS.
+    """
+    try:
+        return ALGORITHMS[name]()
+    except KeyError:
+        raise ValueError('unknown fingerprint algorithm: ' + str(name) + ', available: '
+                         + ', '.join(sorted(ALGORITHMS)))
+
+
+def is_fingerprint(etag):
+    """True if etag is a fingerprint, not an md5sum ETag."""
+    return bool(etag) and etag.replace('"', '').split(':', 1)[0] in ALGORITHMS
+
+
+def file_fingerprint(fname, algorithm):
+    """
+    Args:
+        fname (str): file path.
+        algorithm: get_algorithm result.
+
+    Returns:
+        (str): '<algorithm>:<hex digest>'
+    """
+    h = algorithm.new()
+    buf = bytearray(CHUNK_SIZE)
+    view = memoryview(buf)
+    with open(fname, 'rb', buffering = 0) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            h.update(view[:n])
+    return algorithm.name + ':' + h.hexdigest()
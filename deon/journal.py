@@ -0,0 +1,138 @@
+"""
+Crash-safe journal of a directory sync.
+
+Before the transfers of a sync start, the planned work set (the keys that
+need an upload or download with their ETags and metadata) is written to a
+journal file in the local cache directory.  Every finished transfer appends
+a line to it.  If the sync dies, `--resume` reads the plan back and only
+transfers the unfinished keys, without hashing, listing or diffing
+again, and the whole plan is verified against the ETags recorded in it.  The
+journal is removed once a sync is verified.
+
+The journal is a JSON lines file: a plan line written atomically,
+
+    {"plan": 1, "direction": "up", "s3path": ..., "local": ..., "created": ...,
+     "extra": {...}, "items": {key: {...}}}
+
+then one {"done": key} line per transfer, or {"redo": key} for keys that
+failed verification.  A torn last line of a crashed process is ignored.
+"""
+
+import os
+import json
+import time
+import hashlib
+import threading
+import logging
+from collections import OrderedDict
+
+## seconds between fsyncs of done records, each record is flushed to the os
+## at once, so a crashed process loses none
+FSYNC_INTERVAL = 1.0
+
+
+def journal_name(direction, s3path, local, shard = None):
+    key = '\n'.join([direction, s3path, str(local), str(shard)])
+    return 'journal_' + direction + '_' + hashlib.sha1(key.encode()).hexdigest()[:16] + '.jsonl'
+
+
+class SyncJournal():
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str): journal file.
+        """
+        self.path = path
+        self.file = None
+        self.lock = threading.Lock()
+        self.synced = time.time()
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def start(self, direction, s3path, local, items, extra = None):
+        """
+        Write the plan of a sync, replacing an older journal.
+
+        Args:
+            items (OrderedDict): keys to transfer with their ETag and metadata.
+            extra (dict): other state needed to finish the sync.
+        """
+        plan = OrderedDict([('plan', 1), ('direction', direction), ('s3path', s3path),
+                            ('local', local), ('created', time.time()),
+                            ('extra', extra or {}), ('items', items)])
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok = True)
+        tmp = self.path + '.tmp.' + str(os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(json.dumps(plan, default = str) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self.file = open(self.path, 'a')
+        self.logger.info('journal of ' + str(len(items)) + ' keys: ' + self.path)
+
+    def load(self):
+        """
+        Read the plan and progress of an interrupted sync, and continue its
+        journal.
+
+        Returns:
+            (dict): the plan, None if the journal is missing or unreadable.
+            (OrderedDict): planned items that aren't done.
+        """
+        try:
+            with open(self.path) as f:
+                content = f.read()
+            lines = content.split('\n')
+            plan = json.loads(lines[0], object_pairs_hook = OrderedDict)
+        except (OSError, ValueError, IndexError):
+            return None, None
+        done = set()
+        for line in lines[1:]:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                ## torn write of a crashed process
+                continue
+            if 'done' in record:
+                done.add(record['done'])
+            elif 'redo' in record:
+                done.discard(record['redo'])
+        pending = OrderedDict((k, v) for k, v in plan['items'].items() if k not in done)
+        self.file = open(self.path, 'a')
+        if not content.endswith('\n'):
+            ## records after a torn line start on a line of their own
+            self.file.write('\n')
+        return plan, pending
+
+    def write(self, record):
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.write(json.dumps(record) + '\n')
+            self.file.flush()
+            if time.time() - self.synced > FSYNC_INTERVAL:
+                os.fsync(self.file.fileno())
+                self.synced = time.time()
+
+    def done(self, key):
+        self.write({'done': key})
+
+    def redo(self, keys):
+        for k in keys:
+            self.write({'redo': k})
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.file.close()
+                self.file = None
+
+    def remove(self):
+        self.close()
+        if self.exists():
+            os.remove(self.path)
@@ -0,0 +1,342 @@
+"""
+Lazy checkout of a deon repo path through a bounded disk cache.
+
+`deoncli down` materialises a whole prefix.  A LazyRepo instead resolves the
+local paths of a repo (<bucket>/<key>) on demand: the first open of a file
+downloads it into the cache directory, later opens read the cached copy.
+When the cache grows beyond max_bytes the least recently used objects are
+evicted, except objects under a pinned prefix, so the working set of a job
+stays on disk.
+
+    from deon.lazy import LazyRepo
+
+    repo = LazyRepo('rail-robot-data-sharing-v1/mini-robonet/', max_bytes = 200e9)
+    with repo.h5('rail-robot-data-sharing-v1/mini-robonet/traj0.hdf5') as hf:
+        ...
+
+The cache keeps an index of its objects with their ETag, size and recency in
+<cache_dir>/index.json, and the pinned prefixes in <cache_dir>/pins.json, so a
+restarted job reuses the cached objects.  Cached objects whose ETag differs
+from the listing are downloaded again.  The index is saved every SAVE_EVERY
+fills and on close, files that are missing from it, e.g. after a crash, are
+indexed with an unknown ETag when the cache is loaded, so they count against
+max_bytes and are evicted or downloaded again.  Share a LazyRepo between the threads
+of a process, one cache directory should not be used by several processes
+at once.
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+from deon.s3sync import SmartS3Sync
+
+CACHE_DIR = os.path.join('~', '.deon', 'lazy')
+INDEX_NAME = 'index.json'
+PINS_NAME = 'pins.json'
+TMP_DIR = '.tmp'
+## fills between saves of the index
+SAVE_EVERY = 64
+
+
+def write_json_atomic(path, contents):
+    tmp = path + '.tmp.' + str(os.getpid()) + '.' + str(threading.get_ident())
+    with open(tmp, 'w') as f:
+        json.dump(contents, f)
+    os.replace(tmp, path)
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except (OSError, ValueError):
+        return True
+    return True
+
+
+class LazyCache():
+
+    def __init__(self, cache_dir = CACHE_DIR, max_bytes = None):
+        """
+        Args:
+            cache_dir (str): directory of the cached objects and the index.
+            max_bytes (int): cache size, least recently used unpinned objects
+                             are evicted beyond it, None for unlimited.
+        """
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.max_bytes = int(max_bytes) if max_bytes else None
+        self.lock = threading.Lock()
+        self.fills = {}
+        self.unsaved = 0
+        self.logger = logging.getLogger(self.__class__.__name__)
+        os.makedirs(os.path.join(self.cache_dir, TMP_DIR), exist_ok = True)
+        self.clean_tmp()
+        self.index = self.load_index()
+        if self.max_bytes and self.total() > self.max_bytes and self.evict():
+            self.save_index()
+
+    def path(self, name):
+        """Cache path of <bucket>/<key>."""
+        return os.path.join(self.cache_dir, name)
+
+    def tmp_path(self, name):
+        return os.path.join(self.cache_dir, TMP_DIR, '%d.%d.%s' % (
+            os.getpid(), threading.get_ident(), name.replace('/', '_')))
+
+    def clean_tmp(self):
+        """Remove partial downloads of processes that are gone."""
+        tmp_dir = os.path.join(self.cache_dir, TMP_DIR)
+        for name in os.listdir(tmp_dir):
+            try:
+                pid = int(name.split('.', 1)[0])
+            except ValueError:
+                continue
+            if not pid_alive(pid):
+                os.remove(os.path.join(tmp_dir, name))
+
+    def load_index(self):
+        """
+        Returns:
+            (OrderedDict): {'<bucket>/<key>': {'ETag', 'size', 'used'}}, least
+                           recently used first, without entries whose file
+                           is missing or incomplete, with an empty ETag for
+                           files that aren't indexed.
+        """
+        try:
+            with open(os.path.join(self.cache_dir, INDEX_NAME)) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            entries = {}
+        for name, st in self.cached_files():
+            entry = entries.get(name)
+            if entry is None or entry['size'] != st.st_size:
+                entries[name] = {'ETag': '', 'size': st.st_size, 'used': st.st_mtime}
+        index = OrderedDict()
+        for name, entry in sorted(entries.items(), key = lambda x: x[1]['used']):
+            try:
+                if os.path.getsize(self.path(name)) == entry['size']:
+                    index[name] = entry
+            except OSError:
+                pass
+        return index
+
+    def cached_files(self):
+        """Yields (<bucket>/<key>, stat) of the files in the cache directory."""
+        for root, dirs, files in os.walk(self.cache_dir):
+            if root == self.cache_dir:
+                dirs[:] = [d for d in dirs if d != TMP_DIR]
+                files = [f for f in files if not f.startswith((INDEX_NAME, PINS_NAME))]
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield os.path.relpath(path, self.cache_dir).replace(os.sep, '/'), st
+
+    def save_index(self):
+        with self.lock:
+            entries = OrderedDict((k, dict(v)) for k, v in self.index.items())
+            self.unsaved = 0
+        write_json_atomic(os.path.join(self.cache_dir, INDEX_NAME), entries)
+
+    def pins(self):
+        """Pinned prefixes, re-read so pins of `deoncli lazy pin` apply."""
+        try:
+            with open(os.path.join(self.cache_dir, PINS_NAME)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return []
+
+    def pin(self, prefix):
+        """Never evict objects under prefix (<bucket>/<key prefix>)."""
+        pins = self.pins()
+        if prefix not in pins:
+            write_json_atomic(os.path.join(self.cache_dir, PINS_NAME), sorted(pins + [prefix]))
+
+    def unpin(self, prefix):
+        pins = self.pins()
+        if prefix in pins:
+            pins.remove(prefix)
+            write_json_atomic(os.path.join(self.cache_dir, PINS_NAME), pins)
+
+    def pinned(self, name, pins):
+        return any(name.startswith(p) for p in pins)
+
+    def total(self):
+        with self.lock:
+            return sum(v['size'] for v in self.index.values())
+
+    def lookup(self, name, etag):
+        """
+        Cache path of an object if its cached version has etag, and mark it
+        recently used.  None if it isn't cached or stale.
+        """
+        with self.lock:
+            entry = self.index.get(name)
+            if entry is None or entry['ETag'] != etag:
+                return None
+            entry['used'] = time.time()
+            self.index.move_to_end(name)
+        return self.path(name)
+
+    def fill_lock(self, name):
+        with self.lock:
+            return self.fills.setdefault(name, threading.Lock())
+
+    def add(self, name, tmp, etag):
+        """Move a downloaded file into the cache, then evict to max_bytes."""
+        size = os.path.getsize(tmp)
+        with self.lock:
+            ## a stale version is replaced
+            self.index.pop(name, None)
+        if self.max_bytes:
+            self.evict(size)
+        os.makedirs(os.path.dirname(self.path(name)), exist_ok = True)
+        os.replace(tmp, self.path(name))
+        with self.lock:
+            self.index[name] = {'ETag': etag, 'size': size, 'used': time.time()}
+            self.unsaved += 1
+            save = self.unsaved >= SAVE_EVERY
+        if save:
+            self.save_index()
+        return self.path(name)
+
+    def evict(self, need = 0):
+        """
+        Remove least recently used unpinned objects until need more bytes
+        fit into max_bytes.
+
+        Returns:
+            (int): bytes freed.
+        """
+        pins = self.pins()
+        freed = 0
+        with self.lock:
+            total = sum(v['size'] for v in self.index.values())
+            for name in list(self.index):
+                if total + need <= self.max_bytes:
+                    break
+                if self.pinned(name, pins):
+                    continue
+                entry = self.index.pop(name)
+                try:
+                    os.remove(self.path(name))
+                except OSError:
+                    pass
+                total -= entry['size']
+                freed += entry['size']
+                self.logger.debug('evicted ' + name)
+        if total + need > self.max_bytes:
+            self.logger.warning('lazy cache is over its size, %d bytes are pinned'
+                                % total)
+        return freed
+
+    def status(self):
+        """
+        Returns:
+            (OrderedDict): objects, bytes, max_bytes, pinned objects and bytes.
+        """
+        pins = self.pins()
+        with self.lock:
+            pinned = [v['size'] for k, v in self.index.items() if self.pinned(k, pins)]
+            return OrderedDict([('objects', len(self.index)),
+                                ('bytes', sum(v['size'] for v in self.index.values())),
+                                ('max_bytes', self.max_bytes),
+                                ('pins', pins),
+                                ('pinned_objects', len(pinned)),
+                                ('pinned_bytes', sum(pinned))])
+
+
+class LazyRepo():
+
+    def __init__(self, s3path, cache_dir = CACHE_DIR, max_bytes = None, **kwargs):
+        """
+        Args:
+            s3path (str): repo path <bucket>/<prefix>/ of the files.
+            cache_dir (str): directory of the cached objects.
+            max_bytes (int): cache size, None for unlimited.
+            kwargs: SmartS3Sync options, e.g. profile, objectstore.
+        """
+        self.sync = SmartS3Sync(local = [], s3path = s3path, **kwargs)
+        self.bucket = self.sync.bucket
+        self.cache = LazyCache(cache_dir, max_bytes)
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.listing = self.sync.queryS3(s3path[len(self.bucket) + 1:]) or OrderedDict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Save the recency of cache hits."""
+        self.cache.save_index()
+
+    def key(self, local):
+        if Path(local).parts[0] != self.bucket:
+            raise ValueError(local + ' is not in bucket ' + self.bucket)
+        return "/".join(Path(local).parts[1:])
+
+    def path(self, local):
+        """
+        Cache path of a repo file, downloaded on first use.
+
+        Args:
+            local (str): repo path <bucket>/<key>.
+        """
+        key = self.key(local)
+        remote = self.listing.get(key)
+        if remote is None:
+            raise FileNotFoundError(local + ' is not in s3')
+        name = self.bucket + '/' + key
+        etag = remote.get('StoredETag', remote['ETag']).replace('"', '')
+        path = self.cache.lookup(name, etag)
+        if path is not None:
+            return path
+        with self.cache.fill_lock(name):
+            path = self.cache.lookup(name, etag)
+            if path is not None:
+                return path
+            self.sync.resolve_plain_etags(OrderedDict([(key, remote)]), OrderedDict(),
+                                          fromS3 = True)
+            tmp = self.cache.tmp_path(name)
+            try:
+                self.sync.download_object(key, tmp, remote = remote)
+                return self.cache.add(name, tmp, etag)
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+
+    def open(self, local, mode = 'rb'):
+        return open(self.path(local), mode)
+
+    def h5(self, local):
+        """Read-only h5py.File of a repo file."""
+        import h5py
+        return h5py.File(self.path(local), 'r')
+
+    def keys(self, prefix = ''):
+        """Repo paths of the listed objects under <bucket>/<prefix>."""
+        return [self.bucket + '/' + k for k in self.listing
+                if k.startswith(prefix) and not k.endswith('/')]
+
+    def pin(self, prefix, fetch = False):
+        """
+        Protect the objects under a repo path prefix from eviction.
+
+        Args:
+            prefix (str): <bucket>/<key prefix>.
+            fetch (boolean): also download them now.
+        """
+        self.cache.pin(prefix)
+        if fetch:
+            for local in self.keys(prefix[len(self.bucket) + 1:]):
+                self.path(local)
@@ -0,0 +1,154 @@
+"""
+Content-addressed local object store.
+
+Objects downloaded from S3 are kept once under <root>/objects, keyed by their
+S3 ETag and size, so the same object showing up under several buckets or
+prefixes is only downloaded and stored once. A downloaded file is added as a
+reflink or a copy, so the store object has an inode of its own and the
+downloaded file is left as it is. Checkouts into a deon repo are reflinks when
+the filesystem supports them, hardlinks otherwise, and plain copies as a last
+resort (e.g. the store is on another device).
+
+Store objects are read-only, and hardlinked checkouts share their inode with
+the store and with every other checkout of the object, in any bucket. Treat
+checked out files as immutable: never modify one in place (e.g. as root, or
+after chmod u+w), write a new file instead.
+"""
+
+import os
+import stat
+import shutil
+import logging
+import uuid
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+## linux ioctl to clone a file (reflink), see ioctl_ficlone(2)
+FICLONE = 0x40049409
+
+
+def reflink(src, dst):
+    """
+    Create dst as a copy-on-write clone of src.
+
+    Raises:
+        OSError: the platform or filesystem does not support reflinks.
+    """
+    if fcntl is None:
+        raise OSError('reflink not supported on this platform')
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        except OSError:
+            d.close()
+            os.remove(dst)
+            raise
+
+
+def clone_or_copy(src, dst):
+    """
+    Copy src to dst as a file of its own, a reflink if possible.
+
+    Returns:
+        (str): 'reflink' or 'copy'
+    """
+    try:
+        reflink(src, dst)
+        return 'reflink'
+    except OSError:
+        shutil.copyfile(src, dst)
+        return 'copy'
+
+
+def link_or_copy(src, dst):
+    """
+    Materialise src at dst using the cheapest available method.
+
+    Returns:
+        (str): 'reflink', 'hardlink' or 'copy'
+    """
+    try:
+        reflink(src, dst)
+        return 'reflink'
+    except OSError:
+        pass
+    try:
+        os.link(src, dst)
+        return 'hardlink'
+    except OSError:
+        shutil.copyfile(src, dst)
+        return 'copy'
+
+
+class ObjectStore():
+
+    def __init__(self, root):
+        self.root = os.path.expanduser(root)
+        self.logger = logging.getLogger(self.__class__.__name__)
+        os.makedirs(os.path.join(self.root, 'objects'), exist_ok = True)
+        os.makedirs(os.path.join(self.root, 'tmp'), exist_ok = True)
+
+    def object_path(self, etag, size):
+        """
+        Path of the store object for an s3 ETag and object size.
+
+        Args:
+            etag (str): s3 ETag, quoted or not.
+            size (int): object size in bytes.
+        """
+        etag = etag.replace('"', '')
+        return os.path.join(self.root, 'objects', etag[:2],
+                            etag + '_' + str(size))
+
+    def contains(self, etag, size):
+        return os.path.isfile(self.object_path(etag, size))
+
+    def checkout(self, etag, size, dest):
+        """
+        Materialise a store object at dest.
+
+        Args:
+            etag (str): s3 ETag of the object.
+            size (int): object size in bytes.
+            dest (str): local file path, replaced if it exists.
+
+        Returns:
+            (str): method used ('reflink', 'hardlink' or 'copy'), or None if
+                   the object is not in the store.
+        """
+        src = self.object_path(etag, size)
+        if not os.path.isfile(src):
+            return None
+        if os.path.lexists(dest):
+            os.remove(dest)
+        method = link_or_copy(src, dest)
+        self.logger.debug('checkout (' + method + '): ' + src + ' to ' + dest)
+        return method
+
+    def add(self, path, etag, size):
+        """
+        Add a local file to the store, unless an object with the same ETag
+        and size is already stored.
+
+        Args:
+            path (str): local file path.
+            etag (str): s3 ETag of the file contents.
+            size (int): file size in bytes.
+        """
+        dest = self.object_path(etag, size)
+        if os.path.isfile(dest):
+            return
+        os.makedirs(os.path.dirname(dest), exist_ok = True)
+
+        ## stage in tmp and rename so a crash never leaves a partial object,
+        ## path is never linked, it stays the user's file
+        tmp = os.path.join(self.root, 'tmp', str(uuid.uuid4()))
+        method = clone_or_copy(path, tmp)
+        ## checkouts may hardlink the object, protect it against in place edits
+        mode = os.stat(tmp).st_mode
+        os.chmod(tmp, mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+        os.replace(tmp, dest)
+        self.logger.debug('stored (' + method + '): ' + path + ' as ' + dest)
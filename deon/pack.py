@@ -0,0 +1,263 @@
+"""
+Pack filtered trajectories into memory-mappable training shards.
+
+Reading thousands of small hdf5 files every epoch is slow and hammers the
+file system with metadata requests.  A pack holds the selected datasets of a
+filtered list of files in a few large .npy shards, the rows of each file
+contiguous in its shard, with an index of the row offsets and the metadata
+table of the packed files:
+
+    <out_dir>/index.json            fields, shards and the offsets of each file
+    <out_dir>/metadata.jsonl        metadata of each file, in index order
+    <out_dir>/shard-00000.<field>.npy
+
+    from deon.pack import Pack
+
+    pack = Pack('packs/sawyer')
+    pack.update(filtered_df, fields = ['images', 'actions'])
+    for i in range(len(pack)):
+        arrays = pack[i]  # np.memmap slices, nothing is copied
+
+Files are fetched like load_dataset does, only if they aren't up to date.
+Updating a pack again is incremental: files already packed with the same
+ETag are kept, new files are added in new shards, and files that changed or
+no longer match are dropped from the index.  Shards without any indexed
+rows are removed, rows of dropped files in other shards stay until the pack
+is rebuilt.  Shards are never modified once written, and the index is
+replaced atomically, so a pack can be read while it's updated.
+"""
+
+import os
+import json
+import logging
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+from deon.dataset import Dataset
+
+SHARD_BYTES = 1024 ** 3
+INDEX_NAME = 'index.json'
+METADATA_NAME = 'metadata.jsonl'
+METADATA_DIR = 'metadata'
+
+
+def metadata_table(local_dir, root = METADATA_DIR):
+    """
+    Metadata synced by `deoncli metadata down` as a DataFrame indexed by the
+    local path <bucket>/<key> of each file.
+
+    Args:
+        local_dir (str): <bucket>/<prefix> of the files.
+        root (str): metadata directory.
+    """
+    import pandas as pd
+
+    paths = sorted(Path(root, local_dir).glob('**/*.json'))
+    metadatas = []
+    for metadata_path in paths:
+        with metadata_path.open("r") as metadata_file:
+            metadatas.append(json.load(metadata_file))
+    filenames = [str(path.relative_to(root))[:-5] for path in paths]
+    return pd.DataFrame(metadatas, index = filenames)
+
+
+def write_atomic(path, write):
+    tmp = path + '.tmp.' + str(os.getpid())
+    with open(tmp, 'w') as f:
+        write(f)
+    os.replace(tmp, path)
+
+
+class Pack():
+
+    def __init__(self, out_dir):
+        """
+        Args:
+            out_dir (str): directory of the pack, created by update.
+        """
+        self.out_dir = os.path.expanduser(out_dir)
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.index = self.load_index()
+        self.arrays = {}
+
+    def load_index(self):
+        """
+        Returns:
+            (OrderedDict): {'fields': {name: {'dtype', 'shape'}}, 'shards':
+                           [ids], 'items': [{'path', 'ETag', 'shard',
+                           'offsets': {name: [start, stop]}}]}
+        """
+        try:
+            with open(os.path.join(self.out_dir, INDEX_NAME)) as f:
+                return json.load(f, object_pairs_hook = OrderedDict)
+        except (OSError, ValueError):
+            return OrderedDict([('fields', OrderedDict()), ('shards', []), ('items', [])])
+
+    def shard_path(self, shard, field):
+        return os.path.join(self.out_dir, 'shard-%05d.%s.npy' % (shard, field))
+
+    """Reading"""
+
+    def __len__(self):
+        return len(self.index['items'])
+
+    def paths(self):
+        """Local paths of the packed files, in index order."""
+        return [item['path'] for item in self.index['items']]
+
+    def array(self, shard, field):
+        """Memory map of a field of a shard."""
+        key = (shard, field)
+        if key not in self.arrays:
+            self.arrays[key] = np.load(self.shard_path(shard, field), mmap_mode = 'r')
+        return self.arrays[key]
+
+    def __getitem__(self, i):
+        """
+        Returns:
+            (OrderedDict): rows of each field of the i-th file, slices of
+                           read-only memory maps.
+        """
+        item = self.index['items'][i]
+        return OrderedDict((field, self.array(item['shard'], field)[start:stop])
+                           for field, (start, stop) in item['offsets'].items())
+
+    def metadata(self):
+        """Metadata table of the packed files, indexed by local path."""
+        import pandas as pd
+
+        path = os.path.join(self.out_dir, METADATA_NAME)
+        if not len(self) or not os.path.isfile(path):
+            return pd.DataFrame()
+        return pd.read_json(path, orient = 'records', lines = True).set_index('path')
+
+    """Writing"""
+
+    def check(self, path, field, array):
+        """Rows of array must match the dtype and shape packed so far."""
+        spec = self.index['fields'].get(field)
+        shape = list(array.shape[1:])
+        if array.dtype.hasobject:
+            raise ValueError(path + ': ' + field + ' has dtype ' + str(array.dtype)
+                             + ', which can not be memory mapped')
+        if spec is None:
+            self.index['fields'][field] = OrderedDict([('dtype', array.dtype.str),
+                                                        ('shape', shape)])
+        elif spec['dtype'] != array.dtype.str or spec['shape'] != shape:
+            raise ValueError(path + ': ' + field + ' has rows of ' + array.dtype.str
+                             + ' ' + str(shape) + ', the pack has ' + spec['dtype'] + ' '
+                             + str(spec['shape']))
+
+    def write_shard(self, shard, batch):
+        """
+        Write the rows of a batch of files as a new shard.
+
+        Args:
+            batch (list): (path, ETag, OrderedDict of arrays) of each file.
+
+        Returns:
+            (list): index items of the files.
+        """
+        items = [OrderedDict([('path', path), ('ETag', etag), ('shard', shard),
+                              ('offsets', OrderedDict())]) for path, etag, arrays in batch]
+        for field, spec in self.index['fields'].items():
+            rows = sum(len(arrays[field]) for path, etag, arrays in batch)
+            dest = self.shard_path(shard, field)
+            tmp = dest + '.tmp.' + str(os.getpid()) + '.npy'
+            out = np.lib.format.open_memmap(tmp, mode = 'w+', dtype = np.dtype(spec['dtype']),
+                                            shape = tuple([rows] + spec['shape']))
+            start = 0
+            for item, (path, etag, arrays) in zip(items, batch):
+                stop = start + len(arrays[field])
+                out[start:stop] = arrays[field]
+                item['offsets'][field] = [start, stop]
+                start = stop
+            out.flush()
+            del out
+            os.replace(tmp, dest)
+        self.logger.info('wrote shard %d of %d files' % (shard, len(batch)))
+        return items
+
+    def save(self, table):
+        """Replace the index and the metadata table, then remove unused shards."""
+        os.makedirs(self.out_dir, exist_ok = True)
+        paths = self.paths()
+        metadata = table.loc[paths].copy() if len(paths) else table.iloc[:0].copy()
+        metadata.insert(0, 'path', paths)
+        write_atomic(os.path.join(self.out_dir, METADATA_NAME),
+                     lambda f: metadata.to_json(f, orient = 'records', lines = True))
+        unused = [s for s in self.index['shards']
+                  if s not in set(item['shard'] for item in self.index['items'])]
+        self.index['shards'] = [s for s in self.index['shards'] if s not in unused]
+        write_atomic(os.path.join(self.out_dir, INDEX_NAME),
+                     lambda f: json.dump(self.index, f))
+        for name in os.listdir(self.out_dir):
+            if any(name.startswith('shard-%05d.' % s) for s in unused):
+                os.remove(os.path.join(self.out_dir, name))
+        self.arrays = {}
+
+    def update(self, table, fields, shard_bytes = SHARD_BYTES, rebuild = False, **kwargs):
+        """
+        Pack the files of a metadata table, incrementally.
+
+        Args:
+            table (DataFrame): metadata of the files to pack, indexed by local
+                               path <bucket>/<key>, e.g. a filtered
+                               metadata_table.  Its 'ETag' column tells
+                               which packed files changed.
+            fields (list): hdf5 datasets to pack, their first axis are rows.
+            shard_bytes (int): bytes of the rows of a shard, a shard holds at
+                               least one file.
+            rebuild (boolean): pack all files again into new shards.
+            kwargs: Dataset options, e.g. workers, profile.
+
+        Returns:
+            (OrderedDict): counts of 'kept', 'packed' and 'dropped' files and
+                           the number of 'shards'.
+        """
+        fields = list(fields)
+        etags = OrderedDict((path, str(table['ETag'][path]) if 'ETag' in table else None)
+                            for path in table.index)
+        if self.index['items'] and list(self.index['fields']) != fields and not rebuild:
+            raise ValueError('the pack has fields ' + ', '.join(self.index['fields'])
+                             + ', rebuild it to pack ' + ', '.join(fields))
+        old = self.index['items']
+        if rebuild:
+            self.index['fields'] = OrderedDict()
+            old = []
+        kept = [item for item in old
+                if item['path'] in etags and item['ETag'] == etags[item['path']]]
+        packed = set(item['path'] for item in kept)
+        todo = [path for path in etags if path not in packed]
+        self.logger.info('pack: %d files up to date, %d to pack, %d dropped'
+                         % (len(kept), len(todo), len(old) - len(kept)))
+
+        items = list(kept)
+        shard = max(self.index['shards']) + 1 if self.index['shards'] else 0
+        batch = []
+        nbytes = 0
+        if todo:
+            os.makedirs(self.out_dir, exist_ok = True)
+            for path, arrays in Dataset(todo, fields = fields, **kwargs):
+                for field in fields:
+                    if arrays[field].ndim == 0:
+                        arrays[field] = arrays[field].reshape(1)
+                    self.check(path, field, arrays[field])
+                batch.append((path, etags[path], arrays))
+                nbytes += sum(a.nbytes for a in arrays.values())
+                if nbytes >= shard_bytes:
+                    items += self.write_shard(shard, batch)
+                    self.index['shards'].append(shard)
+                    shard += 1
+                    batch = []
+                    nbytes = 0
+            if batch:
+                items += self.write_shard(shard, batch)
+                self.index['shards'].append(shard)
+        self.index['items'] = items
+        self.save(table)
+        return OrderedDict([('kept', len(kept)), ('packed', len(todo)),
+                            ('dropped', len(old) - len(kept)),
+                            ('shards', len(self.index['shards']))])
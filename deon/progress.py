@@ -0,0 +1,203 @@
+"""
+Aggregated progress of the transfers of a sync.
+
+One ProgressReporter covers all concurrent transfers of a sync (or of all
+syncs of `--all`).  Workers report transferred bytes from the boto3 transfer
+callbacks without taking a lock, every thread adds to a counter of its own
+and the reporter sums the counters.  Files are counted when their transfer
+task starts and finishes.  A background thread renders one status line at a
+fixed rate,
+
+    120/300 files  1.2 GB/3.4 GB  85.3 MB/s  ETA 0:00:26  8 active
+
+redrawn in place on a terminal, or written to the log every LOG_INTERVAL
+seconds when stderr is not a terminal, e.g. in batch jobs.
+"""
+
+import sys
+import time
+import logging
+import threading
+
+BAR_INTERVAL = 0.5
+LOG_INTERVAL = 30.0
+## seconds of transferred bytes the throughput is averaged over
+RATE_WINDOW = 10.0
+MODES = ('auto', 'bar', 'log', 'off')
+
+
+def format_bytes(nbytes):
+    for unit in ('B', 'KB', 'MB', 'GB', 'TB'):
+        if abs(nbytes) < 1000 or unit == 'TB':
+            break
+        nbytes /= 1000.0
+    return ('%d %s' if unit == 'B' else '%.1f %s') % (nbytes, unit)
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def get_progress(mode = 'auto', stream = None):
+    """ProgressReporter of a --progress mode, NullProgress for 'off'."""
+    if mode == 'off':
+        return NullProgress()
+    return ProgressReporter(mode = mode, stream = stream)
+
+
+class NullProgress():
+
+    enabled = False
+
+    def start(self):
+        pass
+
+    def plan(self, files, nbytes):
+        pass
+
+    def update(self, nbytes):
+        pass
+
+    def begin(self, key):
+        pass
+
+    def finish(self, key, nbytes = 0):
+        pass
+
+    def close(self):
+        pass
+
+
+class ProgressReporter():
+
+    enabled = True
+
+    def __init__(self, mode = 'auto', interval = None, stream = None):
+        """
+        Args:
+            mode (str): 'bar' redraws a status line, 'log' logs it, 'auto'
+                        picks 'bar' if stream is a terminal.
+            interval (float): seconds between renders, default BAR_INTERVAL
+                              or LOG_INTERVAL.
+            stream: output of 'bar', default stderr.
+        """
+        self.stream = stream or sys.stderr
+        if mode == 'auto':
+            mode = 'bar' if hasattr(self.stream, 'isatty') and self.stream.isatty() else 'log'
+        self.mode = mode
+        self.interval = interval or (BAR_INTERVAL if mode == 'bar' else LOG_INTERVAL)
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        ## (thread, [bytes]) counters, only written by their thread
+        self.counters = []
+        ## bytes of counters of finished threads
+        self.folded = 0
+        self.planned_files = 0
+        self.planned_bytes = 0
+        self.files = 0
+        self.finished_bytes = 0
+        self.active = {}
+        self.samples = []
+        self.started = None
+        self.width = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """Start rendering, once per reporter."""
+        if self.thread is not None:
+            return
+        self.started = time.time()
+        self.thread = threading.Thread(target = self.run, name = 'deon-progress', daemon = True)
+        self.thread.start()
+
+    def plan(self, files, nbytes):
+        """Add files and bytes to the planned totals."""
+        with self.lock:
+            self.planned_files += files
+            self.planned_bytes += nbytes
+
+    def update(self, nbytes):
+        """boto3 transfer callback, lock free."""
+        try:
+            counter = self.local.counter
+        except AttributeError:
+            counter = self.local.counter = [0]
+            with self.lock:
+                self.counters.append((threading.current_thread(), counter))
+        counter[0] += nbytes
+
+    def begin(self, key):
+        with self.lock:
+            self.active[key] = time.time()
+
+    def finish(self, key, nbytes = 0):
+        """
+        Args:
+            nbytes (int): planned bytes of the file.
+        """
+        with self.lock:
+            self.active.pop(key, None)
+            self.files += 1
+            self.finished_bytes += nbytes
+
+    def transferred(self):
+        """Bytes reported by the transfer callbacks so far."""
+        with self.lock:
+            live = []
+            for thread, counter in self.counters:
+                if thread.is_alive():
+                    live.append((thread, counter))
+                else:
+                    self.folded += counter[0]
+            self.counters = live
+            return self.folded + sum(counter[0] for thread, counter in live)
+
+    def rate(self, now, transferred):
+        self.samples.append((now, transferred))
+        while len(self.samples) > 2 and now - self.samples[0][0] > RATE_WINDOW:
+            self.samples.pop(0)
+        t0, b0 = self.samples[0]
+        return (transferred - b0) / (now - t0) if now > t0 else 0.0
+
+    def line(self):
+        now = time.time()
+        rate = self.rate(now, self.transferred())
+        with self.lock:
+            files, finished, active = self.files, self.finished_bytes, len(self.active)
+            planned_files, planned_bytes = self.planned_files, self.planned_bytes
+        parts = ['%d/%d files' % (files, planned_files) if planned_files else '%d files' % files,
+                 format_bytes(finished) + ('/' + format_bytes(planned_bytes) if planned_bytes else ''),
+                 format_bytes(rate) + '/s']
+        elapsed = now - (self.started or now)
+        if planned_bytes and 0 < finished < planned_bytes:
+            ## average over the sync, files finish in bursts
+            parts.append('ETA ' + format_duration((planned_bytes - finished) * elapsed / finished))
+        parts.append('%d active' % active)
+        return '  '.join(parts)
+
+    def render(self, final = False):
+        line = self.line()
+        if self.mode == 'log':
+            self.logger.info(('done: ' if final else '') + line)
+            return
+        self.stream.write('\r' + line + ' ' * max(0, self.width - len(line)))
+        if final:
+            self.stream.write('\n')
+        self.stream.flush()
+        self.width = len(line)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.render()
+
+    def close(self):
+        """Stop rendering and print the final totals."""
+        if self.thread is None:
+            return
+        self.stopped.set()
+        self.thread.join()
+        self.thread = None
+        self.render(final = True)
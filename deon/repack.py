@@ -0,0 +1,431 @@
+"""
+Repack hdf5 files into a layout that is cheap to read remotely.
+
+hdf5 files written with the defaults have their object headers, b-trees and
+heaps scattered between the raw data, so a reader fetching a file with range
+requests needs a round trip for almost every object it opens.  repack_file
+rewrites a file with
+
+  - paged file space (fs_strategy 'page'): metadata is aggregated into
+    metadata pages and raw data into raw data pages, so opening a file and
+    walking its objects touches a few pages,
+  - the latest format's compact object headers,
+  - contiguous layout for uncompressed fixed-size datasets, so any slice
+    along the first axis is one byte range, and chunks of about CHUNK_BYTES
+    along the first axis for compressed ones,
+
+keeping every attribute, including the 'metadata' attribute deon publishes as
+metajson, hard links, and the compression filters of each dataset, which are
+compared with the original's after the rewrite.  Files with references, in
+datasets or in attributes like the DIMENSION_LIST of dimension scales, are not
+repacked.
+
+estimate_requests counts the range requests a remote reader fetching
+aligned blocks of block_size bytes (and caching them) needs to open a file
+and walk its attributes, and to read every dataset, so a repack report shows
+what a layout costs over the network:
+
+    deoncli repack <bucket>/<prefix>/traj0.hdf5 --dry_run
+
+`deoncli up --repack` (or "repack": true for a data bucket) uploads repacked
+copies of new and changed hdf5 files, the local files are left as they are.
+"""
+
+import os
+import json
+import logging
+from collections import OrderedDict
+
+import h5py
+import numpy as np
+
+PAGE_SIZE = 256 * 1024
+CHUNK_BYTES = 2 * 1024 * 1024
+## block size of the modelled remote reader
+BLOCK_SIZE = PAGE_SIZE
+## root attribute marking a repacked file and its layout
+MARKER = 'deon_repack'
+EXTENSIONS = ('.hdf5', '.h5')
+
+
+def layout(page_size = PAGE_SIZE, chunk_bytes = CHUNK_BYTES):
+    return json.dumps(OrderedDict([('page_size', page_size), ('chunk_bytes', chunk_bytes)]))
+
+
+def is_repackable(fname):
+    return fname.endswith(EXTENSIONS) and os.path.isfile(fname) and h5py.is_hdf5(fname)
+
+
+def is_repacked(fname, page_size = PAGE_SIZE, chunk_bytes = CHUNK_BYTES):
+    """True if fname was repacked with this layout."""
+    with h5py.File(fname, 'r') as hf:
+        return hf.attrs.get(MARKER) == layout(page_size, chunk_bytes)
+
+
+class BlockCounter():
+    """
+    File object for h5py counting the range requests of a remote reader that
+    fetches aligned blocks and keeps them.
+    """
+
+    def __init__(self, fname, block_size = BLOCK_SIZE):
+        self.f = open(fname, 'rb')
+        self.block_size = block_size
+        self.blocks = set()
+        self.requests = 0
+        self.pos = 0
+
+    def seek(self, offset, whence = os.SEEK_SET):
+        self.pos = self.f.seek(offset, whence)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def readinto(self, buf):
+        first = self.pos // self.block_size
+        last = (self.pos + max(len(buf), 1) - 1) // self.block_size
+        missing = [b for b in range(first, last + 1) if b not in self.blocks]
+        ## one request per run of missing blocks
+        self.requests += sum(1 for i, b in enumerate(missing)
+                             if i == 0 or missing[i - 1] != b - 1)
+        self.blocks.update(missing)
+        self.f.seek(self.pos)
+        n = self.f.readinto(buf)
+        self.pos += n
+        return n
+
+    def read(self, size = -1):
+        if size < 0:
+            size = os.fstat(self.f.fileno()).st_size - self.pos
+        buf = bytearray(size)
+        return bytes(buf[:self.readinto(buf)])
+
+    def close(self):
+        self.f.close()
+
+
+def estimate_requests(fname, block_size = BLOCK_SIZE):
+    """
+    Returns:
+        (OrderedDict): 'open' requests to open the file and read all its
+                       attributes, 'read' requests to also read every
+                       dataset.
+    """
+    counter = BlockCounter(fname, block_size)
+    try:
+        with h5py.File(counter, 'r') as hf:
+            def visit_attrs(name, obj):
+                for k in obj.attrs:
+                    obj.attrs[k]
+            dict(hf.attrs)
+            hf.visititems(visit_attrs)
+            opened = counter.requests
+
+            def visit_data(name, obj):
+                if isinstance(obj, h5py.Dataset) and obj.shape is not None:
+                    obj[()]
+            hf.visititems(visit_data)
+        return OrderedDict([('open', opened), ('read', counter.requests)])
+    finally:
+        counter.close()
+
+
+def chunk_shape(shape, itemsize, chunk_bytes = CHUNK_BYTES):
+    """Chunks of whole rows along the first axis of about chunk_bytes."""
+    row = int(np.prod(shape[1:])) * itemsize if len(shape) > 1 else itemsize
+    rows = max(1, min(shape[0], chunk_bytes // max(row, 1)))
+    return (rows,) + tuple(shape[1:])
+
+
+def copy_attrs(src, dst):
+    for name in src.attrs:
+        dst.attrs.create(name, src.attrs[name], dtype = src.attrs.get_id(name).dtype)
+
+
+def copy_dataset(ds, parent, name, chunk_bytes = CHUNK_BYTES):
+    """Copy a dataset with a remote-read-friendly layout."""
+    special = (ds.shape is None or ds.shape == () or ds.dtype.hasobject
+               or h5py.check_dtype(vlen = ds.dtype) is not None
+               or ds.dtype.names is not None)
+    if special:
+        ## scalars, empty datasets, strings and compound types keep their layout
+        parent.copy(ds, name, without_attrs = True)
+        copy_attrs(ds, parent[name])
+        return
+    compressed = ds.compression is not None or ds.shuffle or ds.fletcher32
+    resizable = ds.maxshape != ds.shape
+    if compressed or resizable:
+        chunks = chunk_shape(ds.shape, ds.dtype.itemsize, chunk_bytes)
+        if 0 in chunks:
+            chunks = None
+    else:
+        chunks = None
+    out = parent.create_dataset(name, shape = ds.shape, dtype = ds.dtype,
+                                chunks = chunks if chunks or compressed or resizable else None,
+                                maxshape = ds.maxshape if resizable else None,
+                                compression = ds.compression,
+                                compression_opts = ds.compression_opts,
+                                shuffle = ds.shuffle, fletcher32 = ds.fletcher32,
+                                fillvalue = ds.fillvalue)
+    copy_attrs(ds, out)
+    ## copy in blocks of rows to bound memory
+    step = chunk_shape(ds.shape, ds.dtype.itemsize, chunk_bytes * 8)[0] if ds.shape[0] else 1
+    for start in range(0, ds.shape[0], step):
+        out[start:start + step] = ds[start:start + step]
+
+
+def copy_group(src, dst, chunk_bytes = CHUNK_BYTES, copied = None):
+    """
+    Args:
+        copied (dict): {object id: path in dst} of the objects copied so far,
+                       further hard links to them are linked, not copied.
+    """
+    if copied is None:
+        copied = {src.id: dst.name}
+    copy_attrs(src, dst)
+    for name in src:
+        link = src.get(name, getlink = True)
+        if isinstance(link, (h5py.SoftLink, h5py.ExternalLink)):
+            dst[name] = link
+            continue
+        obj = src[name]
+        if obj.id in copied:
+            dst[name] = dst.file[copied[obj.id]]
+            continue
+        copied[obj.id] = dst.name.rstrip('/') + '/' + name
+        if isinstance(obj, h5py.Group):
+            copy_group(obj, dst.create_group(name), chunk_bytes, copied)
+        elif isinstance(obj, h5py.Datatype):
+            ## with its attributes
+            dst.copy(obj, name)
+        else:
+            copy_dataset(obj, dst, name, chunk_bytes)
+
+
+def is_reference(dtype):
+    """True for reference types, and vlen, compound or array types of them."""
+    if h5py.check_dtype(ref = dtype) is not None:
+        return True
+    base = h5py.check_dtype(vlen = dtype)
+    if isinstance(base, np.dtype):
+        return is_reference(base)
+    if dtype.names is not None:
+        return any(is_reference(dtype.fields[n][0]) for n in dtype.names)
+    if dtype.subdtype is not None:
+        return is_reference(dtype.subdtype[0])
+    return False
+
+
+def has_references(hf):
+    """
+    Object and region references, in datasets or in attributes (e.g. the
+    DIMENSION_LIST of dimension scales), would point into the old file.
+    """
+    found = []
+
+    def visit(name, obj):
+        if isinstance(obj, h5py.Dataset) and is_reference(obj.dtype):
+            found.append(name)
+        if any(is_reference(obj.attrs.get_id(k).dtype) for k in obj.attrs):
+            found.append(name)
+    visit('/', hf)
+    hf.visititems(visit)
+    return bool(found)
+
+
+def same_value(a, b):
+    a, b = np.asarray(a), np.asarray(b)
+    if a.dtype != b.dtype or a.shape != b.shape:
+        return False
+    if a.dtype.names is not None:
+        return all(same_value(a[n], b[n]) for n in a.dtype.names)
+    if a.dtype.hasobject:
+        return all(same_value(x, y) for x, y in zip(a.ravel(), b.ravel()))
+    ## byte-wise, so NaNs are equal
+    return a.tobytes() == b.tobytes()
+
+
+def describe(hf):
+    """
+    Links, attributes and dataset types of a file, independent of its
+    layout: {path: (link, attributes, type)}, a hard link to an object
+    reached before names the path it was first reached by.
+    """
+    entries = OrderedDict()
+    first = {}
+
+    def attrs(obj):
+        return [(k, obj.attrs.get_id(k).dtype, obj.attrs[k]) for k in sorted(obj.attrs)
+                if not (obj.name == '/' and k == MARKER)]
+
+    def visit(group, path):
+        for name in sorted(group):
+            link = group.get(name, getlink = True)
+            child = path + name
+            if isinstance(link, h5py.SoftLink):
+                entries[child] = (('soft', link.path), None, None)
+                continue
+            if isinstance(link, h5py.ExternalLink):
+                entries[child] = (('external', link.filename, link.path), None, None)
+                continue
+            obj = group[name]
+            if obj.id in first:
+                entries[child] = (('hard', first[obj.id]), None, None)
+                continue
+            first[obj.id] = child
+            if isinstance(obj, h5py.Dataset):
+                kind = ('dataset', obj.dtype, obj.shape, obj.maxshape, obj.compression,
+                        obj.compression_opts, obj.shuffle, obj.fletcher32)
+            elif isinstance(obj, h5py.Datatype):
+                kind = ('datatype', obj.dtype)
+            else:
+                kind = ('group',)
+            entries[child] = (('object',), attrs(obj), kind)
+            if isinstance(obj, h5py.Group):
+                visit(obj, child + '/')
+
+    first[hf.id] = '/'
+    entries['/'] = (('object',), attrs(hf), ('group',))
+    visit(hf, '/')
+    return entries
+
+
+def difference(src, dst):
+    """
+    Returns:
+        (str): the first path whose links, attributes or dataset types
+               differ between two open files, None if there is none.
+    """
+    a, b = describe(src), describe(dst)
+    for path in OrderedDict.fromkeys(list(a) + list(b)):
+        if path not in a or path not in b:
+            return path
+        (link, attrs, kind), (link2, attrs2, kind2) = a[path], b[path]
+        if link != link2 or kind != kind2 or (attrs is None) != (attrs2 is None):
+            return path
+        if attrs is None:
+            continue
+        if [(k, dt) for k, dt, v in attrs] != [(k, dt) for k, dt, v in attrs2]:
+            return path
+        if not all(same_value(v, v2) for (k, dt, v), (k2, dt2, v2) in zip(attrs, attrs2)):
+            return path
+    return None
+
+
+def repack_file(src, dst, page_size = PAGE_SIZE, chunk_bytes = CHUNK_BYTES):
+    """
+    Write a repacked copy of an hdf5 file.
+
+    Args:
+        src (str): hdf5 file.
+        dst (str): repacked file, replaced if it exists.
+        page_size (int): file space page size.
+        chunk_bytes (int): chunk size of compressed datasets.
+
+    Raises:
+        ValueError: the file has references, or the links, attributes or
+                    dataset types of the repacked file differ.
+    """
+    with h5py.File(src, 'r') as hin:
+        if has_references(hin):
+            raise ValueError(src + ' has object references, not repacking it')
+        with h5py.File(dst, 'w', libver = 'latest', fs_strategy = 'page',
+                       fs_persist = True, fs_page_size = page_size) as hout:
+            copy_group(hin, hout, chunk_bytes)
+            hout.attrs[MARKER] = layout(page_size, chunk_bytes)
+        with h5py.File(dst, 'r') as hout:
+            path = difference(hin, hout)
+            if path is not None:
+                raise ValueError(path + ' of ' + src + ' changed in the repacked file')
+
+
+class Repacker():
+
+    def __init__(self, page_size = PAGE_SIZE, chunk_bytes = CHUNK_BYTES,
+                 block_size = BLOCK_SIZE):
+        """
+        Args:
+            page_size (int): file space page size of repacked files.
+            chunk_bytes (int): chunk size of compressed datasets.
+            block_size (int): block size of the modelled remote reader.
+        """
+        self.page_size = page_size
+        self.chunk_bytes = chunk_bytes
+        self.block_size = block_size
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def repack(self, fname, dry_run = False, dst = None):
+        """
+        Repack an hdf5 file in place, or into a copy, unless it's repacked
+        already.  The repacked file is only kept if it improves the range
+        requests, see improves, small files usually fit in a block either
+        way and only grow by the page padding.
+
+        Args:
+            dry_run (boolean): only report, keep the file.
+            dst (str): write the repacked file here and keep fname, dst is
+                       removed unless the report says 'repacked'.
+
+        Returns:
+            (OrderedDict): the file's report, with 'repacked' False if the
+                           original was kept, None if it's not an hdf5 file,
+                           it's repacked already or repacking failed.
+        """
+        if not is_repackable(fname) or is_repacked(fname, self.page_size, self.chunk_bytes):
+            return None
+        tmp = dst or os.path.join(os.path.dirname(fname) or '.',
+                                  '.' + os.path.basename(fname) + '.repack.' + str(os.getpid()))
+        keep = False
+        try:
+            repack_file(fname, tmp, self.page_size, self.chunk_bytes)
+            before = estimate_requests(fname, self.block_size)
+            after = estimate_requests(tmp, self.block_size)
+            report = OrderedDict([('file', fname),
+                                  ('bytes', [os.path.getsize(fname), os.path.getsize(tmp)]),
+                                  ('open_requests', [before['open'], after['open']]),
+                                  ('read_requests', [before['read'], after['read']])])
+            report['repacked'] = improves(report) and not dry_run
+            if report['repacked']:
+                os.chmod(tmp, os.stat(fname).st_mode & 0o7777)
+                if dst is None:
+                    os.replace(tmp, fname)
+                else:
+                    keep = True
+            self.logger.debug('repack ' + json.dumps(report))
+            return report
+        except (ValueError, OSError) as e:
+            self.logger.warning('not repacking ' + fname + ': ' + str(e))
+            return None
+        finally:
+            if not keep and os.path.exists(tmp):
+                os.remove(tmp)
+
+
+def summarize(reports):
+    """
+    Totals of repack reports, [before, after] of each count, after counting
+    the files that were repacked (or would be, with dry_run) as repacked.
+    """
+    total = OrderedDict([('files', len(reports)),
+                         ('repacked', sum(1 for r in reports if improves(r)))])
+    for k in ('bytes', 'open_requests', 'read_requests'):
+        total[k] = [sum(r[k][0] for r in reports),
+                    sum(r[k][1] if improves(r) else r[k][0] for r in reports)]
+    return total
+
+
+def improves(report):
+    """
+    Fewer range requests to open the file, reading all of it may take up to
+    two more for the padding of the last metadata and raw data pages.
+    """
+    return (report['open_requests'][1] < report['open_requests'][0]
+            and report['read_requests'][1] <= report['read_requests'][0] + 2)
+
+
+def format_report(total):
+    parts = ['%d of %d files' % (total['repacked'], total['files'])]
+    for k in ('bytes', 'open_requests', 'read_requests'):
+        parts.append('%s %d -> %d' % (k.replace('_', ' '), total[k][0], total[k][1]))
+    return ', '.join(parts)
@@ -87,12 +87,17 @@ import subprocess
 import sys
 import json
 import boto3
-from botocore.exceptions import ClientError
-from collections import OrderedDict
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config as BotoConfig
+from botocore.exceptions import ClientError, EndpointConnectionError, ConnectionClosedError
+from collections import OrderedDict, deque
 import os
 import hashlib
 from binascii import unhexlify
 import threading
+import functools
+from concurrent import futures
+from concurrent.futures import ThreadPoolExecutor
 import magic
 import datetime
 import time
@@ -100,8 +105,169 @@ import gzip
 import logging
 from logging.handlers import TimedRotatingFileHandler
 import uuid
+import tempfile
 import h5py
 from pathlib import Path
+from contextlib import contextmanager
+from deon.objectstore import ObjectStore
+from deon.stats import SyncStats, NullStats
+from deon.trace import Tracer, NullTracer
+from deon.compression import get_codec, ETagReader, CodecWriter
+from deon import delta as deltasync
+from deon.changefeed import Changefeed, make_record, is_feed_key
+from deon.shard import in_shard, listing_digest, ShardMarkers
+from deon.cacheserve import cache_reachable
+from deon.journal import SyncJournal, journal_name
+from deon.progress import NullProgress, get_progress
+from deon.fingerprint import get_algorithm, is_fingerprint, file_fingerprint
+from deon.repack import Repacker, summarize, format_report
+from deon.daemon import warm_state
+from deon.slim import RangeFile, write_slim, slim_info, is_hdf5_key
+
+## part size used for multipart uploads and copies, md5 must use the same part
+## size to reproduce the resulting ETags
+PART_SIZE = 8 * 1024 * 1024
+## s3 minimum part size, except for the last part
+MIN_PART_SIZE = 5 * 1024 * 1024
+## part sizes tried per object when its ETag has a different part count
+MAX_PART_CANDIDATES = 4
+## threads hashing the parts of one large file, hashlib releases the GIL
+HASH_THREADS = min(8, os.cpu_count() or 1)
+## threads are started on demand, md5(threads = n) limits the parts in flight
+HASH_POOL_SIZE = 32
+
+_hash_pool = None
+_hash_pool_lock = threading.Lock()
+
+## threads are started on demand, an upload keeps at most the
+## max_concurrency of its transfer config chunks in flight
+CHUNK_POOL_SIZE = 32
+
+_chunk_pool = None
+
+
+def hash_pool():
+    """Thread pool shared by all md5 calls, created on first use."""
+    global _hash_pool
+    with _hash_pool_lock:
+        if _hash_pool is None:
+            _hash_pool = ThreadPoolExecutor(max_workers = HASH_POOL_SIZE,
+                                            thread_name_prefix = 'deon-md5')
+        return _hash_pool
+
+
+def chunk_pool():
+    """Thread pool shared by all delta uploads, created on first use."""
+    global _chunk_pool
+    with _hash_pool_lock:
+        if _chunk_pool is None:
+            _chunk_pool = ThreadPoolExecutor(max_workers = CHUNK_POOL_SIZE,
+                                             thread_name_prefix = 'deon-chunk')
+        return _chunk_pool
+
+
+## part buffer of each hashing thread, reused for all parts and files
+_part_buffers = threading.local()
+
+
+def read_part(fname, fd, buf, offset):
+    """Read into buf from offset of fd, returns the bytes read (less at eof)."""
+    view = memoryview(buf)
+    n = 0
+    if not hasattr(os, 'preadv'):
+        ## no positional reads, use a file of its own
+        with open(fname, 'rb', buffering = 0) as f:
+            f.seek(offset)
+            while n < len(buf):
+                r = f.readinto(view[n:])
+                if not r:
+                    break
+                n += r
+        return n
+    while n < len(buf):
+        r = os.preadv(fd, [view[n:]], offset + n)
+        if r == 0:
+            break
+        n += r
+    return n
+
+
+def hash_part(fname, fd, offset, part_size):
+    """md5 of one part, read into the buffer of the calling thread."""
+    buf = getattr(_part_buffers, 'buf', None)
+    if buf is None or len(buf) != part_size:
+        buf = _part_buffers.buf = bytearray(part_size)
+    n = read_part(fname, fd, buf, offset)
+    return hashlib.md5(memoryview(buf)[:n]).hexdigest()
+
+
+def with_fingerprint(remote, meta):
+    """Add the fingerprint of an upload's metadata to the new object."""
+    if meta['Metadata'].get('fingerprint'):
+        remote['Fingerprint'] = meta['Metadata']['fingerprint']
+    return remote
+
+
+def load_json_cache(path):
+    """Contents of a gzipped json cache file, {} if it's missing."""
+    warm = warm_state()
+    if warm is not None:
+        ## deoncli daemon, read again only if the file changed
+        return warm.load_json(path, read_json_cache)
+    return read_json_cache(path)
+
+
+def read_json_cache(path):
+    if os.path.isfile(path):
+        try:
+            with gzip.open(path, 'rt') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            logging.getLogger('SmartS3Sync').warning('ignoring unreadable ' + path)
+    return {}
+
+
+def save_json_cache(path, contents):
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    tmp = path + '.tmp.' + str(os.getpid()) + '.' + str(threading.get_ident())
+    with gzip.open(tmp, 'wt') as f:
+        json.dump(contents, f)
+    os.replace(tmp, path)
+    warm = warm_state()
+    if warm is not None:
+        warm.saved_json(path, contents)
+
+
+def part_size_candidates(size, etag):
+    """
+    Part sizes other than PART_SIZE that give an object of size bytes the
+    part count of its ETag, MiB multiples only.  Powers of two and multiples
+    of 5 MiB (defaults of common tools) are tried first.
+
+    Args:
+        size (int): object size.
+        etag (str): object ETag, '<md5>-<parts>' for multipart uploads.
+
+    Returns:
+        (list): part sizes in bytes, the size itself for single part ETags of
+                files that md5 splits into parts.
+    """
+    if '-' not in etag:
+        return [size] if size > PART_SIZE else []
+    parts = int(etag.rsplit('-', 1)[1])
+    if parts < 1 or size < parts:
+        return []
+    mib = 1024 * 1024
+    ## ceil(size / part_size) == parts
+    lo = max(MIN_PART_SIZE, -(-size // parts)) if parts > 1 else max(size, 1)
+    hi = -(-size // (parts - 1)) if parts > 1 else max(size, 1) + mib
+    candidates = [p for p in range(-(-lo // mib) * mib, hi, mib) if p != PART_SIZE]
+    if parts == 1 and size <= PART_SIZE:
+        ## md5 already uses one part, only the '-1' form differs
+        candidates = [max(size, 1)]
+    candidates.sort(key = lambda p: (not (p & (p - 1)) == 0, p % (5 * mib) != 0, p))
+    return candidates[:MAX_PART_CANDIDATES]
+
 
 def get_metajson(filepath):
     if filepath.endswith("hdf5"):
@@ -128,34 +294,31 @@ class S3SyncUtility():
     ## https://stackoverflow.com/questions/3431825/generating-an-md5-checksum-of-a-file
     ## https://stackoverflow.com/questions/6591047/etag-definition-changed-in-amazon-s3/28877788#28877788
 
-    def md5(self, fname, part_size = 8 * 1024 * 1024):
+    def md5(self, fname, part_size = PART_SIZE, threads = None, multipart = False):
         """
         Calculate the md5sum for a file using the specified part_size.
         If a file is larger than the part size then the md5sum is calculated
         using the same approach used by AWS for multipart uploads to ensure
-        Etags can be compared during sync.
+        Etags can be compared during sync.  The parts of large files are
+        hashed in parallel, each part is read into a reused buffer.
 
         Args:
             fname (str): local file path.
             part_size: file upload part-size bytes.
+            threads (int): threads hashing parts, default HASH_THREADS.
+            multipart (boolean): '<md5>-1' for files of one part, like the
+                                 ETag of a multipart upload of one part.
 
         Returns:
             md5sum
 
         """
         if os.path.isfile(fname):
-            hash_md5 = hashlib.md5()
-            blockcount = 0
-            md5Lst = []
-            with open(fname, "rb") as f:
-                for chunk in iter(lambda: f.read(part_size), b""):
-                    hash_md5 = hashlib.md5()
-                    hash_md5.update(chunk)
-                    md5Lst.append(hash_md5.hexdigest())
-                    blockcount += 1
-
-            if blockcount <= 1:
-                return hash_md5.hexdigest()
+            md5Lst = self.part_md5s(fname, part_size, threads or HASH_THREADS)
+            blockcount = len(md5Lst)
+
+            if blockcount <= 1 and not (multipart and md5Lst):
+                return md5Lst[0] if md5Lst else hashlib.md5().hexdigest()
             else:
                 ## calculate aws multipart upload etag md5 equivalent
                 c = ''.join(md5Lst)
@@ -167,6 +330,37 @@ class S3SyncUtility():
             ## md5sum dev/null
             return "d41d8cd98f00b204e9800998ecf8427e"
 
+    def part_md5s(self, fname, part_size = PART_SIZE, threads = HASH_THREADS):
+        """
+        md5 of each part_size part of a file as hex strings.  The parts of
+        files larger than one part are hashed on the shared hash pool, at most
+        threads parts at a time.
+        """
+        fd = os.open(fname, os.O_RDONLY)
+        pending = deque()
+        try:
+            size = os.fstat(fd).st_size
+            if size <= part_size:
+                buf = bytearray(size)
+                n = read_part(fname, fd, buf, 0)
+                return [hashlib.md5(memoryview(buf)[:n]).hexdigest()] if n else []
+            offsets = range(0, size, part_size)
+            if threads <= 1:
+                return [hash_part(fname, fd, offset, part_size) for offset in offsets]
+            pool = hash_pool()
+            md5Lst = []
+            for offset in offsets:
+                if len(pending) >= threads:
+                    md5Lst.append(pending.popleft().result())
+                pending.append(pool.submit(hash_part, fname, fd, offset, part_size))
+            while pending:
+                md5Lst.append(pending.popleft().result())
+            return md5Lst
+        finally:
+            ## parts still reading from fd after an error
+            futures.wait(pending)
+            os.close(fd)
+
     def dzip_meta(self, key, md5sum = False):
         """
         Create a dictionary of local file or dir path with associated os.stat data.
@@ -265,30 +459,6 @@ class DirectoryWalk():
             self.logger.exception(str(e))
 
 
-class ProgressPercentage(object):
-
-    ## ProgressPercentage is straight from the documentation
-    ## http://boto3.readthedocs.io/en/latest/_modules/boto3/s3/transfer.html
-
-    def __init__(self, filename):
-        self._filename = filename
-        self._size = float(os.path.getsize(filename))
-        self._seen_so_far = 0
-        self._lock = threading.Lock()
-
-    def __call__(self, bytes_amount):
-        # To simplify we'll assume this is hooked up
-        # to a single filename.
-        with self._lock:
-            self._seen_so_far += bytes_amount
-            percentage = (self._seen_so_far / self._size) * 100
-            sys.stderr.write(
-                "\r%s  %s / %s  (%.2f%%)" % (
-                    self._filename, self._seen_so_far, self._size,
-                    percentage))
-            sys.stderr.flush()
-
-
 class SmartS3Sync():
 
     def __init__(self, local = None, s3path = None, metadata = None,
@@ -297,12 +467,43 @@ class SmartS3Sync():
                  localcache = False,
                  localcache_dir = None,
                  localcache_fname = None,
+                 objectstore = None,
+                 compression = None,
+                 delta = False,
+                 changefeed = False,
+                 reconcile = False,
+                 scheduler = None,
+                 shard = None,
+                 cache_endpoint = None,
+                 quick = False,
+                 fingerprint = None,
+                 repack = False,
+                 datasets = None,
+                 resume = False,
+                 progress = None,
+                 progress_mode = 'auto',
+                 collect_stats = False,
+                 s3client = None,
+                 stats_json = None,
+                 stats_prom = None,
+                 trace = None,
+                 trace_memory = False,
+                 trace_cprofile = False,
                  log = logging.INFO, library = logging.CRITICAL):
 
         self.local = local
         self.s3path = s3path
         self.bucket = s3path.split('/', 1)[0]
-        self.walk = DirectoryWalk(local)
+        self.stats = self.init_stats(stats_json, stats_prom, collect = collect_stats)
+        self.last_report = None
+        self.scheduler = scheduler
+        if trace:
+            self.tracer = Tracer(trace, memory = trace_memory, cprofile = trace_cprofile)
+        else:
+            self.tracer = NullTracer()
+        with self.phase('walk'):
+            self.walk = DirectoryWalk(local)
+            self.stats.add('walk', files = len(self.walk.file))
         self.uid = uid
         self.gid = gid
         self.logger = self.init_logger(log, library = library)
@@ -311,10 +512,52 @@ class SmartS3Sync():
         self.keys = self.parse_prefix(s3path, self.bucket, self.metadir)
         self.s3cl = None
         self.s3rc = None
-        self.session = self.init_boto3session(profile)
+        ## pooled client of deoncli daemon, see init_boto3session
+        self.warm_key = None
+        if s3client is not None:
+            ## e.g. deon.fakes3.FakeS3Client for offline benchmarks
+            self.s3cl = s3client
+            self.session = None
+        else:
+            self.session = self.init_boto3session(profile)
+        self.stats.attach(self.s3cl)
+        self.tracer.attach(self.s3cl)
+        self.cache_etags = {}
+        self.read_cl = self.init_cache_client(cache_endpoint)
         self.localcache = localcache
         self.localcache_fname = self.init_localcache_fname(localcache_fname)
         self.localcache_dir = self.init_localcache(localcache_dir, localcache)
+        self.objectstore = ObjectStore(objectstore) if objectstore else None
+        self.codec = get_codec(compression) if compression else None
+        self.delta = delta
+        self.changefeed = changefeed
+        self.reconcile = reconcile
+        self.shard = shard
+        self.codec_etags = None
+        self.codec_etags_changed = False
+        self.part_etags = None
+        self.part_etags_changed = False
+        self.quick = quick
+        self.quick_stats = None
+        self.quick_stats_changed = False
+        self.fingerprint = get_algorithm(fingerprint) if fingerprint else None
+        self.fingerprints = None
+        self.fingerprints_changed = False
+        self.repacker = Repacker() if repack else None
+        ## {key: (repacked copy, ETag of the local file)} uploaded in place
+        ## of the local files
+        self.repacked = OrderedDict()
+        ## download slim hdf5 files with only these datasets, see deon.slim
+        self.datasets = list(datasets) if datasets else None
+        self.resume = resume
+        ## a reporter shared by several syncs, e.g. of --all, else one per sync
+        self.shared_progress = progress
+        self.progress = progress or NullProgress()
+        self.progress_mode = progress_mode
+        self.transfer_config = TransferConfig(multipart_threshold = PART_SIZE,
+                                              multipart_chunksize = PART_SIZE)
+        ## {stored etag: metadata} seen in the HEAD requests of downloads
+        self.head_metadata = {}
 
 
     def init_logger(self, log = logging.DEBUG, library = logging.CRITICAL):
@@ -340,6 +583,83 @@ class SmartS3Sync():
 
         return class_logger
 
+    def init_stats(self, stats_json = None, stats_prom = None, collect = False):
+        """
+        Collect sync metrics only if a report was requested.
+
+        Args:
+            stats_json (str): path of the JSON report, '-' for stdout.
+            stats_prom (str): path of the Prometheus textfile.
+            collect (boolean): collect metrics for self.last_report without
+                               writing a report, e.g. for a summary of
+                               several syncs.
+        """
+        if not stats_json and not stats_prom and not collect:
+            return NullStats()
+        return SyncStats(json_path = stats_json, prom_path = stats_prom,
+                         labels = OrderedDict([('bucket', self.bucket),
+                                               ('prefix', self.s3path[len(self.bucket) + 1:])]))
+
+    def run_tasks(self, tasks):
+        """
+        Run per-file transfer tasks, on the shared workers of self.scheduler
+        if there is one, one after another otherwise.
+
+        Returns:
+            (list): task results in order.
+        """
+        if self.scheduler is None:
+            return [task() for task in tasks]
+        return self.scheduler.map(self.s3path, tasks)
+
+    def throttle(self, nbytes):
+        """Account transferred bytes against the scheduler's bandwidth budget."""
+        if self.scheduler is not None:
+            self.scheduler.throttle(nbytes)
+
+    def transfer_callback(self, local, show_progress = True):
+        """
+        Callback for managed transfers, reports progress and applies the
+        bandwidth budget.  None if there is nothing to do.
+        """
+        callbacks = []
+        if show_progress and self.progress.enabled:
+            callbacks.append(self.progress.update)
+        if self.scheduler is not None and self.scheduler.bucket is not None:
+            callbacks.append(self.scheduler.throttle)
+        if not callbacks:
+            return None
+        if len(callbacks) == 1:
+            return callbacks[0]
+
+        def callback(nbytes):
+            for c in callbacks:
+                c(nbytes)
+        return callback
+
+    @contextmanager
+    def phase(self, name):
+        """Time a sync phase in the stats report and the trace."""
+        with self.stats.phase(name), self.tracer.span(name, 'phase'):
+            yield
+
+    def md5(self, fname):
+        """S3SyncUtility.md5, traced."""
+        with self.tracer.span('md5', 'hash', path = fname):
+            return S3SyncUtility().md5(fname)
+
+    def local_etag(self, fname):
+        """Fingerprint of a local file with a fingerprint algorithm, md5sum otherwise."""
+        if self.fingerprint is None:
+            return self.md5(fname)
+        with self.tracer.span('fingerprint', 'hash', path = fname):
+            return file_fingerprint(fname, self.fingerprint)
+
+    def metajson(self, fname):
+        """get_metajson, traced as a file open."""
+        with self.tracer.span('open', 'file', path = fname, reason = 'metajson'):
+            return get_metajson(fname)
+
     def init_boto3session(self, profile):
         """
         Initialize a boto3 session, s3 client, and s3 resource.
@@ -357,6 +677,12 @@ class SmartS3Sync():
             session (boto3.Session)
         """
         self.logger.debug('intializing boto3 session')
+        warm = warm_state()
+        if warm is not None:
+            ## deoncli daemon, reuse the credentials and connections of
+            ## earlier commands
+            self.warm_key, session, self.s3cl, self.s3rc = warm.boto3_clients(profile, self)
+            return session
         if profile:
             ## use profile names passed in args, looks for .aws config file
             session = boto3.Session(profile_name = profile)
@@ -382,6 +708,56 @@ class SmartS3Sync():
                                  + 'exiting...')
             sys.exit()
 
+    def init_cache_client(self, cache_endpoint):
+        """
+        s3 client for object downloads through a deon cache-serve endpoint on
+        the LAN, see deon.cacheserve.
+
+        Args:
+            cache_endpoint (str): e.g. http://cachehost:8910
+
+        Returns:
+            s3 client, self.s3cl if there is no endpoint or it's unreachable.
+        """
+        if not cache_endpoint:
+            return self.s3cl
+        if not cache_reachable(cache_endpoint):
+            self.logger.warning('cache endpoint ' + cache_endpoint
+                                + ' is unreachable, downloading from s3')
+            return self.s3cl
+        session = self.session or boto3.Session()
+        client = session.client('s3', endpoint_url = cache_endpoint,
+                                config = BotoConfig(s3 = {'addressing_style': 'path'},
+                                                    connect_timeout = 2,
+                                                    retries = {'max_attempts': 2}))
+        self.stats.attach(client)
+        self.tracer.attach(client)
+        ## managed downloads don't take IfMatch, it's added to their HEAD and
+        ## GET requests here
+        for operation in ('HeadObject', 'GetObject'):
+            client.meta.events.register('before-parameter-build.s3.' + operation,
+                                        self.add_cache_etag)
+        self.logger.info('downloading objects through cache ' + cache_endpoint)
+        return client
+
+    def add_cache_etag(self, params, **kwargs):
+        etag = self.cache_etags.get(params.get('Key'))
+        if etag and 'IfMatch' not in params:
+            params['IfMatch'] = etag
+
+    def read_object(self, read):
+        """
+        Call read(client) with the cache client, falls back to s3 for this
+        and all later reads if the cache can't be reached.
+        """
+        if self.read_cl is not self.s3cl:
+            try:
+                return read(self.read_cl, True)
+            except (EndpointConnectionError, ConnectionClosedError) as e:
+                self.logger.warning('cache endpoint failed, downloading from s3: ' + str(e))
+                self.read_cl = self.s3cl
+        return read(self.s3cl, False)
+
     def init_localcache_fname(self, localcache_fname):
         """
 
@@ -411,6 +787,349 @@ class SmartS3Sync():
 
         return localcache_dir
 
+    def codec_etags_path(self):
+        cache_dir = self.localcache_dir or os.path.join(os.environ.get('HOME'), '.s3sync')
+        return os.path.join(cache_dir, 'codec_etags_' + self.bucket + '.json.gz')
+
+    def load_codec_etags(self):
+        """
+        Map of stored ETags of compressed objects to their plain md5sum, size
+        and codec, {'stored etag': ['plain etag', 'size', 'codec']}, objects
+        found to be plain have an empty codec.  The stored bytes determine
+        the plain content, so entries hold for any key and never go stale.
+        """
+        if self.codec_etags is None:
+            self.codec_etags = load_json_cache(self.codec_etags_path())
+        return self.codec_etags
+
+    def save_codec_etags(self):
+        if not self.codec_etags_changed:
+            return
+        save_json_cache(self.codec_etags_path(), self.codec_etags)
+        self.codec_etags_changed = False
+
+    def add_codec_etag(self, stored_etag, plain_etag, size, codec):
+        self.load_codec_etags()[stored_etag.replace('"', '')] = [plain_etag, str(size), codec]
+        self.codec_etags_changed = True
+
+    def resolve_plain_etags(self, remote, local = None, fromS3 = False):
+        """
+        Translate the ETags and sizes of compressed objects in an s3 listing
+        to those of their plain content, so they compare equal to the md5sum
+        of local files.  The stored values are kept as 'StoredETag' and
+        'StoredSize', the codec as 'Codec'.
+
+        Translations come from the codec ETag cache, objects that aren't
+        cached are looked up with head_object if their ETag differs from the
+        one of the local file, and compression or delta sync is enabled or
+        they are downloaded (fromS3): a client without these settings must
+        still decompress and assemble the objects of one that has them.
+        Downloaded objects without a local file are not looked up, their
+        codec is learnt from the HEAD of their download, see
+        download_object.
+
+        Args:
+            remote (OrderedDict): s3 listing, translated in place.
+            local (OrderedDict): local keys with their md5sum 'ETag', None to
+                                 look up all remote objects.
+            fromS3 (boolean): also look up objects that don't exist locally.
+
+        Returns:
+            remote (OrderedDict)
+        """
+        if not remote:
+            return remote
+        cache = self.load_codec_etags()
+        for k, v in remote.items():
+            if (k.endswith('/') or 'StoredETag' in v or is_feed_key(k)
+                    or k.startswith(deltasync.CHUNK_PREFIX)):
+                continue
+            etag = v['ETag'].replace('"', '')
+            entry = cache.get(etag)
+            if entry is None and (self.codec is not None or self.delta or fromS3):
+                if fromS3 and (local is None or k not in local):
+                    ## a new object learns its codec from its download
+                    continue
+                if local is not None:
+                    if k not in local and not fromS3:
+                        continue
+                    if k in local and local[k].get('ETag', '').replace('"', '') == etag:
+                        continue
+                v['Metadata'] = self.lookup_codec(k)
+                entry = cache.get(etag)
+            self.apply_codec(v, entry)
+        self.save_codec_etags()
+        if self.fingerprint is not None:
+            self.resolve_fingerprints(remote, local, fromS3)
+        if local is not None:
+            self.resolve_part_sizes(remote, local)
+        return remote
+
+    def lookup_codec(self, key, head = None):
+        """
+        Add the codec in the metadata of an object to the codec ETag cache,
+        an empty one if it's stored plain.
+
+        Args:
+            head (dict): head_object response of key, None to request it.
+
+        Returns:
+            (dict): metadata of the object.
+        """
+        head = head or self.s3cl.head_object(Bucket = self.bucket, Key = key)
+        meta = head.get('Metadata', {})
+        if meta.get('codec') and meta.get('plain-etag'):
+            self.add_codec_etag(head['ETag'], meta['plain-etag'], meta.get('size', ''),
+                                meta['codec'])
+        else:
+            self.add_codec_etag(head['ETag'], '', '', '')
+        return meta
+
+    def learn_codec(self, parsed, **kwargs):
+        """after-call handler of HeadObject, caches the codec of the object."""
+        if parsed.get('ETag') and 'Metadata' in parsed:
+            self.head_metadata[parsed['ETag'].replace('"', '')] = self.lookup_codec(None, parsed)
+
+    def learned_codec(self, key, remote):
+        """
+        Codec of a download whose codec wasn't cached, at its first write.
+        It was learnt from the HEAD of the managed download, or is looked up
+        if that wasn't seen, e.g. with a backend that doesn't send one.
+
+        Returns:
+            (str): codec to decompress with, None to write the data as it is,
+                   a delta manifest is assembled after the download.
+        """
+        etag = remote['ETag'].replace('"', '')
+        if etag not in self.load_codec_etags():
+            self.head_metadata[etag] = self.lookup_codec(key)
+        codec = self.load_codec_etags().get(etag, ['', '', ''])[2]
+        return codec if codec and codec != deltasync.DELTA_CODEC else None
+
+    def apply_codec(self, v, entry):
+        """Translate a listing entry with its codec ETag cache entry."""
+        if not entry or not entry[2]:
+            return v
+        v['StoredETag'] = v['ETag']
+        v['StoredSize'] = v.get('Size', v.get('ContentLength'))
+        v['ETag'] = entry[0]
+        if entry[1]:
+            v['Size'] = int(entry[1])
+        v['Codec'] = entry[2]
+        return v
+
+    def resolve_codec(self, key, remote):
+        """
+        Translate the listing entry of an object about to be downloaded that
+        resolve_plain_etags didn't look up, e.g. of a key not in the cache
+        yet, so compressed and delta objects are never written as stored.
+        """
+        if not remote or 'StoredETag' in remote or not remote.get('ETag'):
+            return remote
+        etag = remote['ETag'].replace('"', '')
+        if etag not in self.load_codec_etags():
+            remote['Metadata'] = self.lookup_codec(key)
+        return self.apply_codec(remote, self.load_codec_etags().get(etag))
+
+    def fingerprints_path(self):
+        cache_dir = self.localcache_dir or os.path.join(os.environ.get('HOME'), '.s3sync')
+        return os.path.join(cache_dir, 'fingerprints_' + self.bucket + '.json.gz')
+
+    def load_fingerprints(self):
+        """
+        Fingerprints in the metadata of object versions,
+        {'key|stored etag': 'fingerprint', '' if the object has none}.
+        """
+        if self.fingerprints is None:
+            self.fingerprints = load_json_cache(self.fingerprints_path())
+        return self.fingerprints
+
+    def save_fingerprints(self):
+        if not self.fingerprints_changed:
+            return
+        save_json_cache(self.fingerprints_path(), self.fingerprints)
+        self.fingerprints_changed = False
+
+    def resolve_fingerprints(self, remote, local = None, fromS3 = False):
+        """
+        Translate the ETags of objects with a fingerprint in their metadata
+        to the fingerprint, kept as 'Fingerprint' too, so they compare with
+        the fingerprints of local files.  Local files whose object has no
+        fingerprint get their md5sum instead.
+
+        Fingerprints come from a cache by key and ETag, objects that aren't
+        cached are looked up with head_object if they exist locally or are
+        downloaded.
+
+        Args:
+            remote (OrderedDict): s3 listing, translated in place.
+            local (OrderedDict): local keys with their fingerprint 'ETag'.
+            fromS3 (boolean): also look up objects that don't exist locally.
+        """
+        local = local if local is not None else {}
+        cache = self.load_fingerprints()
+        for k, v in remote.items():
+            if (k.endswith('/') or 'Fingerprint' in v or is_feed_key(k)
+                    or k.startswith(deltasync.CHUNK_PREFIX)):
+                continue
+            if is_fingerprint(v['ETag']):
+                ## plain etag of an object compressed in fingerprint mode
+                v['Fingerprint'] = v['ETag']
+                continue
+            stored = v.get('StoredETag', v['ETag']).replace('"', '')
+            fingerprint = cache.get(k + '|' + stored)
+            if fingerprint is None and (k in local or fromS3):
+                head = self.s3cl.head_object(Bucket = self.bucket, Key = k)
+                fingerprint = head.get('Metadata', {}).get('fingerprint', '')
+                cache[k + '|' + stored] = fingerprint
+                self.fingerprints_changed = True
+            if fingerprint:
+                v.setdefault('StoredETag', v['ETag'])
+                v['ETag'] = v['Fingerprint'] = fingerprint
+            elif (fingerprint is not None and k in local and local[k].get('local')
+                    and is_fingerprint(local[k].get('ETag'))):
+                ## uploaded without a fingerprint, compare md5sums
+                local[k]['ETag'] = self.md5(local[k]['local'])
+        self.save_fingerprints()
+        return remote
+
+    def part_etags_path(self):
+        cache_dir = self.localcache_dir or os.path.join(os.environ.get('HOME'), '.s3sync')
+        return os.path.join(cache_dir, 'part_etags.json.gz')
+
+    def load_part_etags(self):
+        """
+        ETags of local files computed with other part sizes than PART_SIZE,
+        {'path|mtime|size|part size|multipart': 'etag'}.
+        """
+        if self.part_etags is None:
+            self.part_etags = load_json_cache(self.part_etags_path())
+        return self.part_etags
+
+    def save_part_etags(self):
+        if not self.part_etags_changed:
+            return
+        save_json_cache(self.part_etags_path(), self.part_etags)
+        self.part_etags_changed = False
+
+    def quick_stats_path(self):
+        cache_dir = self.localcache_dir or os.path.join(os.environ.get('HOME'), '.s3sync')
+        return os.path.join(cache_dir, 'quick_stats_' + self.bucket + '.json.gz')
+
+    def load_quick_stats(self):
+        """
+        Size and mtime of each object version for --quick,
+        {'key': ['stored etag', 'plain etag', 'size', 'mtime']}.  The size and
+        mtime are those recorded in the object metadata by the uploader
+        (downloads set the mtime of the local file to it), or the stat of a
+        local file whose md5sum matched the object.
+        """
+        if self.quick_stats is None:
+            self.quick_stats = load_json_cache(self.quick_stats_path())
+        return self.quick_stats
+
+    def save_quick_stats(self):
+        if not self.quick_stats_changed:
+            return
+        save_json_cache(self.quick_stats_path(), self.quick_stats)
+        self.quick_stats_changed = False
+
+    def add_quick_stat(self, key, remote, size, mtime):
+        """
+        Args:
+            key (str): s3 key.
+            remote (dict): the object in the form of resolve_plain_etags.
+            size, mtime: recorded size and mtime of the object.
+        """
+        stored = (remote.get('StoredETag') or remote['ETag']).replace('"', '')
+        plain = remote['ETag']
+        if self.fingerprint is not None and remote.get('Fingerprint'):
+            plain = remote['Fingerprint']
+        entry = [stored, plain.replace('"', ''), str(size), str(mtime)]
+        if self.load_quick_stats().get(key) != entry:
+            self.quick_stats[key] = entry
+            self.quick_stats_changed = True
+
+    def quick_check(self, keys, remote):
+        """
+        Set the 'ETag' of local keys whose size and mtime equal the ones
+        recorded for the listed version of their object, without hashing.
+
+        Returns:
+            (set): keys set by the quick check.
+        """
+        stats = self.load_quick_stats()
+        quick = set()
+        for k, v in keys.items():
+            entry = stats.get(k)
+            r = remote.get(k) if remote else None
+            if (entry is None or r is None or k.endswith('/')
+                    or is_fingerprint(entry[1]) != (self.fingerprint is not None)
+                    or entry[0] != r.get('StoredETag', r['ETag']).replace('"', '')
+                    or entry[2] != str(v['size']) or entry[3] != str(v['mtime'])):
+                continue
+            v['ETag'] = entry[1]
+            quick.add(k)
+        self.logger.info('quick check: ' + str(len(quick)) + ' of ' + str(len(keys))
+                         + ' files unchanged by size and mtime')
+        return quick
+
+    def learn_quick_stats(self, local, remote):
+        """Record the stat of local files whose md5sum matched the object."""
+        if not self.quick or not remote:
+            return
+        for k, v in local.items():
+            r = remote.get(k)
+            if (r is not None and not k.endswith('/') and v.get('ETag')
+                    and v['ETag'].replace('"', '') == r['ETag'].replace('"', '')):
+                self.add_quick_stat(k, r, v['size'], v['mtime'])
+        self.save_quick_stats()
+
+    def part_etag(self, local, part_size, multipart):
+        """ETag of a local file with another part size, cached."""
+        key = '|'.join([local['local'], str(local.get('mtime', '')), str(local.get('size', '')),
+                        str(part_size), 'm' if multipart else 'p'])
+        cache = self.load_part_etags()
+        if key not in cache:
+            with self.tracer.span('md5', 'hash', path = local['local'], part_size = part_size):
+                cache[key] = S3SyncUtility().md5(local['local'], part_size = part_size,
+                                                 multipart = multipart)
+            self.part_etags_changed = True
+        return cache[key]
+
+    def resolve_part_sizes(self, remote, local):
+        """
+        Translate the ETags of objects that were uploaded with another part
+        size than PART_SIZE, e.g. by other tools, to the md5sum of the local
+        file, so they don't differ only because of the chunking.  Candidate
+        part sizes are inferred from the part count of the ETag and the
+        object size, the original ETag is kept as 'StoredETag' and the
+        matching part size as 'PartSize'.
+
+        Args:
+            remote (OrderedDict): s3 listing, translated in place.
+            local (OrderedDict): local keys with their md5sum 'ETag'.
+        """
+        for k, v in remote.items():
+            if (k.endswith('/') or k not in local or 'StoredETag' in v
+                    or not os.path.isfile(local[k].get('local', ''))):
+                continue
+            etag = v['ETag'].replace('"', '')
+            local_etag = local[k].get('ETag', '').replace('"', '')
+            size = v.get('Size', v.get('ContentLength'))
+            if (not local_etag or etag == local_etag or size is None
+                    or str(local[k].get('size', size)) != str(size)):
+                continue
+            for part_size in part_size_candidates(int(size), etag):
+                if self.part_etag(local[k], part_size, '-' in etag) == etag:
+                    self.logger.debug(k + ' was uploaded with ' + str(part_size)
+                                      + ' byte parts')
+                    v['StoredETag'] = v['ETag']
+                    v['ETag'] = local_etag
+                    v['PartSize'] = part_size
+                    break
+        self.save_part_etags()
+        return remote
 
     def check_localcache(self, keys):
         """
@@ -431,36 +1150,30 @@ class SmartS3Sync():
         util = S3SyncUtility()
 
         if os.path.isfile(md5_data):
-            fdict = {}
             keys_updated = OrderedDict({})
-            with gzip.open(md5_data, 'rb') as f:
+            fdict = load_json_cache(md5_data)
 
-                fdict = json.loads(f.read().decode())
-
-                for k,v in keys.items():
-                    try:
-                        ## check last modified, if different compute md5
-                        if fdict[v['local']]['mtime'] != v['mtime']:
-                            keys_updated.update({k:v})
-
-                            keys_updated[k]['ETag'] = util.md5(k)
-                            fdict[v['local']] = {'ETag':keys_updated[k]['ETag'], 'mtime':v['mtime']}
-                        else:
-                            ## if same last modified, use stored md5 tag
-                            keys_updated.update({k:v})
-                            keys_updated[k]['ETag'] = fdict[v['local']]['ETag']
-                    except KeyError:
-                        ## if key not found locally compute md5, and store local
+            for k,v in keys.items():
+                try:
+                    ## check last modified, if different compute md5
+                    if fdict[v['local']]['mtime'] != v['mtime']:
                         keys_updated.update({k:v})
-                        keys_updated[k]['ETag'] = util.md5(v['local'])
 
-                        ## update local data store
+                        keys_updated[k]['ETag'] = self.md5(v['local'])
                         fdict[v['local']] = {'ETag':keys_updated[k]['ETag'], 'mtime':v['mtime']}
+                    else:
+                        ## if same last modified, use stored md5 tag
+                        keys_updated.update({k:v})
+                        keys_updated[k]['ETag'] = fdict[v['local']]['ETag']
+                except KeyError:
+                    ## if key not found locally compute md5, and store local
+                    keys_updated.update({k:v})
+                    keys_updated[k]['ETag'] = self.md5(v['local'])
 
-            with gzip.open(md5_data, 'w') as f:
-                json_str = json.dumps(fdict)
-                json_bytes = json_str.encode('utf-8')
-                f.write(json_bytes)
+                    ## update local data store
+                    fdict[v['local']] = {'ETag':keys_updated[k]['ETag'], 'mtime':v['mtime']}
+
+            save_json_cache(md5_data, fdict)
 
             return keys_updated
         else:
@@ -478,7 +1191,7 @@ class SmartS3Sync():
                  total = len(keys) - 1
 
                  for k,v in keys.items():
-                     keys[k]['ETag'] = util.md5(v['local'])
+                     keys[k]['ETag'] = self.md5(v['local'])
                      nextLn = '    "' + v['local'] + '": {"mtime": "' + v['mtime'] + '" , "ETag": "' + v['ETag'] + '"}'
                      f.write(nextLn.encode())
 
@@ -491,6 +1204,80 @@ class SmartS3Sync():
 
              return keys
 
+    def update_localcache(self, keys):
+        """
+        Record the md5sums of local files in the localcache file, e.g. of
+        files uploaded outside of a directory sync.
+
+        Args:
+            keys (dict): {'s3key/path': {'local':..., 'mtime':..., 'ETag':...}}
+        """
+        if not self.localcache or not keys:
+            return
+        if not os.path.exists(self.localcache_dir):
+            os.mkdir(self.localcache_dir)
+        md5_data = os.path.join(self.localcache_dir, self.localcache_fname)
+        fdict = load_json_cache(md5_data)
+        for k, v in keys.items():
+            fdict[v['local']] = {'ETag': v['ETag'], 'mtime': v['mtime']}
+        save_json_cache(md5_data, fdict)
+
+
+    def cached_etags(self, keys, remote = None):
+        """
+        Set the 'ETag' of the local keys that are known without hashing, by
+        the quick check or from the local cache, like compute_etags.
+
+        Returns:
+            (OrderedDict): the keys that still need to be hashed.
+        """
+        quick = self.quick_check(keys, remote) if self.quick and remote is not None else set()
+        rest = OrderedDict((k, v) for k, v in keys.items() if k not in quick)
+        if rest and self.localcache and self.fingerprint is None:
+            fdict = load_json_cache(os.path.join(self.localcache_dir, self.localcache_fname))
+            for k, v in list(rest.items()):
+                entry = fdict.get(v['local'])
+                if entry is not None and entry['mtime'] == v['mtime']:
+                    v['ETag'] = entry['ETag']
+                    del rest[k]
+        return rest
+
+    def compute_etags(self, keys, localcache = None, remote = None):
+        """
+        Fill in the md5sum 'ETag' of local keys, using the local cache if
+        enabled.
+
+        Args:
+            keys (OrderedDict):
+            {'s3key/path': {'uid':'1000', 'mode':'33204', 'local':..., etc...'}}
+            localcache (boolean): override self.localcache, e.g. False for
+                                  --force.
+            remote (OrderedDict): s3 listing, with --quick files whose size and
+                                  mtime match the listed object aren't hashed.
+
+        Returns:
+            keys (OrderedDict): with 'ETag' set.
+        """
+        if localcache is None:
+            localcache = self.localcache
+        if self.quick and remote is not None:
+            quick = self.quick_check(keys, remote)
+            if quick:
+                rest = OrderedDict((k, v) for k, v in keys.items() if k not in quick)
+                self.compute_etags(rest, localcache = localcache)
+                return keys
+        with self.phase('hash'):
+            self.stats.add('hash', files = len(keys),
+                           nbytes = sum(int(v.get('size') or 0) for v in keys.values()))
+            ## fingerprints are fast enough to not cache them
+            if localcache and self.fingerprint is None:
+                self.logger.info('checking local cache...')
+                return self.check_localcache(keys)
+            for k,v in keys.items():
+                self.logger.debug('not using localcache, calculating md5 sum now for "' + v['local'] + '"')
+                v['ETag'] = self.local_etag(v['local'])
+                self.logger.debug(v['ETag'])
+            return keys
 
     def parse_prefix(self, path = None, bucket = None, metadir = None):
         """
@@ -573,10 +1360,10 @@ class SmartS3Sync():
 
 
         """
-        my_bucket = self.s3rc.Bucket(self.bucket)
-        my_bucket.Object(key).copy_from(CopySource = my_bucket.name +'/' + key,
-                                        Metadata = metadata,
-                                        MetadataDirective='REPLACE')
+        self.s3cl.copy_object(Bucket = self.bucket, Key = key,
+                              CopySource = {'Bucket': self.bucket, 'Key': key},
+                              Metadata = metadata,
+                              MetadataDirective = 'REPLACE')
 
 
     def verify_keys(self, keys = None):
@@ -647,6 +1434,26 @@ class SmartS3Sync():
 
         """
 
+        with self.phase('list'):
+            matches = self._warm_queryS3(prefix, search, return_all_objects)
+        self.stats.add('list', files = len(matches) if matches else 0)
+        return matches
+
+    def _warm_queryS3(self, prefix, search, return_all_objects):
+        """_queryS3, reusing recent listings of a pooled client in deoncli daemon."""
+        warm = warm_state()
+        if warm is None or self.warm_key is None or not return_all_objects:
+            return self._queryS3(prefix, search, return_all_objects)
+        try:
+            return warm.listing(self.warm_key, self.bucket, prefix)
+        except KeyError:
+            pass
+        listed, generation = time.time(), warm.generation
+        matches = self._queryS3(prefix, search, return_all_objects)
+        warm.store_listing(self.warm_key, self.bucket, prefix, matches, listed, generation)
+        return matches
+
+    def _queryS3(self, prefix, search, return_all_objects):
         # Create a reusable Paginator
         paginator = self.s3cl.get_paginator('list_objects_v2')
 
@@ -701,6 +1508,11 @@ class SmartS3Sync():
             this dictionary will include a 'local' key that has the file path
             to a local file before conversion to an s3 key for eTag lookup.
         """
+        with self.phase('diff'):
+            self.stats.add('diff', files = len(source))
+            return self._compare_etag(source, destination, fromS3)
+
+    def _compare_etag(self, source, destination, fromS3):
         ## compare ETags to determine which files need to be uploaded
         needs_sync = OrderedDict()
         for k,v in source.items():
@@ -719,6 +1531,484 @@ class SmartS3Sync():
                 needs_sync[k] = v
         return needs_sync
 
+    def download_object(self, key, local, remote = None):
+        """
+        Download an s3 object to a local file.  If an object store is
+        configured and already holds the object, it is checked out from the
+        store without any network I/O, otherwise the downloaded file is added
+        to the store.  Compressed objects are decompressed while they are
+        written.
+
+        Args:
+            key (str): s3 key.
+            local (str): local file path.
+            remote (dict): listing or head_object entry of key, provides the
+                           ETag and size the object store is keyed by, and the
+                           'Codec' of compressed objects (resolve_plain_etags),
+                           None to head the object, delta manifests and
+                           compressed objects are recognized by its metadata.
+        """
+        if remote is None:
+            head = self.s3cl.head_object(Bucket = self.bucket, Key = key)
+            remote = {'ETag': head['ETag'], 'Size': head['ContentLength'],
+                      'Metadata': self.lookup_codec(key, head)}
+        ## the codec of an object that isn't cached yet is learnt from the
+        ## HEAD of its managed download, the object store needs the plain
+        ## ETag before
+        learn = (self.objectstore is None and bool(remote) and 'StoredETag' not in remote
+                 and bool(remote.get('ETag'))
+                 and remote['ETag'].replace('"', '') not in self.load_codec_etags())
+        if not learn:
+            self.resolve_codec(key, remote)
+        etag = None
+        if self.objectstore is not None and remote:
+            etag = remote['ETag']
+            size = remote.get('Size', remote.get('ContentLength'))
+            if self.objectstore.checkout(etag, size, local):
+                self.logger.info("checkout: " + key + " to " + local
+                                 + " from object store")
+                self.stats.transfer('checked_out', files = 1, nbytes = int(size))
+                self.record_download(key, local, remote)
+                return
+
+        if remote and remote.get('Codec') == deltasync.DELTA_CODEC:
+            self.download_delta(key, local)
+            if etag is not None:
+                self.objectstore.add(local, etag, size)
+            self.record_download(key, local, remote)
+            return
+
+        ## unlink first, local may be a hardlink into the object store
+        if os.path.lexists(local):
+            os.remove(local)
+
+        with self.phase('transfer'), self.tracer.span('download', 'transfer', key = key):
+            with self.tracer.span('open', 'file', path = local):
+                f = open(local, 'wb')
+            with f:
+                self.logger.info("download: " + key + " to " + local)
+                codec = remote.get('Codec') if remote else None
+
+                def read(client, cached):
+                    f.seek(0)
+                    f.truncate()
+                    if cached and remote and remote.get('ETag'):
+                        ## lets the cache serve its copy without asking s3
+                        stored = remote.get('StoredETag', remote['ETag'])
+                        self.cache_etags[key] = '"' + stored.replace('"', '') + '"'
+                    events = getattr(getattr(client, 'meta', None), 'events', None)
+                    unique_id = 'deon-codec-%d-%s' % (id(self), key)
+                    if learn:
+                        writer = CodecWriter(f, lambda: self.learned_codec(key, remote))
+                        if events is not None:
+                            events.register('after-call.s3.HeadObject', self.learn_codec,
+                                            unique_id = unique_id)
+                    else:
+                        writer = get_codec(codec).decompress_writer(f) if codec else f
+                    try:
+                        client.download_fileobj(Bucket = self.bucket,
+                                                Key = key,
+                                                Fileobj = writer,
+                                                Callback = self.transfer_callback(local))
+                    finally:
+                        self.cache_etags.pop(key, None)
+                        if learn and events is not None:
+                            events.unregister('after-call.s3.HeadObject', unique_id = unique_id)
+                    if codec or learn:
+                        writer.flush()
+
+                self.read_object(read)
+            if learn:
+                metadata = self.head_metadata.pop(remote['ETag'].replace('"', ''), None)
+                if metadata is not None:
+                    remote.setdefault('Metadata', metadata)
+                self.resolve_codec(key, remote)
+                codec = remote.get('Codec')
+            if codec != deltasync.DELTA_CODEC:
+                nbytes = os.path.getsize(local)
+                self.stats.add('transfer', files = 1, nbytes = nbytes)
+                if codec and remote.get('StoredSize'):
+                    nbytes = int(remote['StoredSize'])
+                self.stats.transfer('downloaded', files = 1, nbytes = nbytes)
+
+        if codec == deltasync.DELTA_CODEC:
+            ## the download was the manifest, assemble the file from its chunks
+            with open(local, 'rb') as f:
+                manifest = deltasync.load_manifest(f.read())
+            os.remove(local)
+            self.download_delta(key, local, manifest)
+        if etag is not None:
+            self.objectstore.add(local, etag, size)
+        self.record_download(key, local, remote)
+
+    def download_slim(self, key, local, remote):
+        """
+        Write a slim copy of an hdf5 object with only self.datasets, reading
+        just their byte ranges and the file structure, see deon.slim.
+        Compressed and delta objects can't be read by range, they are
+        downloaded whole and slimmed locally.
+
+        Args:
+            remote (dict): listing entry of key, after resolve_plain_etags.
+        """
+        self.resolve_codec(key, remote)
+        etag = remote['ETag'].replace('"', '')
+        if remote.get('Codec'):
+            tmp = os.path.join(os.path.dirname(local) or '.',
+                               '.' + os.path.basename(local) + '.full.' + str(os.getpid()))
+            try:
+                self.download_object(key, tmp, remote = remote)
+                with h5py.File(tmp, 'r') as hf:
+                    missing = write_slim(hf, local, self.datasets, etag)
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+        else:
+            stored = '"' + remote.get('StoredETag', remote['ETag']).replace('"', '') + '"'
+
+            def read(start, end):
+                def get(client, cached):
+                    return client.get_object(Bucket = self.bucket, Key = key,
+                                             Range = 'bytes=%d-%d' % (start, end - 1),
+                                             IfMatch = stored)['Body'].read()
+                return self.read_object(get)
+
+            with self.phase('transfer'), self.tracer.span('slim', 'transfer', key = key):
+                self.logger.info("slim download: " + key + " to " + local)
+                f = RangeFile(read, int(remote.get('Size', remote.get('ContentLength'))))
+                with h5py.File(f, 'r') as hf:
+                    missing = write_slim(hf, local, self.datasets, etag)
+                self.stats.add('transfer', files = 1, nbytes = f.nbytes)
+                self.stats.transfer('downloaded', files = 1, nbytes = f.nbytes)
+            self.logger.debug('%s: %d range requests, %d of %s bytes'
+                              % (key, f.requests, f.nbytes, remote.get('Size')))
+        if missing:
+            self.logger.warning(key + ' has no dataset ' + ', '.join(missing))
+
+    def record_download(self, key, local, remote):
+        """
+        With --quick, set the mtime of a downloaded file to the one recorded
+        in the object metadata and remember it for the quick check.  Files
+        checked out of the object store share their inode and keep its mtime.
+        """
+        if not self.quick or not remote or not remote.get('ETag'):
+            return
+        mtime = None
+        if not (self.objectstore is not None and os.stat(local).st_nlink > 1):
+            try:
+                ## the metadata of the codec lookup, if there was one
+                meta = remote.get('Metadata')
+                if meta is None:
+                    meta = self.s3cl.head_object(Bucket = self.bucket, Key = key).get('Metadata', {})
+                mtime = int(meta['mtime']) if meta.get('mtime') else None
+            except (ClientError, ValueError):
+                mtime = None
+        if mtime is not None:
+            os.utime(local, (time.time(), mtime))
+        st = os.stat(local)
+        self.add_quick_stat(key, remote, st.st_size, int(st.st_mtime))
+
+    def upload_meta(self, v):
+        """
+        ExtraArgs of the upload of a local file.
+
+        Args:
+            v (dict): dzip_meta of the file with its 'ETag'.
+
+        Returns:
+            (dict): 'ContentType', and the stat, fingerprint, uid, gid and
+                    metajson of the file as 'Metadata'.
+            (str): metajson of the file.
+        """
+        meta = {}
+        ## load the magic file() function
+        m = magic.open(magic.MAGIC_NONE)
+        m_result = m.load()
+        meta['ContentType'] = m.file(v['local']).split(';')[0]
+        meta['Metadata'] = v.copy()
+        if is_fingerprint(v.get('ETag')):
+            meta['Metadata']['fingerprint'] = v['ETag']
+
+        ## remove unneccesary metadata
+        rm_local_etag = meta['Metadata'].pop('ETag')
+        rm_local_path = meta['Metadata'].pop('local')
+
+        metajson = self.metajson(v['local'])
+        add_metajson_to_metadata(meta, metajson)
+
+        ## check for uid & gid
+        if self.uid:
+            meta['Metadata']['uid'] = self.uid
+        if self.gid:
+            meta['Metadata']['gid'] = self.gid
+        return meta, metajson
+
+    def upload_object(self, key, local, meta, show_progress = True, etag = None,
+                      remote = None):
+        """
+        Upload a local file to an s3 key.  With compression enabled the file
+        is compressed while it is uploaded and the codec and the md5sum of the
+        plain file are added to the metadata.
+
+        Args:
+            key (str): s3 key.
+            local (str): local file path.
+            meta (dict): ExtraArgs for upload_fileobj, i.e. 'Metadata' and
+                         'ContentType'.
+            show_progress (boolean): report upload progress.
+            etag (str): md5sum or fingerprint of the local file.
+            remote (dict): listing entry of the object being replaced, the
+                           chunks of a previous delta upload are not checked
+                           again.
+
+        Returns:
+            (dict): the new object in the form of resolve_plain_etags, with
+                    the md5sum 'ETag' of the plain content, and the
+                    'Fingerprint' in fingerprint mode.
+        """
+        fingerprint = etag if is_fingerprint(etag) else None
+        if self.delta and os.path.getsize(local) >= deltasync.MIN_DELTA_SIZE:
+            ## plain-etag is the md5sum in every mode, fingerprints are only
+            ## stored as 'fingerprint'
+            return self.upload_delta(key, local, meta,
+                                     self.md5(local) if fingerprint or not etag else etag,
+                                     remote = remote)
+        if self.codec is not None:
+            return self.upload_compressed(key, local, meta,
+                                          self.md5(local) if fingerprint or not etag else etag)
+
+        with self.phase('transfer'), self.tracer.span('upload', 'transfer', key = key):
+            with self.tracer.span('open', 'file', path = local):
+                f = open(local, 'rb')
+            with f:
+                self.logger.info("upload: " + local + " to " + key)
+                ## the ETag of the object, computed while uploading
+                body = ETagReader(f, PART_SIZE) if fingerprint else f
+                self.s3cl.upload_fileobj(body, self.bucket, key,
+                                         ExtraArgs = meta,
+                                         Callback = self.transfer_callback(local, show_progress),
+                                         Config = self.transfer_config)
+            nbytes = os.path.getsize(local)
+            self.stats.add('transfer', files = 1, nbytes = nbytes)
+            self.stats.transfer('uploaded', files = 1, nbytes = nbytes)
+        if fingerprint:
+            return {'ETag': body.etag(), 'Size': nbytes, 'Fingerprint': fingerprint}
+        return {'ETag': etag, 'Size': nbytes}
+
+    def upload_compressed(self, key, local, meta, etag):
+        """
+        Upload a local file compressed with self.codec, see upload_object.
+        The ETag of the compressed stream is computed while uploading and
+        added to the codec ETag cache, so no extra request is needed to
+        compare the object with the local file later.
+        """
+        meta = dict(meta, Metadata = dict(meta['Metadata'], codec = self.codec.name))
+        meta['Metadata']['plain-etag'] = etag.replace('"', '')
+        with self.phase('transfer'), self.tracer.span('upload', 'transfer', key = key,
+                                                      codec = self.codec.name):
+            with self.tracer.span('open', 'file', path = local):
+                f = open(local, 'rb')
+            with f:
+                self.logger.info("upload: " + local + " to " + key
+                                 + " (" + self.codec.name + ")")
+                reader = ETagReader(self.codec.compress_reader(f), PART_SIZE)
+                self.s3cl.upload_fileobj(reader, self.bucket, key,
+                                         ExtraArgs = meta,
+                                         Callback = self.transfer_callback(local),
+                                         Config = self.transfer_config)
+            nbytes = os.path.getsize(local)
+            self.add_codec_etag(reader.etag(), meta['Metadata']['plain-etag'], nbytes,
+                                self.codec.name)
+            self.stats.add('transfer', files = 1, nbytes = nbytes)
+            self.stats.transfer('uploaded', files = 1, nbytes = reader.size)
+        return with_fingerprint({'ETag': meta['Metadata']['plain-etag'], 'Size': nbytes,
+                                 'StoredETag': reader.etag(), 'Codec': self.codec.name},
+                                meta)
+
+    def get_manifest(self, key):
+        body = self.s3cl.get_object(Bucket = self.bucket, Key = key)['Body'].read()
+        return deltasync.load_manifest(body)
+
+    def upload_delta(self, key, local, meta, etag, remote = None):
+        """
+        Upload a local file as content-defined chunks plus a manifest at key,
+        see deon.delta.  Only chunks that aren't stored in the bucket yet are
+        uploaded, on the shared chunk pool.
+        """
+        with self.tracer.span('chunk', 'hash', path = local):
+            chunks = deltasync.file_chunks(local)
+
+        with self.phase('transfer'), self.tracer.span('upload', 'transfer', key = key,
+                                                      codec = deltasync.DELTA_CODEC):
+            stored = set()
+            if remote and remote.get('Codec') == deltasync.DELTA_CODEC:
+                stored.update(sha for sha, size in self.get_manifest(key)['chunks'])
+
+            uploaded = 0
+            pool = chunk_pool()
+            pending = deque()
+            try:
+                for sha, offset, size in chunks:
+                    if sha in stored:
+                        continue
+                    ## repeated chunks of the file are uploaded once
+                    stored.add(sha)
+                    if len(pending) >= self.transfer_config.max_concurrency:
+                        uploaded += pending.popleft().result()
+                    pending.append(pool.submit(self.upload_chunk, local, sha, offset, size))
+                while pending:
+                    uploaded += pending.popleft().result()
+            finally:
+                ## chunks still in flight after an error
+                futures.wait(pending)
+            reused = sum(size for sha, offset, size in chunks) - uploaded
+
+            nbytes = os.path.getsize(local)
+            body = deltasync.make_manifest(chunks, nbytes, etag.replace('"', ''))
+            metadata = dict(meta['Metadata'], codec = deltasync.DELTA_CODEC)
+            metadata['plain-etag'] = etag.replace('"', '')
+            self.logger.info("upload: " + local + " to " + key + " (delta, "
+                             + str(uploaded) + " new bytes, " + str(reused)
+                             + " bytes already stored)")
+            self.s3cl.put_object(Bucket = self.bucket, Key = key, Body = body,
+                                 Metadata = metadata, ContentType = meta['ContentType'])
+            stored_etag = hashlib.md5(body).hexdigest()
+            self.add_codec_etag(stored_etag, metadata['plain-etag'],
+                                nbytes, deltasync.DELTA_CODEC)
+            self.stats.add('transfer', files = 1, nbytes = nbytes)
+            self.stats.transfer('uploaded', files = 1, nbytes = uploaded + len(body))
+            self.stats.transfer('delta_reused', nbytes = reused)
+        return with_fingerprint({'ETag': metadata['plain-etag'], 'Size': nbytes,
+                                 'StoredETag': stored_etag, 'Codec': deltasync.DELTA_CODEC},
+                                meta)
+
+    def upload_chunk(self, local, sha, offset, size):
+        """
+        Upload a chunk of a local file unless the bucket has it already.
+
+        Returns:
+            (int): bytes uploaded, 0 for a stored chunk.
+        """
+        try:
+            self.s3cl.head_object(Bucket = self.bucket, Key = deltasync.chunk_key(sha))
+            return 0
+        except ClientError:
+            pass
+        with open(local, 'rb') as f:
+            f.seek(offset)
+            body = f.read(size)
+        self.s3cl.put_object(Bucket = self.bucket, Key = deltasync.chunk_key(sha), Body = body)
+        self.throttle(size)
+        return size
+
+    def download_delta(self, key, local, manifest = None):
+        """
+        Assemble a local file from its delta manifest at key.  Chunks found in
+        the current local file are copied from it, the others are downloaded.
+
+        Args:
+            manifest (dict): the manifest if it was downloaded already.
+        """
+        with self.phase('transfer'), self.tracer.span('download', 'transfer', key = key,
+                                                      codec = deltasync.DELTA_CODEC):
+            if manifest is None:
+                manifest = self.get_manifest(key)
+            have = {}
+            if os.path.isfile(local):
+                with self.tracer.span('chunk', 'hash', path = local):
+                    for sha, offset, size in deltasync.file_chunks(local):
+                        have.setdefault(sha, offset)
+
+            downloaded = 0
+            reused = 0
+            tmp = local + '.deon-tmp.' + str(os.getpid())
+            old = open(local, 'rb') if have else None
+            try:
+                with open(tmp, 'wb') as f:
+                    for sha, size in manifest['chunks']:
+                        if sha in have:
+                            old.seek(have[sha])
+                            data = old.read(size)
+                            reused += size
+                        else:
+                            data = self.read_object(
+                                lambda client, cached: client.get_object(
+                                    Bucket = self.bucket,
+                                    Key = deltasync.chunk_key(sha))['Body'].read())
+                            self.throttle(size)
+                            if hashlib.sha256(data).hexdigest() != sha:
+                                raise IOError('corrupt chunk ' + deltasync.chunk_key(sha))
+                            downloaded += size
+                        f.write(data)
+            except BaseException:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                raise
+            finally:
+                if old is not None:
+                    old.close()
+            ## replaces the entry only, local may be a hardlink into the
+            ## object store
+            os.replace(tmp, local)
+            self.logger.info("download: " + key + " to " + local + " (delta, "
+                             + str(downloaded) + " new bytes, " + str(reused)
+                             + " bytes reused)")
+            self.stats.add('transfer', files = 1, nbytes = manifest['size'])
+            self.stats.transfer('downloaded', files = 1, nbytes = downloaded)
+            self.stats.transfer('delta_reused', nbytes = reused)
+
+    def index_copy_sources(self, remote, needs_sync):
+        """
+        Index existing s3 objects by content so pending uploads with the same
+        content can be copied server side.
+
+        Args:
+            remote (OrderedDict): s3 listing, {'s3key/path': {'ETag':'###', 'Size':...}}
+            needs_sync (OrderedDict): keys about to be uploaded, these are
+                                      excluded as sources since they are
+                                      about to be overwritten.
+
+        Returns:
+            (dict): {(ETag, size): 's3key/path'}, size is a string as in the
+                    local metadata.
+        """
+        sources = {}
+        if not remote:
+            return sources
+        for k, v in remote.items():
+            if k.endswith('/') or k in needs_sync or not v.get('Size'):
+                continue
+            sources.setdefault((v['ETag'].replace('"', ''), str(v['Size'])), k)
+        return sources
+
+    def copy_object(self, source, key, meta, size):
+        """
+        Server side copy of an s3 object to a new key with new metadata.
+
+        Objects larger than PART_SIZE are copied as a managed multipart copy
+        with the same part size as uploads, so the resulting ETag still
+        matches the local md5.
+
+        Args:
+            source (str): s3 key to copy from.
+            key (str): s3 key to copy to.
+            meta (dict): 'Metadata' and 'ContentType' for the new object.
+            size (int): object size in bytes.
+        """
+        self.logger.info("copy: " + source + " to " + key)
+        copy_source = {'Bucket': self.bucket, 'Key': source}
+        extra_args = dict(meta, MetadataDirective = 'REPLACE')
+        with self.phase('transfer'), self.tracer.span('copy', 'transfer', key = key, source = source):
+            if size < PART_SIZE:
+                self.s3cl.copy_object(Bucket = self.bucket, Key = key,
+                                      CopySource = copy_source, **extra_args)
+            else:
+                self.s3cl.copy(copy_source, self.bucket, key,
+                               ExtraArgs = extra_args,
+                               Config = self.transfer_config)
+            self.stats.add('transfer', files = 1)
+            self.stats.transfer('copied', files = 1, nbytes = size)
+
     def sync_file_toS3(self, force = False, show_progress = True):
         """
         Sync a local file with to an s3 bucket.
@@ -729,70 +2019,135 @@ class SmartS3Sync():
 
         key = self.s3path.split('/', 1)[1] + self.local.rsplit('/', 1)[1]
 
+        local_file_dict[key] = util.dzip_meta(key = self.local, md5sum = False)
         if force:
-            local_file_dict[key] = util.dzip_meta(key = self.local, md5sum = True)
+            local_file_dict = self.compute_etags(local_file_dict, localcache = False)
             ## force an upload of all files
             needs_sync = local_file_dict
+            matches = None
             self.logger.warning('using force, ignoring local cache and s3 '
                                 'bucket contents, uploading all files')
 
         else:
-            if self.localcache:
-                local_file_dict[key] = util.dzip_meta(key = self.local, md5sum = False)
-                self.logger.info('checking local cache...')
-                local_file_dict = self.check_localcache(local_file_dict)
-            else:
-                local_file_dict[key] = util.dzip_meta(key = self.local, md5sum = True)
+            local_file_dict = self.compute_etags(local_file_dict)
 
             self.logger.debug('paginate (queryS3) bucket')
             matches = self.queryS3(key, local_file_dict)
+            self.resolve_plain_etags(matches, local_file_dict)
 
             self.logger.debug('comparing etags (md5sum)')
             needs_sync = self.compare_etag(local_file_dict, matches)
 
+        if needs_sync:
+            needs_sync = self.drop_slim(needs_sync)
         if needs_sync:
             ## verify the s3path
             self.verify_keys(keys = self.keys)
 
-            metajson = get_metajson(self.local)
+            meta, metajson = self.upload_meta(local_file_dict[key])
 
-            with open(self.local, 'rb') as f:
-                meta = {}
-                ## load the magic file() function
-                m = magic.open(magic.MAGIC_NONE)
-                m_result = m.load()
-                meta['ContentType'] = m.file(self.local).split(';')[0]
-                meta['Metadata'] = local_file_dict[key].copy()
+            changes = []
+            try:
+                remote = self.upload_object(key, self.local, meta,
+                                            show_progress = show_progress,
+                                            etag = local_file_dict[key]['ETag'],
+                                            remote = matches.get(key) if matches else None)
+                changes.append(make_record(key, remote, metajson))
 
-                ## remove unneccesary metadata
-                rm_local_etag = meta['Metadata'].pop('ETag')
-                rm_local_path = meta['Metadata'].pop('local')
+            except ClientError as e:
+                self.logger.exception('upload failed')
 
-                add_metajson_to_metadata(meta, metajson)
+            self.verify_sync(needs_sync)
+            self.append_changes(changes)
+        else:
+            self.logger.info(self.local + ' is up to date.')
 
-                ## check for uid & gid
-                if self.uid:
-                    meta['Metadata']['uid'] = self.uid
-                if self.gid:
-                    meta['Metadata']['gid'] = self.gid
+    def repacked_copy(self, local):
+        """
+        Repack a copy of an hdf5 file to upload in its place, see deon.repack,
+        the file itself is left as it is.
 
-                try:
-                    self.logger.info("upload: " + self.local + " to " + key)
-                    if show_progress:
-                        self.s3cl.upload_fileobj(f, self.bucket, key,
-                                        ExtraArgs = meta,
-                                        Callback = ProgressPercentage(self.local))
-                        sys.stderr.write('\n')
-                    else:
-                        self.s3cl.upload_fileobj(f, self.bucket, key,
-                                        ExtraArgs = meta)
+        Returns:
+            (str): path of the repacked copy, to be removed after the upload,
+                   None if the file is uploaded as it is.
+            (OrderedDict): the repack report, None if it wasn't repacked.
+        """
+        fd, tmp = tempfile.mkstemp(prefix = 'deon-repack-', suffix = os.path.splitext(local)[1])
+        os.close(fd)
+        with self.tracer.span('repack', 'file', path = local):
+            report = self.repacker.repack(local, dst = tmp)
+        if report is None or not report['repacked']:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return None, report
+        return tmp, report
+
+    def repack_source(self, key):
+        """ETag of the local file an object is a repacked copy of, None if it isn't one."""
+        try:
+            head = self.s3cl.head_object(Bucket = self.bucket, Key = key)
+        except ClientError:
+            return None
+        return head.get('Metadata', {}).get('repack-source')
 
-                except ClientError as e:
-                    self.logger.exception('upload failed')
+    def repack_files(self, needs_sync, remote = None, rehash = False):
+        """
+        Repack copies of the hdf5 files about to be uploaded and set their
+        ETag to the copy's, the copies are uploaded in place of the files
+        with the ETag of the file as 'repack-source' metadata.  Files whose
+        object is a repacked copy of them already, or is the same as their
+        copy, are dropped from needs_sync, and their object's ETag is
+        recorded in the local cache and the quick stats so later syncs match
+        them without a lookup.
 
-            self.verify_sync(needs_sync)
-        else:
-            self.logger.info(self.local + ' is up to date.')
+        Args:
+            rehash (boolean): hash the files again, the ETags of a resumed
+                              plan are the ones of their copies.
+        """
+        reports = []
+        cached = OrderedDict()
+        with self.phase('repack'):
+            for k, v in list(needs_sync.items()):
+                if k.endswith('/'):
+                    continue
+                if rehash:
+                    v['ETag'] = self.local_etag(v['local'])
+                source = v['ETag'].replace('"', '')
+                if remote and k in remote and self.repack_source(k) == source:
+                    del needs_sync[k]
+                    v['ETag'] = remote[k]['ETag']
+                    cached[k] = v
+                    continue
+                tmp, report = self.repacked_copy(v['local'])
+                if report is not None:
+                    reports.append(report)
+                if tmp is None:
+                    continue
+                v['ETag'] = self.local_etag(tmp)
+                if remote and k in remote and \
+                        remote[k]['ETag'].replace('"', '') == v['ETag'].replace('"', ''):
+                    del needs_sync[k]
+                    os.remove(tmp)
+                    cached[k] = v
+                else:
+                    self.repacked[k] = (tmp, source)
+            repacked = [r for r in reports if r['repacked']]
+            self.stats.add('repack', files = len(repacked),
+                           nbytes = sum(r['bytes'][1] for r in repacked))
+        if self.quick:
+            for k, v in cached.items():
+                self.add_quick_stat(k, remote[k], v['size'], v['mtime'])
+        if self.fingerprint is None:
+            self.update_localcache(cached)
+        if reports:
+            self.logger.info('repacked ' + format_report(summarize(reports)))
+
+    def clear_repacked(self):
+        """Remove the repacked copies that are left."""
+        while self.repacked:
+            k, (tmp, source) = self.repacked.popitem()
+            if os.path.exists(tmp):
+                os.remove(tmp)
 
     def sync_dir_toS3(self, force = False, show_progress = True):
         """
@@ -814,37 +2169,57 @@ class SmartS3Sync():
             s3LocalDirAndFileKeys.update({k:v})
 
 
-        if force:
-            ## force an upload of all files
+        journal = None
+        resumed = self.resume_journal('up')
+        if resumed is not None:
+            journal, planned, needs_sync, extra = resumed
+            self.refresh_journaled(planned, needs_sync)
+            matches = None
 
-            for k,v in s3LocalDirAndFileKeys.items():
-                s3LocalDirAndFileKeys[k]['ETag'] = utility.md5(s3LocalDirAndFileKeys[k]['local'])
+        elif force:
+            ## force an upload of all files
+            s3LocalDirAndFileKeys = self.compute_etags(s3LocalDirAndFileKeys,
+                                                       localcache = False)
             needs_sync = s3LocalDirAndFileKeys
+            matches = None
             self.logger.warning('using force, ignoring local cache and s3 '
                                 'bucket contents, uploading all files')
 
         else:
-            if self.localcache:
-                self.logger.info('checking local cache...')
-                s3LocalDirAndFileKeys = self.check_localcache(s3LocalDirAndFileKeys)
-            else:
-               for k,v in s3LocalDirAndFileKeys.items():
-                   s3LocalDirAndFileKeys[k]['ETag'] = utility.md5(s3LocalDirAndFileKeys[k]['local'])
-
             self.logger.debug('paginate (queryS3) bucket')
             ## paginate bucket
             matches = self.queryS3(self.s3path[len(self.bucket) + 1:],
                                  s3LocalDirAndFileKeys)
+            s3LocalDirAndFileKeys = self.compute_etags(s3LocalDirAndFileKeys,
+                                                       remote = matches)
+            self.resolve_plain_etags(matches, s3LocalDirAndFileKeys)
 
             self.logger.debug('comparing etags (md5sum)')
             needs_sync = self.compare_etag(s3LocalDirAndFileKeys, matches)
+            self.learn_quick_stats(s3LocalDirAndFileKeys, matches)
+
+        if needs_sync and journal is None:
+            needs_sync = self.drop_slim(needs_sync)
+        if needs_sync and self.repacker is not None:
+            self.repack_files(needs_sync, matches, rehash = journal is not None)
 
         if needs_sync:
             ## verify the s3path
             self.verify_keys(keys = self.keys)
 
+            ## objects already in the bucket, by content, that can be copied
+            ## server side instead of uploading the same bytes again
+            if force or matches is None:
+                copy_sources = {}
+            else:
+                copy_sources = self.index_copy_sources(matches, needs_sync)
+
+            if journal is None:
+                planned = needs_sync
+                journal = self.start_journal('up', planned)
+
             ## complete sync
-            for k, v in needs_sync.items():
+            def sync_key(k, v):
                 meta = {}
                 m = magic.open(magic.MAGIC_NONE)
                 m_result = m.load()
@@ -852,6 +2227,8 @@ class SmartS3Sync():
 
                 ## copy v becuase intact dict is needed to verify sync
                 meta['Metadata'] = v.copy()
+                if is_fingerprint(v.get('ETag')):
+                    meta['Metadata']['fingerprint'] = v['ETag']
 
 
                 ## check for uid & gid
@@ -860,29 +2237,59 @@ class SmartS3Sync():
                 if self.gid:
                     meta['Metadata']['gid'] = self.gid
 
-                if not k.endswith('/'):
-                    with open(v['local'], 'rb') as f:
-                        self.logger.info("upload: " + v['local'] + " to "+ k)
-
-                        l = v['local']
-
-                        ## remove unneccesary metadata
-                        rm_local_etag = meta['Metadata'].pop('ETag')
-                        rm_local_path = meta['Metadata'].pop('local')
-
-                        metajson = get_metajson(v['local'])
-                        add_metajson_to_metadata(meta, metajson)
-                        self.logger.debug("found metajson")
-                        self.logger.debug(metajson)
-
-                        if show_progress:
-                            self.s3cl.upload_fileobj(f, self.bucket, k,
-                                         ExtraArgs = meta,
-                                         Callback = ProgressPercentage(l))
-                            sys.stderr.write('\n')
-                        else:
-                            self.s3cl.upload_fileobj(f, self.bucket, k,
-                                         ExtraArgs = meta)
+                ## a repacked copy is uploaded in place of the file
+                tmp, repack_source = self.repacked.get(k, (None, None))
+                path = tmp or v['local']
+                size = v['size']
+                if tmp is not None:
+                    size = str(os.path.getsize(tmp))
+                    meta['Metadata']['size'] = size
+                    meta['Metadata']['repack-source'] = repack_source
+                source = copy_sources.get((v['ETag'].replace('"', ''), size))
+                if not k.endswith('/') and source:
+                    ## remove unneccesary metadata
+                    rm_local_etag = meta['Metadata'].pop('ETag')
+                    rm_local_path = meta['Metadata'].pop('local')
+
+                    add_metajson_to_metadata(meta, self.metajson(v['local']))
+                    ## a compressed source stays compressed, plain-etag is
+                    ## its md5sum in fingerprint mode too
+                    stored = matches[source].get('StoredETag')
+                    plain = v['ETag']
+                    if is_fingerprint(plain):
+                        plain = stored
+                        if matches[source].get('Codec'):
+                            plain = self.load_codec_etags().get(stored.replace('"', ''),
+                                                                [stored])[0]
+                    if matches[source].get('Codec'):
+                        meta['Metadata']['codec'] = matches[source]['Codec']
+                        meta['Metadata']['plain-etag'] = plain.replace('"', '')
+                    self.copy_object(source, k, meta,
+                                     int(matches[source].get('StoredSize') or size))
+                    remote = with_fingerprint({'ETag': plain, 'Size': size,
+                                               'Codec': matches[source].get('Codec'),
+                                               'StoredETag': stored}, meta)
+                    if self.quick:
+                        self.add_quick_stat(k, remote, v['size'], v['mtime'])
+                    return make_record(k, remote, meta['Metadata']['metajson'])
+
+                elif not k.endswith('/'):
+                    ## remove unneccesary metadata
+                    rm_local_etag = meta['Metadata'].pop('ETag')
+                    rm_local_path = meta['Metadata'].pop('local')
+
+                    metajson = self.metajson(v['local'])
+                    add_metajson_to_metadata(meta, metajson)
+                    self.logger.debug("found metajson")
+                    self.logger.debug(metajson)
+
+                    remote = self.upload_object(k, path, meta,
+                                                show_progress = show_progress,
+                                                etag = v['ETag'],
+                                                remote = matches.get(k) if matches else None)
+                    if self.quick:
+                        self.add_quick_stat(k, remote, v['size'], v['mtime'])
+                    return make_record(k, remote, metajson)
 
                 else:
 
@@ -896,13 +2303,23 @@ class SmartS3Sync():
                         self.logger.exception("exiting")
                         sys.exit()
 
-            self.verify_sync(needs_sync)
+            try:
+                changes = self.run_tasks(self.transfer_tasks(needs_sync, sync_key, journal))
+            finally:
+                self.clear_repacked()
+            self.finish_journal(journal, self.verify_sync(planned))
+            self.save_quick_stats()
+            self.append_changes([c for c in changes if c])
         else:
+            if journal is not None:
+                self.finish_journal(journal, self.verify_sync(planned) if planned else None)
             self.logger.info('S3 bucket is up to date')
 
 
     def sync_files_fromS3(self, force = False, show_progress = True):
         """self.local is a list of files"""
+        if self.datasets:
+            return self.sync_slim_fromS3(force = force, files = self.local)
         utility = S3SyncUtility()
 
         s3localdirkeys = self.walk.toS3Keys(self.walk.root, self.s3path)
@@ -917,19 +2334,14 @@ class SmartS3Sync():
             self.logger.debug('updating dict with s3 keys ' + k + ':' + str(v))
             s3LocalDirAndFileKeys.update({k:v})
 
-        if self.localcache:
-            self.logger.info('checking local cache...')
-            s3LocalDirAndFileKeys = self.check_localcache(s3LocalDirAndFileKeys)
-        else:
-           for k,v in s3LocalDirAndFileKeys.items():
-               self.logger.debug('not using localcache, calculating md5 sum now for "' + v['local'] + '"')
-               s3LocalDirAndFileKeys[k]['ETag'] = utility.md5(s3LocalDirAndFileKeys[k]['local'])
-               self.logger.debug(s3LocalDirAndFileKeys[k]['ETag'])
-
         self.logger.debug('paginate (queryS3) bucket')
         ## paginate bucket
         all_s3_objects= self.queryS3(self.s3path[len(self.bucket) + 1:],
                                      return_all_objects = True)
+        s3LocalDirAndFileKeys = self.compute_etags(s3LocalDirAndFileKeys,
+                                                   remote = None if force else all_s3_objects)
+        self.resolve_plain_etags(all_s3_objects, None if force else s3LocalDirAndFileKeys,
+                                 fromS3 = True)
 
         if force: # check tags
             self.logger.debug('force: syncing all files')
@@ -937,10 +2349,11 @@ class SmartS3Sync():
         else:
             self.logger.debug('comparing etags (md5sum)')
             needs_sync = self.compare_etag(s3LocalDirAndFileKeys, all_s3_objects, fromS3 = True)
+            self.learn_quick_stats(s3LocalDirAndFileKeys, all_s3_objects)
 
         if needs_sync:
             ## complete sync
-            for k, v in needs_sync.items():
+            def download_key(k, v):
                 v['local'] = str(self.bucket) + "/" + k
 
                 if not k.endswith('/'):
@@ -951,31 +2364,276 @@ class SmartS3Sync():
                     except FileExistsError as e:
                         self.logger.info('local directory already exists, skipping...')
 
-                    with open(v['local'], 'wb') as f:
-                        try:
-                            self.logger.info("download: " + k + " to "
-                                             + v['local'])
-
-
-                            self.s3cl.download_fileobj(
-                                    Bucket = self.bucket,
-                                    Key = k,
-                                    Fileobj= f)
+                    try:
+                        self.download_object(k, v['local'],
+                                             remote = all_s3_objects.get(k) if all_s3_objects else None)
 
-                        except ClientError as e:
-                            ## Access Denied, s3 permission error
-                            self.logger.exception("exiting")
-                            sys.exit()
+                    except ClientError as e:
+                        ## Access Denied, s3 permission error
+                        self.logger.exception("exiting")
+                        sys.exit()
 
+            self.run_tasks(self.transfer_tasks(needs_sync, download_key))
             self.verify_sync(needs_sync, fromS3 = True)
+            self.save_quick_stats()
         else:
             self.logger.info('local files are up to date')
 
 
+    def feed(self, cursor_name = 'cursor.json'):
+        """Changefeed of self.s3path, None if changefeeds are off."""
+        if not self.changefeed:
+            return None
+        return Changefeed(self.s3cl, self.bucket, self.s3path[len(self.bucket) + 1:],
+                          cursor_name = cursor_name)
+
+    def use_feed(self, feed, force = False):
+        """
+        Returns:
+            (dict): the feed cursor if changes can be read from the feed,
+                    None if a full listing is needed (no cursor yet, force,
+                    --reconcile or the reconcile interval passed).
+        """
+        if feed is None:
+            return None
+        cursor = feed.load_cursor()
+        if force or self.reconcile or feed.needs_reconcile(cursor):
+            self.logger.info('reconciling changefeed of ' + self.s3path
+                             + ' with a full listing')
+            return None
+        return cursor
+
+    def append_changes(self, changes):
+        """
+        Append change records of a sync to the changefeeds of the synced
+        prefix and its parent prefixes.
+        """
+        if not self.changefeed or not changes:
+            return
+        for prefix in [''] + list(self.keys):
+            feed = Changefeed(self.s3cl, self.bucket, prefix)
+            feed.append([c for c in changes if c['Key'].startswith(prefix)])
+
+    def read_changes(self, feed, cursor):
+        """
+        Read new change records of the feed as listing entries under
+        self.s3path, in the form of resolve_plain_etags.
+        """
+        prefix = self.s3path[len(self.bucket) + 1:]
+        with self.phase('list'):
+            records, new_cursor = feed.read(cursor)
+        remote = OrderedDict()
+        for k, r in records.items():
+            if not k.startswith(prefix) or k.endswith('/'):
+                continue
+            entry = dict(r, StoredETag = r.get('StoredETag', r['ETag']))
+            if r.get('Codec'):
+                self.add_codec_etag(entry['StoredETag'], r['ETag'], r['Size'], r['Codec'])
+            if r.get('Fingerprint'):
+                if self.fingerprint is not None:
+                    entry['ETag'] = r['Fingerprint']
+                else:
+                    del entry['Fingerprint']
+            remote[k] = entry
+        self.save_codec_etags()
+        self.stats.add('list', files = len(remote))
+        self.logger.info(str(len(remote)) + ' changes in the changefeed of ' + self.s3path)
+        return remote, new_cursor
+
+    def sync_changes_fromS3(self, feed, cursor):
+        """
+        Sync a local directory with the changes recorded in the changefeed
+        since the cursor, without listing the prefix.
+        """
+        utility = S3SyncUtility()
+        prefix = self.s3path[len(self.bucket) + 1:]
+        remote, new_cursor = self.read_changes(feed, cursor)
+
+        local = OrderedDict()
+        for k in remote:
+            path = os.path.join(self.local, k[len(prefix):])
+            if os.path.isfile(path):
+                local[k] = utility.dzip_meta(key = path)
+        local = self.compute_etags(local, remote = remote)
+        needs_sync = self.compare_etag(remote, local, fromS3 = True)
+        self.learn_quick_stats(local, remote)
+
+        def download_key(k, v):
+            v['local'] = os.path.join(self.local, k[len(prefix):])
+            os.makedirs(os.path.dirname(v['local']) or '.', exist_ok = True)
+            try:
+                self.download_object(k, v['local'], remote = v)
+            except ClientError as e:
+                ## Access Denied, s3 permission error
+                self.logger.exception("exiting")
+                sys.exit()
+
+        self.run_tasks(self.transfer_tasks(needs_sync, download_key))
+
+        if needs_sync:
+            ## verify against the records, the prefix is not listed
+            self.logger.info('verifying sync')
+            with self.phase('verify'):
+                self.stats.add('verify', files = len(needs_sync))
+                synced = OrderedDict((k, utility.dzip_meta(key = v['local']))
+                                     for k, v in needs_sync.items())
+                synced = self.compute_etags(synced, localcache = False)
+                faulty_syncs = self._compare_etag(needs_sync, synced, True)
+            if faulty_syncs:
+                for k, v in faulty_syncs.items():
+                    self.logger.error('bad download: ' + v['local'])
+                return
+            self.logger.info('sync verified')
+        else:
+            self.logger.info('local directory "' + self.local + '" is up to date with s3://"'+ self.s3path +'"')
+        feed.save_cursor(new_cursor)
+
+    def journal(self, direction):
+        cache_dir = self.localcache_dir or os.path.join(os.environ.get('HOME'), '.s3sync')
+        return SyncJournal(os.path.join(cache_dir, journal_name(direction, self.s3path,
+                                                                self.local, self.shard)))
+
+    def resume_journal(self, direction):
+        """
+        The journal of an interrupted sync, with --resume.
+
+        Returns:
+            (tuple): journal, planned items, pending items and the extra
+                     state of the plan, None to plan a new sync.
+        """
+        journal = self.journal(direction)
+        if not journal.exists():
+            if self.resume:
+                self.logger.info('no interrupted sync of ' + self.s3path + ' to resume')
+            return None
+        if not self.resume:
+            self.logger.warning('an earlier sync of ' + self.s3path + ' was interrupted, '
+                                'planning a new one, --resume continues it instead')
+            return None
+        plan, pending = journal.load()
+        if plan is None:
+            self.logger.warning('journal ' + journal.path + ' is unreadable, planning a new sync')
+            return None
+        self.logger.info('resuming sync of ' + self.s3path + ', ' + str(len(pending))
+                         + ' of ' + str(len(plan['items'])) + ' keys left')
+        return journal, plan['items'], pending, plan['extra']
+
+    def start_journal(self, direction, items, extra = None):
+        journal = self.journal(direction)
+        journal.start(direction, self.s3path, self.local, items, extra)
+        return journal
+
+    def transfer_tasks(self, needs_sync, task, journal = None):
+        """
+        Per-key tasks of a transfer, reported to the progress reporter and
+        recorded in the journal if there is one.
+
+        Args:
+            needs_sync (OrderedDict): keys to transfer.
+            task (function): task(key, value) transfers a key.
+        """
+        sizes = OrderedDict((k, int(v.get('Size', v.get('size')) or 0))
+                            for k, v in needs_sync.items())
+        self.progress.plan(len(sizes), sum(sizes.values()))
+        tasks = []
+        for k, v in needs_sync.items():
+            t = functools.partial(task, k, v)
+            if journal is not None:
+                t = functools.partial(self.journaled, journal, k, t)
+            tasks.append(functools.partial(self.tracked, k, sizes[k], t))
+        return tasks
+
+    def tracked(self, key, nbytes, task):
+        """Run a transfer task as an active transfer of the progress reporter."""
+        self.progress.begin(key)
+        try:
+            return task()
+        finally:
+            self.progress.finish(key, nbytes)
+
+    def journaled(self, journal, key, task):
+        """Run a transfer task and record it as done."""
+        result = task()
+        journal.done(key)
+        return result
+
+    def finish_journal(self, journal, faulty_syncs):
+        """Remove the journal of a verified sync, keep failed keys for --resume."""
+        if faulty_syncs:
+            journal.redo(faulty_syncs)
+            journal.close()
+            self.logger.error(str(len(faulty_syncs)) + ' keys failed verification, '
+                              '--resume retries them')
+        else:
+            journal.remove()
+
+    def refresh_journaled(self, planned, pending):
+        """
+        Hash the pending files of a resumed upload again if they changed
+        since they were planned, drop the ones that were removed.
+        """
+        utility = S3SyncUtility()
+        for k, v in list(pending.items()):
+            if k.endswith('/'):
+                continue
+            if not os.path.isfile(v['local']):
+                self.logger.warning(v['local'] + ' was removed since the sync was planned')
+                del pending[k]
+                del planned[k]
+                continue
+            meta = utility.dzip_meta(v['local'])
+            if meta['size'] != v['size'] or meta['mtime'] != v['mtime']:
+                v.update(meta)
+                v['ETag'] = self.local_etag(v['local'])
+
+    def shard_keys(self, keys):
+        """Keys of self.shard, all keys if the sync is not sharded."""
+        if self.shard is None or keys is None:
+            return keys
+        return OrderedDict((k, v) for k, v in keys.items() if in_shard(k, self.shard))
+
+    def shard_markers(self):
+        return ShardMarkers(self.bucket, self.s3path[len(self.bucket) + 1:], self.shard[1])
+
+    def shard_totals(self, listing):
+        """
+        Returns:
+            (tuple): files and bytes of the listed objects of the shard.
+        """
+        files = [v for k, v in (listing or {}).items() if not k.endswith('/')
+                 and not k.startswith(deltasync.CHUNK_PREFIX) and not is_feed_key(k)]
+        return len(files), sum(int(v['Size']) for v in files)
+
+    def complete_shard(self, digest, files, nbytes):
+        """Write the completion marker of self.shard."""
+        self.shard_markers().complete(self.shard[0], digest, files = files, nbytes = nbytes)
+        self.logger.info('shard ' + str(self.shard[0]) + '/' + str(self.shard[1])
+                         + ' of s3://' + self.s3path + ' complete')
+
     def sync_dir_fromS3(self, force = False, show_progress = True):
-        if force:
-            needs_sync = self.queryS3(self.s3path[len(self.bucket) + 1:],
-                                 return_all_objects = True)
+        resumed = self.resume_journal('down')
+        ## a sharded sync only covers part of the prefix, it lists the
+        ## prefix and leaves the changefeed cursor alone, so does a resumed
+        ## sync of an earlier listing
+        feed = self.feed() if self.shard is None and resumed is None else None
+        cursor = self.use_feed(feed, force)
+        if cursor is not None:
+            return self.sync_changes_fromS3(feed, cursor)
+        started = time.time()
+        if self.shard is not None:
+            self.shard_markers().clear(self.shard[0])
+
+        journal = None
+        if resumed is not None:
+            journal, planned, needs_sync, extra = resumed
+            digest, totals = extra.get('digest'), extra.get('totals')
+
+        elif force:
+            all_s3_objects = self.queryS3(self.s3path[len(self.bucket) + 1:],
+                                          return_all_objects = True)
+            digest = listing_digest(all_s3_objects)
+            all_s3_objects = needs_sync = self.shard_keys(all_s3_objects)
+            self.resolve_plain_etags(needs_sync, fromS3 = True)
             self.logger.warning('using force, ignoring local cache and will '
                                 + 'download all objects from bucket path')
         else:
@@ -1002,29 +2660,36 @@ class SmartS3Sync():
                 self.logger.debug('updating dict with s3 keys ' + k + ':' + str(v))
                 s3LocalDirAndFileKeys.update({k:v})
 
-            if self.localcache:
-                self.logger.info('checking local cache...')
-                s3LocalDirAndFileKeys = self.check_localcache(s3LocalDirAndFileKeys)
-            else:
-               for k,v in s3LocalDirAndFileKeys.items():
-                   self.logger.debug('not using localcache, calculating md5 sum now for "' + v['local'] + '"')
-                   s3LocalDirAndFileKeys[k]['ETag'] = utility.md5(s3LocalDirAndFileKeys[k]['local'])
-                   self.logger.debug(s3LocalDirAndFileKeys[k]['ETag'])
-
             self.logger.debug('paginate (queryS3) bucket')
             ## paginate bucket
             all_s3_objects= self.queryS3(self.s3path[len(self.bucket) + 1:],
                                          return_all_objects = True)
+            digest = listing_digest(all_s3_objects)
+            all_s3_objects = self.shard_keys(all_s3_objects)
+
+            s3LocalDirAndFileKeys = self.compute_etags(self.shard_keys(s3LocalDirAndFileKeys),
+                                                       remote = all_s3_objects)
+            self.resolve_plain_etags(all_s3_objects, s3LocalDirAndFileKeys, fromS3 = True)
 
             self.logger.debug('comparing etags (md5sum)')
 
             needs_sync = self.compare_etag(all_s3_objects, s3LocalDirAndFileKeys, fromS3 = True)
+            self.learn_quick_stats(s3LocalDirAndFileKeys, all_s3_objects)
+
+        if resumed is None:
+            totals = self.shard_totals(all_s3_objects) if self.shard is not None else None
+
+        ## directory keys are never downloaded, don't let them trigger a
+        ## verification listing, delta chunks are part of other files
+        if needs_sync and resumed is None:
+            needs_sync = OrderedDict((k, v) for k, v in needs_sync.items()
+                                     if not k.endswith('/')
+                                     and not k.startswith(deltasync.CHUNK_PREFIX)
+                                     and not is_feed_key(k))
         if needs_sync:
 
             ## complete sync
-            for k, v in needs_sync.items():
-                v['local'] = os.path.join(self.local, k[len(self.s3path[len(self.bucket) + 1:]):])
-
+            def download_key(k, v):
                 if not k.endswith('/'):
                     try:
                         self.logger.info('making local directory '
@@ -1033,25 +2698,119 @@ class SmartS3Sync():
                     except FileExistsError as e:
                         self.logger.info('local directory already exists, skipping...')
 
-                    with open(v['local'], 'wb') as f:
-                        try:
-                            self.logger.info("download: " + k + " to "
-                                             + v['local'])
-
-
-                            self.s3cl.download_fileobj(
-                                    Bucket = self.bucket,
-                                    Key = k,
-                                    Fileobj= f)
+                    try:
+                        self.download_object(k, v['local'], remote = v)
 
-                        except ClientError as e:
-                            ## Access Denied, s3 permission error
-                            self.logger.exception("exiting")
-                            sys.exit()
+                    except ClientError as e:
+                        ## Access Denied, s3 permission error
+                        self.logger.exception("exiting")
+                        sys.exit()
 
-            self.verify_sync(needs_sync, fromS3 = True)
+            if journal is None:
+                for k, v in needs_sync.items():
+                    v['local'] = os.path.join(self.local,
+                                              k[len(self.s3path[len(self.bucket) + 1:]):])
+                planned = needs_sync
+                journal = self.start_journal('down', planned,
+                                             extra = {'digest': digest, 'totals': totals})
+            self.run_tasks(self.transfer_tasks(needs_sync, download_key, journal))
+            faulty_syncs = self.verify_sync(planned, fromS3 = True)
+        elif journal is not None and planned:
+            faulty_syncs = self.verify_sync(planned, fromS3 = True)
         else:
+            faulty_syncs = None
             self.logger.info('local directory "' + self.local + '" is up to date with s3://"'+ self.s3path +'"')
+        if feed is not None:
+            feed.reconciled(started)
+        if journal is not None:
+            self.finish_journal(journal, faulty_syncs)
+        if self.shard is not None and not faulty_syncs:
+            self.complete_shard(digest, *totals)
+
+    def sync_slim_fromS3(self, force = False, files = None):
+        """
+        Download slim hdf5 files with only self.datasets, see deon.slim,
+        other files as usual.  A slim file is up to date if it was made from
+        the listed version of its object with the same datasets, a complete
+        local file if its ETag matches.
+
+        Args:
+            files (list): local paths <bucket>/<key> to download, default
+                          the files under self.s3path.
+        """
+        utility = S3SyncUtility()
+        prefix = self.s3path[len(self.bucket) + 1:]
+        remote = self.shard_keys(self.queryS3(prefix, return_all_objects = True)) or OrderedDict()
+        if files is not None:
+            paths = OrderedDict(("/".join(Path(f).parts[1:]), f) for f in files)
+        elif self.s3path.endswith('/'):
+            paths = OrderedDict((k, os.path.join(self.local, k[len(prefix):])) for k in remote
+                                if not k.endswith('/')
+                                and not k.startswith(deltasync.CHUNK_PREFIX)
+                                and not is_feed_key(k))
+        else:
+            paths = OrderedDict([(prefix, self.local)])
+        for k in [k for k in paths if k not in remote]:
+            self.logger.warning(k + ' is not in s3')
+            del paths[k]
+        ## only the requested keys, resolving the others could head them all
+        remote = OrderedDict((k, remote[k]) for k in paths)
+
+        ## slim files are compared by the ETag they were made from, complete
+        ## local files by their own
+        slim = OrderedDict()
+        full = OrderedDict()
+        todo = set()
+        for k, path in paths.items():
+            info = slim_info(path) if is_hdf5_key(k) else None
+            if force or (info is not None and info['datasets'] != self.datasets):
+                todo.add(k)
+            elif info is not None:
+                slim[k] = info
+            elif os.path.isfile(path):
+                full[k] = utility.dzip_meta(path)
+            else:
+                todo.add(k)
+        full = self.compute_etags(full, remote = remote)
+        self.resolve_plain_etags(remote, full, fromS3 = True)
+        todo.update(k for k, info in slim.items()
+                    if info['ETag'] != remote[k]['ETag'].replace('"', ''))
+        todo.update(self.compare_etag(OrderedDict((k, remote[k]) for k in full), full,
+                                      fromS3 = True))
+        self.learn_quick_stats(full, remote)
+        needs_sync = OrderedDict((k, remote[k]) for k in paths if k in todo)
+
+        if not needs_sync:
+            self.logger.info('slim files of s3://' + self.s3path + ' are up to date')
+            return
+
+        def download_key(k, v):
+            os.makedirs(os.path.dirname(paths[k]) or '.', exist_ok = True)
+            try:
+                if is_hdf5_key(k):
+                    self.download_slim(k, paths[k], v)
+                else:
+                    self.download_object(k, paths[k], remote = v)
+            except ClientError as e:
+                ## Access Denied, s3 permission error
+                self.logger.exception("exiting")
+                sys.exit()
+
+        self.run_tasks(self.transfer_tasks(needs_sync, download_key))
+        plain = OrderedDict((k, dict(v, local = paths[k])) for k, v in needs_sync.items()
+                            if not is_hdf5_key(k))
+        if plain:
+            self.verify_sync(plain, fromS3 = True)
+        self.save_quick_stats()
+
+    def drop_slim(self, needs_sync):
+        """Keys of needs_sync without slim files, which are never uploaded."""
+        slim = [k for k, v in needs_sync.items()
+                if not k.endswith('/') and slim_info(v['local']) is not None]
+        for k in slim:
+            self.logger.warning('not uploading slim file ' + needs_sync[k]['local'])
+            del needs_sync[k]
+        return needs_sync
 
     def sync_metadata_fromS3(self, force = False, show_progress = True):
         self.logger.debug("Syncing metadata")
@@ -1064,6 +2823,12 @@ class SmartS3Sync():
         self.logger.debug("syncing metadata of dir: %s" % rel_sync_path)
         self.logger.debug("syncing metadata to: %s" % metadata_sync_path)
 
+        feed = self.feed(cursor_name = 'metadata_cursor.json')
+        cursor = self.use_feed(feed, force)
+        if cursor is not None:
+            return self.sync_metadata_changes_fromS3(feed, cursor, metadata_path / bucket_name)
+        started = time.time()
+
         if force:
             needs_sync = self.queryS3(self.s3path[len(self.bucket) + 1:],
                                  return_all_objects = True)
@@ -1100,7 +2865,7 @@ class SmartS3Sync():
         if needs_sync:
             ## complete sync
             for k, v in needs_sync.items():
-                if k.endswith('/'):
+                if k.endswith('/') or k.startswith(deltasync.CHUNK_PREFIX) or is_feed_key(k):
                     self.logger.debug("skipping dir %s", k)
                 else:
                     self.logger.debug("syncing header of key %s", k)
@@ -1117,6 +2882,30 @@ class SmartS3Sync():
                         f.write(json.dumps(metadata, indent=4))
         else:
             self.logger.info('local directory "' + self.local + '" is up to date with s3://"'+ self.s3path +'"')
+        if feed is not None:
+            feed.reconciled(started)
+
+    def sync_metadata_changes_fromS3(self, feed, cursor, metadata_bucket_path):
+        """
+        Write the metadata of objects in the changefeed since the cursor, from
+        the metajson of the change records, without listing the prefix or
+        requesting object headers.
+
+        Args:
+            metadata_bucket_path (Path): metadata/<bucket>
+        """
+        remote, new_cursor = self.read_changes(feed, cursor)
+        for k, r in remote.items():
+            if 'metajson' not in r:
+                continue
+            metadata = json.loads(r['metajson'])
+            metadata['ETag'] = '"' + r['StoredETag'] + '"'
+            metadata_filepath = Path(str(metadata_bucket_path / k) + ".json")
+            self.logger.debug("syncing header of key %s to local file %s", k, metadata_filepath)
+            metadata_filepath.parent.mkdir(parents=True, exist_ok=True)
+            with metadata_filepath.open('w') as f:
+                f.write(json.dumps(metadata, indent=4))
+        feed.save_cursor(new_cursor)
 
     def sync_file_fromS3(self, force = False, show_progress = True):
         """
@@ -1130,35 +2919,33 @@ class SmartS3Sync():
 
         if force:
             needs_sync = self.queryS3(key, return_all_objects = True, ) # fromS3 = True)
+            self.resolve_plain_etags(needs_sync, fromS3 = True)
             self.logger.warning('using force, ignoring local cache and s3 '
                                 'bucket contents, downloading all files')
 
         else:
-            if self.localcache:
+            if os.path.isfile(self.local):
                 local_file_dict[key] = util.dzip_meta(key = self.local, md5sum = False)
-                self.logger.info('checking local cache...')
-                local_file_dict = self.check_localcache(local_file_dict)
-            elif os.path.isfile(self.local):
-                local_file_dict[key] = util.dzip_meta(key = self.local, md5sum = True)
+                local_file_dict = self.compute_etags(local_file_dict)
             s3_content = self.s3cl.head_object(Bucket = self.bucket, Key = key)
+            meta = s3_content.get('Metadata', {})
+            if meta.get('codec') and meta.get('plain-etag'):
+                self.add_codec_etag(s3_content['ETag'], meta['plain-etag'],
+                                    meta.get('size', ''), meta['codec'])
 
             matches = OrderedDict({key:s3_content})
+            self.resolve_plain_etags(matches)
 
             self.logger.debug('comparing etags (md5sum)')
             needs_sync = self.compare_etag(matches, local_file_dict, ) # fromS3 = True)
 
         if needs_sync:
 
-            with open(self.local, 'wb') as f:
-                try:
-                    self.logger.info("download: " + key + " to " + self.local)
-
-                    self.s3cl.download_fileobj(Bucket = self.bucket,
-                                               Key = key,
-                                               Fileobj = f)
+            try:
+                self.download_object(key, self.local, remote = needs_sync.get(key))
 
-                except ClientError as e:
-                    self.logger.exception('download failed')
+            except ClientError as e:
+                self.logger.exception('download failed')
 
             self.verify_sync(needs_sync)
         else:
@@ -1173,22 +2960,35 @@ class SmartS3Sync():
         Args:
             just_synced (OrderedDict): items just synced to bucket.
 
+        Returns:
+            (OrderedDict): faulty syncs, empty if the sync is verified.
+
         OrderedDict structure:
         {'s3key/path': {'uid':'1000', 'Etag':'###', 'mode':'33204', etc...'}}
 
         """
 
         self.logger.info('verifying sync')
-        ## paginate bucket
-        matches = self.queryS3(self.s3path[len(self.bucket) + 1:],
-                                    just_synced)
-        faulty_syncs = self.compare_etag(just_synced, matches, fromS3 = fromS3)
+        with self.phase('verify'):
+            self.stats.add('verify', files = len(just_synced))
+            ## paginate bucket
+            matches = self.queryS3(self.s3path[len(self.bucket) + 1:],
+                                        just_synced)
+            self.resolve_plain_etags(matches, just_synced)
+            faulty_syncs = self._compare_etag(just_synced, matches, fromS3)
+            if fromS3 and self.fingerprint is not None:
+                ## fingerprint the downloaded files too, it's cheap
+                for k, v in just_synced.items():
+                    if (v.get('Fingerprint') and os.path.isfile(v.get('local', ''))
+                            and self.local_etag(v['local']) != v['Fingerprint']):
+                        faulty_syncs[k] = v
 
         if faulty_syncs:
             for k,v in faulty_syncs.items():
                 self.logger.error('bad upload: ' + v['local'])
         else:
             self.logger.info('sync verified')
+        return faulty_syncs
 
     def sync(self, interval = None, force = False, fromS3 = False, show_progress = True):
         """
@@ -1198,13 +2998,20 @@ class SmartS3Sync():
             interval (float): sync interval in minutes.
             force (boolean): force sync, ignore localcache.
             fromS3 (boolean): direction of sync.
-            show_progress (boolean): show sync progress.
+            show_progress (boolean): report the progress of the transfers,
+                                     unless a shared progress reporter is set.
         """
+        self.stats.label(direction = 'down' if fromS3 else 'up')
         autosync = True
         while autosync:
+            if self.shared_progress is None:
+                self.progress = get_progress(self.progress_mode) if show_progress else NullProgress()
+            self.progress.start()
             if fromS3:
                 self.logger.info('preparing to sync FROM S3')
-                if self.s3path.endswith('/'):
+                if self.datasets:
+                    self.sync_slim_fromS3(force = force)
+                elif self.s3path.endswith('/'):
                     self.sync_dir_fromS3(force = force,
                                          show_progress = show_progress)
                 else:
@@ -1224,6 +3031,20 @@ class SmartS3Sync():
                     self.logger.critical(self.local + 'is not a file or a '
                                          + 'directory!\n')
                     sys.exit()
+
+            self.save_quick_stats()
+            if self.shared_progress is None:
+                self.progress.close()
+
+            ## one report per sync
+            if self.stats.enabled:
+                self.last_report = self.stats.report()
+            self.stats.write()
+            self.stats.reset()
+            ## the trace holds the last sync, --interval mode runs forever
+            self.tracer.write()
+            self.tracer.reset()
+
             if not interval:
                 autosync = False
             else:
@@ -0,0 +1,151 @@
+"""
+Shared worker and bandwidth budget for concurrent syncs.
+
+FairScheduler runs the per-file tasks (uploads, downloads, copies) of several
+syncs on one pool of worker threads.  Every sync is a job with its own queue
+and free workers take the next task round robin over the jobs that have
+queued tasks, so a bucket with a million files gets the same share of
+workers as a bucket with ten.  An optional token bucket limits the bytes per
+second transferred by all jobs together.
+"""
+
+import time
+import threading
+import logging
+from collections import OrderedDict, deque
+
+
+class TokenBucket():
+
+    def __init__(self, rate, burst = None):
+        """
+        Args:
+            rate (float): bytes per second.
+            burst (float): bucket size in bytes, default one second of rate.
+        """
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, nbytes):
+        """Take nbytes tokens, sleeps while the bucket is in debt."""
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= nbytes
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class _Task():
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.result = self.fn()
+        except BaseException as e:
+            self.error = e
+        self.done.set()
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class FairScheduler():
+
+    def __init__(self, workers = 8, bandwidth = None):
+        """
+        Args:
+            workers (int): number of worker threads shared by all jobs.
+            bandwidth (float): bytes per second shared by all jobs, None for
+                               unlimited.
+        """
+        self.workers = workers
+        self.bucket = TokenBucket(bandwidth) if bandwidth else None
+        self.queues = OrderedDict()
+        self.next_job = 0
+        self.cond = threading.Condition()
+        self.closed = False
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.threads = []
+        for i in range(workers):
+            t = threading.Thread(target = self._worker, name = 'deon-worker-%d' % i)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def submit(self, job, fn):
+        """
+        Queue a task of a job.
+
+        Args:
+            job (str): job name, e.g. the s3path of a sync.
+            fn (callable): task without arguments.
+        """
+        task = _Task(fn)
+        with self.cond:
+            self.queues.setdefault(job, deque()).append(task)
+            self.cond.notify()
+        return task
+
+    def map(self, job, fns):
+        """
+        Run tasks of a job on the workers and wait for all of them.
+
+        Returns:
+            (list): results in the order of fns, the first error is raised
+                    once all tasks finished.
+        """
+        tasks = [self.submit(job, fn) for fn in fns]
+        for task in tasks:
+            task.done.wait()
+        return [task.wait() for task in tasks]
+
+    def throttle(self, nbytes):
+        """Account transferred bytes against the bandwidth budget."""
+        if self.bucket is not None and nbytes > 0:
+            self.bucket.consume(nbytes)
+
+    def _next(self):
+        ## round robin over jobs with queued tasks, called with self.cond held
+        jobs = list(self.queues)
+        for i in range(len(jobs)):
+            job = jobs[(self.next_job + i) % len(jobs)]
+            if self.queues[job]:
+                self.next_job = (self.next_job + i + 1) % len(jobs)
+                task = self.queues[job].popleft()
+                if not self.queues[job]:
+                    del self.queues[job]
+                    self.next_job = jobs.index(job) % max(1, len(jobs) - 1)
+                return task
+        return None
+
+    def _worker(self):
+        while True:
+            with self.cond:
+                task = self._next()
+                while task is None and not self.closed:
+                    self.cond.wait()
+                    task = self._next()
+                if task is None:
+                    return
+            task.run()
+
+    def shutdown(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        for t in self.threads:
+            t.join()
@@ -6,11 +6,24 @@
     "data_buckets": [
         {
             "bucket_name": ...,
+            "prefixes": [...],
+            "compression": ...,
+            "delta": ...,
+            "changefeed": ...,
+            "quick": ...,
+            "fingerprint": ...,
             "driver": ...,
+            "repack": ...,
             "schema": ...,
             "auth": ...
         }
     ],
+    "object_store": ...,
+    "cache_endpoint": ...,
+    "lazy_cache": {
+        "dir": ...,
+        "max_size": ...
+    },
     "aws_config": {}
 }
 """
@@ -0,0 +1,128 @@
+"""
+Sharded downloads across cluster nodes.
+
+With --shard i/N a download only syncs the keys whose hash falls into shard
+i of N (0 <= i < N), so N nodes syncing the same prefix into shared storage
+each transfer a disjoint slice.  The shard of a key only depends on the key
+and N, files keep their shard as the dataset grows.
+
+Every node writes a completion marker once its shard is synced and
+verified,
+
+    .deon/shards/<bucket>/<prefix>/<N>/<i>.done
+
+with a digest of the listing it synced against.  The collective sync is
+complete when all N markers exist and their digests agree, i.e. all nodes
+saw the same objects.  Markers are removed when a shard sync starts.
+"""
+
+import os
+import json
+import time
+import socket
+import hashlib
+from collections import OrderedDict
+
+MARKER_DIR = os.path.join('.deon', 'shards')
+
+
+def parse_shard(text):
+    """
+    Args:
+        text (str): 'i/N', e.g. '0/4'
+
+    Returns:
+        (tuple): (i, N)
+    """
+    try:
+        i, n = [int(x) for x in text.split('/')]
+    except ValueError:
+        raise ValueError('shard must be i/N, e.g. 0/4, got ' + str(text))
+    if n < 1 or not 0 <= i < n:
+        raise ValueError('shard i/N needs 0 <= i < N, got ' + str(text))
+    return i, n
+
+
+def shard_of(key, n):
+    return int(hashlib.md5(key.encode()).hexdigest()[:16], 16) % n
+
+
+def in_shard(key, shard):
+    """
+    Args:
+        shard (tuple): (i, N), None for all keys.
+    """
+    return shard is None or shard_of(key, shard[1]) == shard[0]
+
+
+def listing_digest(listing):
+    """
+    sha256 of the keys and ETags of an s3 listing, equal on all nodes that
+    listed the same objects.
+    """
+    h = hashlib.sha256()
+    for k in sorted(listing or {}):
+        h.update((k + '\t' + listing[k]['ETag'].replace('"', '') + '\n').encode())
+    return h.hexdigest()
+
+
+class ShardMarkers():
+
+    def __init__(self, bucket, prefix, shards, marker_dir = MARKER_DIR):
+        """
+        Args:
+            bucket (str): bucket name.
+            prefix (str): synced s3 prefix.
+            shards (int): N, number of shards.
+            marker_dir (str): marker directory, on the shared storage.
+        """
+        self.shards = shards
+        self.root = os.path.join(marker_dir, bucket, prefix, str(shards))
+
+    def path(self, i):
+        return os.path.join(self.root, str(i) + '.done')
+
+    def clear(self, i):
+        if os.path.exists(self.path(i)):
+            os.remove(self.path(i))
+
+    def complete(self, i, digest, files = 0, nbytes = 0):
+        """Write the marker of shard i."""
+        os.makedirs(self.root, exist_ok = True)
+        marker = OrderedDict([('shard', i), ('shards', self.shards), ('digest', digest),
+                              ('files', files), ('bytes', nbytes),
+                              ('host', socket.gethostname()), ('finished', time.time())])
+        tmp = self.path(i) + '.tmp.' + str(os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(marker, f, indent = 4)
+        os.replace(tmp, self.path(i))
+
+    def status(self):
+        """
+        Returns:
+            (OrderedDict): {i: marker or None}
+        """
+        markers = OrderedDict()
+        for i in range(self.shards):
+            try:
+                with open(self.path(i)) as f:
+                    markers[i] = json.load(f)
+            except (OSError, ValueError):
+                markers[i] = None
+        return markers
+
+    def is_complete(self, markers = None):
+        """
+        Returns:
+            (boolean): all shards finished against the same listing.
+            (str): reason if not.
+        """
+        markers = markers or self.status()
+        missing = [str(i) for i, m in markers.items() if m is None]
+        if missing:
+            return False, 'waiting for shards ' + ', '.join(missing)
+        digests = set(m['digest'] for m in markers.values())
+        if len(digests) > 1:
+            return False, ('shards synced different listings, the prefix changed '
+                           'during the sync, run the shards again')
+        return True, 'all ' + str(self.shards) + ' shards complete'
@@ -0,0 +1,199 @@
+"""
+Slim hdf5 files: downloads of selected datasets only.
+
+Image streams are most of the bytes of a trajectory, while many jobs only
+read the actions, states and metadata.  `deoncli down --datasets
+actions,states` (or sync_files_s3(files, datasets = [...])) opens each hdf5
+object through RangeFile, a read-only file object for h5py that fetches byte
+ranges with GetObject, and copies only the selected datasets into a local
+file:
+
+  - hdf5 structure (superblock, object headers, b-trees, heaps) is read in
+    aligned blocks of block_size bytes, which are kept, so a header next to
+    one already read costs nothing,
+  - a dataset's chunks, or its contiguous data, are read with one request
+    per read h5py makes, compressed chunks are copied without decompressing,
+  - every range request is conditional on the listed ETag, a file replaced
+    during the download fails instead of mixing two versions.
+
+A name selects the dataset at that path, or else every dataset with that
+name, or under a group with that name, at any depth.  The slim file keeps
+the attributes of the root, including the 'metadata' attribute published as
+metajson, of the groups on the way to each dataset and of the datasets, and
+records the ETag of its object and the selected names in the 'deon_slim'
+attribute, so a later download with the same names skips it.  Slim files are
+never uploaded.  Repacked files (deoncli up --repack) have their structure
+in a few pages and need the fewest requests.
+"""
+
+import os
+import json
+from collections import OrderedDict
+
+import h5py
+
+from deon.repack import BLOCK_SIZE, EXTENSIONS, copy_attrs
+
+## blocks of hdf5 structure kept per file, 64 MiB with the default block size
+MAX_BLOCKS = 256
+SLIM_ATTR = 'deon_slim'
+
+
+def is_hdf5_key(key):
+    return key.endswith(EXTENSIONS)
+
+
+def slim_info(fname):
+    """
+    Returns:
+        (dict): 'ETag', 'datasets' and 'paths' of a slim file, None if
+                fname is a complete file or not an hdf5 file.
+    """
+    if not is_hdf5_key(fname) or not os.path.isfile(fname):
+        return None
+    try:
+        with h5py.File(fname, 'r') as hf:
+            info = hf.attrs.get(SLIM_ATTR)
+    except OSError:
+        return None
+    return json.loads(info) if info is not None else None
+
+
+class RangeFile():
+    """Read-only file object for h5py reading an object by byte range."""
+
+    def __init__(self, read, size, block_size = BLOCK_SIZE, max_blocks = MAX_BLOCKS):
+        """
+        Args:
+            read (function): read(start, end) returns bytes [start, end) of
+                             the object.
+            size (int): object size.
+            block_size (int): size of the aligned blocks of small reads.
+            max_blocks (int): blocks kept, least recently used ones are
+                              dropped beyond it.
+        """
+        self.read_range = read
+        self.size = size
+        self.block_size = block_size
+        self.max_blocks = max_blocks
+        self.blocks = OrderedDict()
+        self.pos = 0
+        self.requests = 0
+        self.nbytes = 0
+
+    def fetch(self, start, end):
+        data = self.read_range(start, end)
+        self.requests += 1
+        self.nbytes += len(data)
+        return data
+
+    def seek(self, offset, whence = os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            self.pos = offset
+        elif whence == os.SEEK_CUR:
+            self.pos += offset
+        else:
+            self.pos = self.size + offset
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def readinto(self, buf):
+        view = memoryview(buf).cast('B')
+        n = max(0, min(len(view), self.size - self.pos))
+        if n == 0:
+            return 0
+        if n >= self.block_size:
+            ## data, read as is
+            view[:n] = self.fetch(self.pos, self.pos + n)
+        else:
+            first = self.pos // self.block_size
+            last = (self.pos + n - 1) // self.block_size
+            missing = [b for b in range(first, last + 1) if b not in self.blocks]
+            if missing:
+                start = missing[0] * self.block_size
+                data = self.fetch(start, min((missing[-1] + 1) * self.block_size, self.size))
+                for b in range(missing[0], missing[-1] + 1):
+                    offset = (b - missing[0]) * self.block_size
+                    self.blocks[b] = data[offset:offset + self.block_size]
+            data = b''.join(self.blocks[b] for b in range(first, last + 1))
+            offset = self.pos - first * self.block_size
+            view[:n] = data[offset:offset + n]
+            for b in range(first, last + 1):
+                self.blocks.move_to_end(b)
+            while len(self.blocks) > self.max_blocks:
+                self.blocks.popitem(last = False)
+        self.pos += n
+        return n
+
+    def read(self, size = -1):
+        if size < 0:
+            size = self.size - self.pos
+        buf = bytearray(max(0, size))
+        return bytes(buf[:self.readinto(buf)])
+
+
+def select(hf, names):
+    """
+    Paths of the datasets of hf selected by names, see the module docstring.
+
+    Returns:
+        (tuple): list of paths, list of names that matched nothing.
+    """
+    datasets = []
+    paths = OrderedDict()
+    missing = []
+    for name in names:
+        name = name.strip('/')
+        obj = hf.get(name)
+        if isinstance(obj, h5py.Dataset):
+            paths[name] = True
+            continue
+        if not datasets:
+            hf.visititems(lambda path, o: datasets.append(path)
+                          if isinstance(o, h5py.Dataset) else None)
+        matched = [p for p in datasets
+                   if p.split('/')[-1] == name or ('/' + name + '/') in ('/' + p)]
+        for p in matched:
+            paths[p] = True
+        if not matched:
+            missing.append(name)
+    return list(paths), missing
+
+
+def write_slim(hf, dest, names, etag):
+    """
+    Write the datasets of hf selected by names to a new file.
+
+    Args:
+        hf (h5py.File): source file, e.g. opened on a RangeFile.
+        dest (str): slim file, replaced if it exists.
+        names (list): dataset names, see select.
+        etag (str): ETag of the source object.
+
+    Returns:
+        (list): names that matched no dataset.
+    """
+    paths, missing = select(hf, names)
+    tmp = os.path.join(os.path.dirname(dest) or '.',
+                       '.' + os.path.basename(dest) + '.slim.' + str(os.getpid()))
+    try:
+        with h5py.File(tmp, 'w') as out:
+            copy_attrs(hf, out)
+            for path in paths:
+                parent = out
+                for part in path.split('/')[:-1]:
+                    if part not in parent:
+                        copy_attrs(hf[parent.name].get(part), parent.create_group(part))
+                    parent = parent[part]
+                ## chunks are copied as stored, compressed or not
+                parent.copy(hf[path], path.split('/')[-1])
+            out.attrs[SLIM_ATTR] = json.dumps(OrderedDict([('ETag', etag.replace('"', '')),
+                                                           ('datasets', list(names)),
+                                                           ('paths', paths)]))
+        os.replace(tmp, dest)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return missing
@@ -0,0 +1,381 @@
+"""
+Per-phase sync metrics.
+
+SyncStats records wall time, files and bytes per sync phase (walk, hash, list,
+diff, transfer, verify), files and bytes moved per kind of transfer, request
+counts per s3 API, retries and throttles.  The report can be written as JSON
+or as a Prometheus textfile for the node exporter textfile collector.
+
+NullStats has the same interface and does nothing, it is used when no report
+is requested so syncs pay no overhead.
+"""
+
+import os
+import json
+import time
+import datetime
+import threading
+from collections import Counter, OrderedDict
+
+## error codes botocore treats as throttling
+THROTTLE_CODES = set([
+    'SlowDown', 'Throttling', 'ThrottlingException', 'ThrottledException',
+    'RequestThrottled', 'RequestLimitExceeded', 'TooManyRequestsException',
+    'RequestThrottledException', 'ProvisionedThroughputExceededException',
+    'BandwidthLimitExceeded', 'EC2ThrottledException', 'PriorRequestNotComplete',
+])
+
+PHASES = ('walk', 'hash', 'list', 'diff', 'transfer', 'verify')
+
+
+class _Phase():
+    """
+    Times one phase.  Phases are exclusive: entering a nested phase (e.g. the
+    listing done while verifying) pauses the enclosing one.
+    """
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+        self.elapsed = 0.0
+
+    def __enter__(self):
+        now = time.time()
+        stack = self.stats._stack()
+        if stack:
+            parent = stack[-1]
+            parent.elapsed += now - parent.start
+        stack.append(self)
+        self.start = now
+        return self
+
+    def __exit__(self, *exc):
+        now = time.time()
+        self.elapsed += now - self.start
+        stack = self.stats._stack()
+        stack.pop()
+        if stack:
+            stack[-1].start = now
+        self.stats.add(self.name, seconds = self.elapsed)
+
+
+class _NullPhase():
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NULL_PHASE = _NullPhase()
+
+
+class NullStats():
+    """Disabled stats, all methods are no-ops."""
+
+    enabled = False
+
+    def phase(self, name):
+        return _NULL_PHASE
+
+    def add(self, phase, seconds = 0.0, files = 0, nbytes = 0):
+        pass
+
+    def transfer(self, kind, files = 0, nbytes = 0):
+        pass
+
+    def attach(self, client):
+        pass
+
+    def detach(self, client):
+        pass
+
+    def label(self, **labels):
+        pass
+
+    def reset(self):
+        pass
+
+    def write(self):
+        pass
+
+
+class SyncStats(NullStats):
+
+    enabled = True
+
+    def __init__(self, json_path = None, prom_path = None, labels = None):
+        """
+        Args:
+            json_path (str): write the JSON report here, '-' for stdout.
+            prom_path (str): write a Prometheus textfile here.
+            labels (dict): e.g. {'bucket':..., 'prefix':..., 'direction':...}
+        """
+        self.json_path = json_path
+        self.prom_path = prom_path
+        self.labels = OrderedDict(labels or {})
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.phases = OrderedDict((p, Counter()) for p in PHASES)
+            self.transfers = OrderedDict()
+            self.requests = Counter()
+            self.retries = 0
+            self.throttles = 0
+
+    def _stack(self):
+        try:
+            return self.local.stack
+        except AttributeError:
+            self.local.stack = []
+            return self.local.stack
+
+    """Recording"""
+
+    def phase(self, name):
+        return _Phase(self, name)
+
+    def add(self, phase, seconds = 0.0, files = 0, nbytes = 0):
+        """Add time, files and bytes to a phase."""
+        with self.lock:
+            counts = self.phases.setdefault(phase, Counter())
+            counts['seconds'] += seconds
+            counts['files'] += files
+            counts['bytes'] += nbytes
+
+    def transfer(self, kind, files = 0, nbytes = 0):
+        """
+        Count files and bytes moved.
+
+        Args:
+            kind (str): e.g. 'uploaded', 'downloaded', 'copied', 'checked_out'
+        """
+        with self.lock:
+            counts = self.transfers.setdefault(kind, Counter())
+            counts['files'] += files
+            counts['bytes'] += nbytes
+
+    def label(self, **labels):
+        """Add labels to the report, e.g. label(direction = 'up')."""
+        self.labels.update(labels)
+
+    def attach(self, client):
+        """
+        Count requests, retries and throttles of a boto3 client (or a client
+        that emits the same botocore events, like deon.fakes3.FakeS3Client).
+        """
+        events = getattr(getattr(client, 'meta', None), 'events', None)
+        if events is None:
+            return
+        events.register('before-call.s3', self._before_call,
+                        unique_id = 'deon-stats-before-call-%d' % id(self))
+        events.register('after-call.s3', self._after_call,
+                        unique_id = 'deon-stats-after-call-%d' % id(self))
+        ## registered first, the retry handler stops the event once it
+        ## decides to retry
+        events.register_first('needs-retry.s3', self._needs_retry,
+                              unique_id = 'deon-stats-needs-retry-%d' % id(self))
+
+    def detach(self, client):
+        """Stop counting the requests of a client, e.g. one reused by deoncli daemon."""
+        events = getattr(getattr(client, 'meta', None), 'events', None)
+        if events is None:
+            return
+        events.unregister('before-call.s3', unique_id = 'deon-stats-before-call-%d' % id(self))
+        events.unregister('after-call.s3', unique_id = 'deon-stats-after-call-%d' % id(self))
+        events.unregister('needs-retry.s3', unique_id = 'deon-stats-needs-retry-%d' % id(self))
+
+    def _before_call(self, model = None, **kwargs):
+        with self.lock:
+            self.requests[model.name] += 1
+
+    def _after_call(self, parsed = None, **kwargs):
+        attempts = (parsed or {}).get('ResponseMetadata', {}).get('RetryAttempts', 0)
+        if attempts:
+            with self.lock:
+                self.retries += attempts
+
+    def _needs_retry(self, response = None, **kwargs):
+        if response is None:
+            return None
+        code = (response[1] or {}).get('Error', {}).get('Code')
+        if code in THROTTLE_CODES:
+            with self.lock:
+                self.throttles += 1
+        return None
+
+    """Reporting"""
+
+    def report(self):
+        with self.lock:
+            return OrderedDict([
+                ('labels', OrderedDict(self.labels)),
+                ('started', datetime.datetime.utcfromtimestamp(self.started).isoformat() + 'Z'),
+                ('seconds', time.time() - self.started),
+                ('phases', OrderedDict((p, OrderedDict([('seconds', c['seconds']),
+                                                        ('files', c['files']),
+                                                        ('bytes', c['bytes'])]))
+                                       for p, c in self.phases.items())),
+                ('transfers', OrderedDict((k, OrderedDict([('files', c['files']),
+                                                           ('bytes', c['bytes'])]))
+                                          for k, c in self.transfers.items())),
+                ('requests', OrderedDict(sorted(self.requests.items()))),
+                ('retries', self.retries),
+                ('throttles', self.throttles),
+            ])
+
+    def prometheus(self, report = None):
+        """
+        Returns:
+            (str): the report in the Prometheus text exposition format.
+        """
+        return prometheus(report or self.report())
+
+    def write(self):
+        """Write the report to the configured JSON and Prometheus paths."""
+        write_report(self.report(), self.json_path, self.prom_path)
+
+
+def prometheus(report):
+    """
+    Returns:
+        (str): a report in the Prometheus text exposition format.
+    """
+    def labels(**extra):
+        items = list(report['labels'].items()) + sorted(extra.items())
+        return '{' + ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                              for k, v in items) + '}'
+
+    lines = []
+
+    def metric(name, help_text, metric_type, samples):
+        lines.append('# HELP deon_sync_%s %s' % (name, help_text))
+        lines.append('# TYPE deon_sync_%s %s' % (name, metric_type))
+        for sample_labels, value in samples:
+            lines.append('deon_sync_%s%s %s' % (name, sample_labels, repr(float(value))))
+
+    metric('last_run_timestamp_seconds', 'Start time of the last sync.', 'gauge',
+           [(labels(), time.time() - report['seconds'])])
+    metric('duration_seconds', 'Wall time of the last sync.', 'gauge',
+           [(labels(), report['seconds'])])
+    metric('phase_seconds', 'Wall time per sync phase.', 'gauge',
+           [(labels(phase = p), c['seconds']) for p, c in report['phases'].items()])
+    metric('phase_files', 'Files processed per sync phase.', 'gauge',
+           [(labels(phase = p), c['files']) for p, c in report['phases'].items()])
+    metric('phase_bytes', 'Bytes processed per sync phase.', 'gauge',
+           [(labels(phase = p), c['bytes']) for p, c in report['phases'].items()])
+    metric('transfer_files', 'Files moved per kind of transfer.', 'gauge',
+           [(labels(kind = k), c['files']) for k, c in report['transfers'].items()])
+    metric('transfer_bytes', 'Bytes moved per kind of transfer.', 'gauge',
+           [(labels(kind = k), c['bytes']) for k, c in report['transfers'].items()])
+    metric('requests', 'S3 API calls per operation.', 'gauge',
+           [(labels(api = a), n) for a, n in report['requests'].items()])
+    metric('retries', 'Retried S3 requests.', 'gauge', [(labels(), report['retries'])])
+    metric('throttles', 'Throttled S3 requests.', 'gauge', [(labels(), report['throttles'])])
+    return '\n'.join(lines) + '\n'
+
+
+def write_report(report, json_path = None, prom_path = None):
+    """
+    Args:
+        json_path (str): write the JSON report here, '-' for stdout.
+        prom_path (str): write a Prometheus textfile here.
+    """
+    if json_path == '-':
+        print(json.dumps(report, indent = 4))
+    elif json_path:
+        write_atomic(json_path, json.dumps(report, indent = 4) + '\n')
+    if prom_path:
+        write_atomic(prom_path, prometheus(report))
+
+
+def merge_reports(reports, labels = None):
+    """
+    Sum the reports of several syncs that ran concurrently, e.g. deoncli
+    up --all.  Phase seconds are summed over the syncs, the wall time is
+    the span from the first start to the last end.
+
+    Args:
+        reports (list): SyncStats.report() of each sync.
+        labels (dict): labels of the merged report.
+
+    Returns:
+        (OrderedDict): report in the format of SyncStats.report().
+    """
+    phases = OrderedDict((p, Counter()) for p in PHASES)
+    transfers = OrderedDict()
+    requests = Counter()
+    retries = 0
+    throttles = 0
+    started = None
+    ended = None
+    for r in reports:
+        for p, c in r['phases'].items():
+            phases.setdefault(p, Counter()).update(c)
+        for k, c in r['transfers'].items():
+            transfers.setdefault(k, Counter()).update(c)
+        requests.update(r['requests'])
+        retries += r['retries']
+        throttles += r['throttles']
+        start = datetime.datetime.strptime(r['started'], '%Y-%m-%dT%H:%M:%S.%fZ'
+                                           if '.' in r['started'] else '%Y-%m-%dT%H:%M:%SZ')
+        start = (start - datetime.datetime(1970, 1, 1)).total_seconds()
+        started = start if started is None else min(started, start)
+        ended = start + r['seconds'] if ended is None else max(ended, start + r['seconds'])
+    started = time.time() if started is None else started
+    return OrderedDict([
+        ('labels', OrderedDict(labels or {})),
+        ('started', datetime.datetime.utcfromtimestamp(started).isoformat() + 'Z'),
+        ('seconds', (ended or started) - started),
+        ('phases', OrderedDict((p, OrderedDict([('seconds', c['seconds']),
+                                                ('files', c['files']),
+                                                ('bytes', c['bytes'])]))
+                               for p, c in phases.items())),
+        ('transfers', OrderedDict((k, OrderedDict([('files', c['files']),
+                                                   ('bytes', c['bytes'])]))
+                                  for k, c in transfers.items())),
+        ('requests', OrderedDict(sorted(requests.items()))),
+        ('retries', retries),
+        ('throttles', throttles),
+    ])
+
+
+def format_summary(jobs, total):
+    """
+    Args:
+        jobs (OrderedDict): {name: (status, report)}, report may be None for
+                            syncs that failed before reporting.
+        total (OrderedDict): merge_reports of the job reports.
+
+    Returns:
+        (str): one line per sync and a total line.
+    """
+    def row(name, status, r):
+        if r is None:
+            return '%-40s %-8s' % (name, status)
+        moved = sum(c['files'] for c in r['transfers'].values())
+        nbytes = sum(c['bytes'] for c in r['transfers'].values())
+        return '%-40s %-8s %9.1f %8d %10.1f %9d %7d %7d' % (
+            name, status, r['seconds'], moved, nbytes / 1e6,
+            sum(r['requests'].values()), r['retries'], r['throttles'])
+
+    lines = ['%-40s %-8s %9s %8s %10s %9s %7s %7s' % ('sync', 'status', 'seconds', 'files',
+                                                   'MB', 'requests', 'retries', 'thrtl')]
+    for name, (status, r) in jobs.items():
+        lines.append(row(name, status, r))
+    failed = sum(1 for status, r in jobs.values() if status != 'ok')
+    lines.append(row('total', 'ok' if not failed else '%d failed' % failed, total))
+    return '\n'.join(lines)
+
+
+def write_atomic(path, contents):
+    """Write via a temp file and rename, so readers never see partial files."""
+    tmp = path + '.tmp.' + str(os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(contents)
+    os.replace(tmp, path)
@@ -0,0 +1,216 @@
+"""
+Timeline tracing of syncs.
+
+Tracer records s3 calls, hashes, file opens and transfers as timed spans with
+their thread ids and writes them in the Chrome trace event format, which can
+be loaded in chrome://tracing or https://ui.perfetto.dev.  Optionally the
+peak memory (tracemalloc) and a cProfile of the main thread are captured for
+the same run, the profile is written next to the trace as <trace>.prof.
+
+NullTracer has the same interface and does nothing, it is used when tracing
+is off.
+"""
+
+import os
+import json
+import time
+import threading
+import tracemalloc
+import cProfile
+
+
+class _Span():
+
+    def __init__(self, tracer, name, cat, args):
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        self.tracer.add_span(self.name, self.cat, self.start, time.time(), self.args)
+
+
+class _NullSpan():
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class NullTracer():
+    """Disabled tracing, all methods are no-ops."""
+
+    enabled = False
+
+    def span(self, name, cat, **args):
+        return _NULL_SPAN
+
+    def attach(self, client):
+        pass
+
+    def detach(self, client):
+        pass
+
+    def reset(self):
+        pass
+
+    def write(self):
+        pass
+
+
+class Tracer(NullTracer):
+
+    enabled = True
+
+    def __init__(self, path, memory = False, cprofile = False):
+        """
+        Args:
+            path (str): trace file, e.g. sync.trace.json
+            memory (boolean): track memory with tracemalloc, adds the
+                              current and peak memory as counters.
+            cprofile (boolean): profile the main thread with cProfile.
+        """
+        self.path = path
+        self.memory = memory
+        self.pid = os.getpid()
+        self.events = []
+        self.threads = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.profile = None
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if cprofile:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+    """Recording"""
+
+    def span(self, name, cat, **args):
+        """
+        Args:
+            name (str): span name, e.g. 'md5'
+            cat (str): category, e.g. 's3', 'hash', 'file', 'transfer'
+            args: shown with the span, e.g. path = ...
+        """
+        return _Span(self, name, cat, args)
+
+    def add_span(self, name, cat, start, end, args = None):
+        thread = threading.current_thread()
+        event = {'name': name, 'cat': cat, 'ph': 'X', 'pid': self.pid,
+                 'tid': thread.ident, 'ts': start * 1e6, 'dur': (end - start) * 1e6,
+                 'args': args or {}}
+        with self.lock:
+            self.threads.setdefault(thread.ident, thread.name)
+            self.events.append(event)
+            if self.memory:
+                current, peak = tracemalloc.get_traced_memory()
+                self.events.append({'name': 'memory', 'ph': 'C', 'pid': self.pid,
+                                    'ts': end * 1e6,
+                                    'args': {'current': current, 'peak': peak}})
+
+    def attach(self, client):
+        """Record every call of a boto3 client as a span."""
+        events = getattr(getattr(client, 'meta', None), 'events', None)
+        if events is None:
+            return
+        events.register('before-call.s3', self._before_call,
+                        unique_id = 'deon-trace-before-call-%d' % id(self))
+        events.register('after-call.s3', self._after_call,
+                        unique_id = 'deon-trace-after-call-%d' % id(self))
+
+    def detach(self, client):
+        """Stop recording the calls of a client, e.g. one reused by deoncli daemon."""
+        events = getattr(getattr(client, 'meta', None), 'events', None)
+        if events is None:
+            return
+        events.unregister('before-call.s3', unique_id = 'deon-trace-before-call-%d' % id(self))
+        events.unregister('after-call.s3', unique_id = 'deon-trace-after-call-%d' % id(self))
+
+    def _before_call(self, model = None, params = None, **kwargs):
+        try:
+            stack = self.local.calls
+        except AttributeError:
+            stack = self.local.calls = []
+        args = {}
+        for k in ('Bucket', 'Key', 'Prefix', 'Range', 'PartNumber'):
+            if params and k in params:
+                args[k] = params[k]
+        stack.append((model.name, time.time(), args))
+
+    def _after_call(self, model = None, parsed = None, **kwargs):
+        stack = getattr(self.local, 'calls', None)
+        ## a call that failed before after-call leaves its entry behind,
+        ## match on the operation name
+        while stack and stack[-1][0] != model.name:
+            stack.pop()
+        if not stack:
+            return
+        name, start, args = stack.pop()
+        metadata = (parsed or {}).get('ResponseMetadata', {})
+        if metadata.get('HTTPStatusCode'):
+            args['status'] = metadata['HTTPStatusCode']
+        if metadata.get('RetryAttempts'):
+            args['retries'] = metadata['RetryAttempts']
+        self.add_span(name, 's3', start, time.time(), args)
+
+    def reset(self):
+        """
+        Drop the events recorded so far and restart the memory peak and the
+        profile, e.g. after writing the trace of one sync in --interval mode.
+        """
+        with self.lock:
+            self.events = []
+            self.threads = {}
+        ## reset_peak needs python 3.9
+        if self.memory and tracemalloc.is_tracing() and hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        if self.profile is not None:
+            self.profile.disable()
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+    """Output"""
+
+    def write(self):
+        """
+        Write the trace (and profile) recorded so far.  Can be called more
+        than once, e.g. after every sync in --interval mode.
+        """
+        with self.lock:
+            events = list(self.events)
+            threads = dict(self.threads)
+        for tid, name in threads.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': self.pid,
+                           'tid': tid, 'args': {'name': name}})
+        other = {}
+        if self.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            other['memory_current_bytes'] = current
+            other['memory_peak_bytes'] = peak
+            snapshot = tracemalloc.take_snapshot()
+            other['memory_top_allocations'] = [str(stat) for stat in
+                                               snapshot.statistics('lineno')[:20]]
+        if self.profile is not None:
+            self.profile.disable()
+            self.profile.dump_stats(self.path + '.prof')
+            self.profile.enable()
+            other['cprofile'] = self.path + '.prof'
+
+        tmp = self.path + '.tmp.' + str(self.pid)
+        with open(tmp, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms',
+                       'otherData': other}, f)
+        os.replace(tmp, self.path)
@@ -0,0 +1,264 @@
+"""
+Asynchronous uploads of files written by live data collectors.
+
+`deoncli up` walks and diffs a whole directory to find the few files written
+since the last sync.  A collector that knows which files it wrote enqueues
+them instead, and worker threads upload them in the background:
+
+    from deon.uploader import Uploader
+
+    uploader = Uploader('rail-robot-data-sharing-v1/robot1/')
+    for episode in episodes:
+        write_episode(path, episode)
+        uploader.enqueue(path)
+    failed = uploader.close()
+
+Files are uploaded like sync_file_toS3 does, with their stat and metajson as
+object metadata, and uploads that fail are retried with a backoff.  The queue
+is bounded, enqueue blocks while it is full, so a collector that writes
+faster than the uplink slows down instead of growing the queue.  Finished
+uploads are recorded in batches: in the quick stats (so `deoncli up --quick`
+doesn't hash them again), in the localcache file if enabled, and in the
+changefeed of the bucket if enabled.  flush() waits for the queued uploads
+and records them, call it (or close()) before the collector exits.
+"""
+
+import os
+import time
+import queue
+import logging
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+from deon.s3sync import SmartS3Sync, S3SyncUtility
+from deon.changefeed import make_record
+from deon.slim import slim_info
+
+WORKERS = 4
+MAX_QUEUE = 64
+RETRIES = 3
+RETRY_DELAY = 1.0
+## finished uploads are recorded every BATCH_SIZE uploads or BATCH_INTERVAL
+## seconds, whichever comes first
+BATCH_SIZE = 32
+BATCH_INTERVAL = 30.0
+
+
+class Uploader():
+
+    def __init__(self, s3path, workers = WORKERS, max_queue = MAX_QUEUE,
+                 retries = RETRIES, retry_delay = RETRY_DELAY,
+                 batch_size = BATCH_SIZE, batch_interval = BATCH_INTERVAL,
+                 **kwargs):
+        """
+        Args:
+            s3path (str): repo path <bucket>/<prefix>/ of the files.
+            workers (int): upload threads.
+            max_queue (int): files waiting for a worker before enqueue blocks.
+            retries (int): attempts after a failed upload.
+            retry_delay (float): seconds before the first retry, doubled for
+                                 each further one.
+            batch_size (int): finished uploads recorded at once.
+            batch_interval (float): seconds after which finished uploads are
+                                    recorded even if the batch isn't full.
+            kwargs: SmartS3Sync options, e.g. profile, compression, changefeed,
+                    repack.
+        """
+        self.sync = SmartS3Sync(local = [], s3path = s3path, **kwargs)
+        self.bucket = self.sync.bucket
+        self.prefix = s3path[len(self.bucket) + 1:]
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.queue = queue.Queue(maxsize = max_queue)
+        self.lock = threading.Lock()
+        ## (key, local dzip_meta, remote, metajson) of finished uploads
+        self.finished = []
+        ## changefeed records that failed to be written, see record
+        self.changes = []
+        self.recorded = time.time()
+        self.failed = []
+        self.uploaded = 0
+        self.closed = False
+        self.threads = [threading.Thread(target = self.run, name = 'deon-upload-%d' % i,
+                                         daemon = True) for i in range(workers)]
+        for t in self.threads:
+            t.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def key(self, local):
+        """s3 key of a repo path <bucket>/<key>."""
+        parts = Path(local).parts
+        if parts[0] != self.bucket:
+            raise ValueError(local + ' is not in bucket ' + self.bucket)
+        key = "/".join(parts[1:])
+        if not key.startswith(self.prefix):
+            raise ValueError(local + ' is not under ' + self.sync.s3path)
+        return key
+
+    def enqueue(self, local, timeout = None):
+        """
+        Queue a file for upload, blocks while the queue is full.
+
+        Args:
+            local (str): repo path <bucket>/<key> of a finished file, it must
+                         not be written to anymore.
+            timeout (float): seconds to wait for room in the queue, None to
+                             wait as long as it takes.
+
+        Raises:
+            queue.Full: the queue stayed full for timeout seconds.
+        """
+        if self.closed:
+            raise RuntimeError('uploader is closed')
+        key = self.key(local)
+        self.queue.put((key, local), timeout = timeout)
+
+    def pending(self):
+        """Files queued or being uploaded."""
+        return self.queue.unfinished_tasks
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                self.upload(*item)
+            finally:
+                self.queue.task_done()
+
+    def upload(self, key, local):
+        """Upload a file, retrying failed attempts."""
+        for attempt in range(self.retries + 1):
+            try:
+                due = self.upload_once(key, local)
+            except (ClientError, BotoCoreError, OSError) as e:
+                if isinstance(e, FileNotFoundError) or attempt == self.retries:
+                    self.logger.error('upload of ' + local + ' failed: ' + str(e))
+                    error = e
+                    break
+                delay = self.retry_delay * 2 ** attempt
+                self.logger.warning('upload of ' + local + ' failed, retrying in %.1fs: %s'
+                                    % (delay, e))
+                time.sleep(delay)
+            except Exception as e:
+                ## e.g. an unreadable hdf5 file, retrying won't help
+                self.logger.exception('upload of ' + local + ' failed')
+                error = e
+                break
+            else:
+                ## outside the retries, the file is uploaded even if
+                ## recording the batch fails
+                if due:
+                    self.record()
+                return
+        with self.lock:
+            self.failed.append((local, error))
+
+    def upload_once(self, key, local):
+        """
+        Returns:
+            (boolean): the finished uploads are due to be recorded.
+        """
+        if slim_info(local) is not None:
+            raise ValueError(local + ' is a slim file, see deon.slim')
+        v = S3SyncUtility().dzip_meta(local)
+        ## a repacked copy is uploaded in place of the file, see deon.repack
+        tmp = None
+        if self.sync.repacker is not None:
+            tmp = self.sync.repacked_copy(local)[0]
+        try:
+            v['ETag'] = self.sync.local_etag(tmp or local)
+            meta, metajson = self.sync.upload_meta(v)
+            if tmp is not None:
+                meta['Metadata']['size'] = str(os.path.getsize(tmp))
+                meta['Metadata']['repack-source'] = self.sync.local_etag(local).replace('"', '')
+            remote = self.sync.upload_object(key, tmp or local, meta, show_progress = False,
+                                             etag = v['ETag'])
+        finally:
+            if tmp is not None:
+                os.remove(tmp)
+        with self.lock:
+            self.finished.append((key, v, remote, metajson))
+            self.uploaded += 1
+            due = (len(self.finished) >= self.batch_size
+                   or time.time() - self.recorded > self.batch_interval)
+        return due
+
+    def record(self):
+        """
+        Record the finished uploads in the hash caches and the changefeed.
+        Changefeed records that fail to be written are kept and written with
+        the next batch, the caches are updated once.
+        """
+        with self.lock:
+            finished, self.finished = self.finished, []
+            changes, self.changes = self.changes, []
+            self.recorded = time.time()
+            if finished:
+                for key, v, remote, metajson in finished:
+                    self.sync.add_quick_stat(key, remote, v['size'], v['mtime'])
+                self.sync.save_quick_stats()
+                if self.sync.fingerprint is None:
+                    self.sync.update_localcache(OrderedDict((key, v) for key, v, remote, metajson
+                                                            in finished))
+            changes += [make_record(key, remote, metajson)
+                        for key, v, remote, metajson in finished]
+            if not changes:
+                return
+        try:
+            self.sync.append_changes(changes)
+        except (ClientError, BotoCoreError, OSError) as e:
+            ## put the records back, they are written with the next batch
+            with self.lock:
+                self.changes[:0] = changes
+            self.logger.warning('recording ' + str(len(changes)) + ' uploads in the changefeed '
+                                'failed, retrying with the next batch: ' + str(e))
+            return
+        self.logger.info('uploaded ' + str(len(finished)) + ' files')
+
+    def flush(self, timeout = None):
+        """
+        Wait for the queued uploads and record them.
+
+        Args:
+            timeout (float): seconds to wait, None to wait for all uploads.
+
+        Returns:
+            (list): (local path, exception) of the uploads that failed so
+                    far, a failed upload is reported once.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                left = None if deadline is None else deadline - time.time()
+                if left is not None and left <= 0:
+                    break
+                self.queue.all_tasks_done.wait(left)
+        self.record()
+        with self.lock:
+            failed, self.failed = self.failed, []
+        return failed
+
+    def close(self):
+        """Upload the queued files and stop the workers, see flush."""
+        if self.closed:
+            return []
+        self.closed = True
+        failed = self.flush()
+        for t in self.threads:
+            self.queue.put(None)
+        for t in self.threads:
+            t.join()
+        return failed
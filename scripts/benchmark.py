@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+"""
+Offline benchmarks for deon syncs.
+
+Runs SmartS3Sync, DirectoryWalk, queryS3 and md5 against deon.fakes3, a local
+stand-in for S3 with injectable latency, bandwidth limits and throttling, on a
+synthetic tree of hdf5 files.  For every phase the throughput and the number
+of LIST/HEAD/GET/PUT requests are reported, and request counts are checked
+against budgets so that regressions (e.g. an extra full prefix listing) fail
+loudly with a non-zero exit code.
+
+e.g.
+python scripts/benchmark.py sync --files 10000 --latency 0.005
+python scripts/benchmark.py sync --files 1000000 --workdir /scratch/deon-bench --keep
+python scripts/benchmark.py hash --size 4096 --threads 1,2,4,8
+python scripts/benchmark.py roundtrip --files 100
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import logging
+import tempfile
+from collections import OrderedDict
+
+import click
+import h5py
+import numpy as np
+
+## run from a checkout without installing deon
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from deon.fakes3 import FakeS3Client
+from deon.backends import LocalBackend
+from deon.s3sync import SmartS3Sync, DirectoryWalk, S3SyncUtility, PART_SIZE
+
+BUCKET = 'deon-bench'
+PREFIX = 'trajectories'
+
+## (fraction of files, payload bytes), scaled by --scale
+SIZE_MIX = [
+    (0.70, 4 * 1024),
+    (0.25, 256 * 1024),
+    (0.04, 4 * 1024 * 1024),
+    (0.01, 20 * 1024 * 1024),
+]
+
+FILES_PER_DIR = 1000
+
+
+def make_tree(root, n_files, scale = 1.0, seed = 0):
+    """
+    Write a synthetic tree of hdf5 trajectories with metajson attributes.
+
+    Args:
+        root (str): directory to create the files in.
+        n_files (int): number of files.
+        scale (float): multiplier for the payload sizes in SIZE_MIX.
+
+    Returns:
+        (int): total bytes written.
+    """
+    rng = random.Random(seed)
+    fractions = [f for f, _ in SIZE_MIX]
+    sizes = [max(1, int(s * scale)) for _, s in SIZE_MIX]
+    total = 0
+    for i in range(n_files):
+        d = os.path.join(root, 'batch%04d' % (i // FILES_PER_DIR))
+        if i % FILES_PER_DIR == 0:
+            os.makedirs(d, exist_ok = True)
+        size = rng.choices(sizes, fractions)[0]
+        path = os.path.join(d, 'traj%07d.hdf5' % i)
+        with h5py.File(path, 'w') as hf:
+            hf.attrs['metadata'] = json.dumps({'robot': rng.choice(['sawyer', 'widowx']),
+                                               'traj_ok': True, 'index': i})
+            hf.create_dataset('actions', data = np.frombuffer(os.urandom(size), dtype = np.uint8))
+        total += os.path.getsize(path)
+    return total
+
+
+class Phase():
+    """Times a benchmark phase and captures the requests it made."""
+
+    def __init__(self, report, name, s3cl, files = 0, nbytes = 0):
+        self.report = report
+        self.name = name
+        self.s3cl = s3cl
+        self.files = files
+        self.nbytes = nbytes
+
+    def __enter__(self):
+        self.s3cl.reset_counts()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.time() - self.start
+        self.report[self.name] = OrderedDict([
+            ('seconds', elapsed),
+            ('files_per_s', self.files / elapsed if elapsed else 0.0),
+            ('MB_per_s', self.nbytes / 1e6 / elapsed if elapsed else 0.0),
+            ('requests', self.s3cl.request_counts()),
+            ('requests_not_throttled', self.s3cl.request_counts(throttled = False)),
+            ('throttles', self.s3cl.throttles),
+            ('retries', self.s3cl.retries),
+        ])
+
+
+def check_budgets(report, budgets):
+    """
+    Throttled and retried requests don't count towards the budgets.
+
+    Args:
+        budgets (dict): {phase: {'LIST': max, ...}}
+
+    Returns:
+        (list): budget violations as strings.
+    """
+    violations = []
+    for phase, limits in budgets.items():
+        counts = report[phase]['requests_not_throttled']
+        for request_class, limit in limits.items():
+            if counts[request_class] > limit:
+                violations.append('%s: %d %s requests, budget is %d'
+                                  % (phase, counts[request_class], request_class, limit))
+    return violations
+
+
+def print_report(report):
+    print('%-12s %9s %10s %9s %7s %7s %7s %7s %6s' % ('phase', 'seconds', 'files/s',
+          'MB/s', 'LIST', 'HEAD', 'GET', 'PUT', 'thrtl'))
+    for name, r in report.items():
+        c = r['requests']
+        print('%-12s %9.2f %10.1f %9.1f %7d %7d %7d %7d %6d' % (name, r['seconds'],
+              r['files_per_s'], r['MB_per_s'], c['LIST'], c['HEAD'], c['GET'],
+              c['PUT'], r['throttles']))
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option('--files', default=10000, help="Number of hdf5 files to generate")
+@click.option('--scale', default=1.0, help="Multiplier for the file size mix")
+@click.option('--latency', default=0.0, help="Seconds added to every request")
+@click.option('--bandwidth', default=0.0, help="Bytes/s per request, 0 for unlimited")
+@click.option('--throttle', default=0.0, help="Probability of a SlowDown response")
+@click.option('--workdir', default=None, help="Directory for the tree and fake bucket, default: a temp dir")
+@click.option('--keep', is_flag=True, help="Keep the workdir (and reuse its tree on the next run)")
+@click.option('--json_report', default=None, help="Write the report as JSON to this path")
+def sync(files, scale, latency, bandwidth, throttle, workdir, keep, json_report):
+    """Walk, hash, list, diff, transfer and verify benchmarks"""
+    logging.basicConfig(level = logging.WARNING)
+    ## a --workdir is the user's, only what the benchmark writes in it is removed
+    temporary = workdir is None
+    workdir = os.path.abspath(workdir or tempfile.mkdtemp(prefix = 'deon-bench-'))
+    os.makedirs(workdir, exist_ok = True)
+    cwd = os.getcwd()
+    generated = False
+    ## SmartS3Sync maps local paths '<bucket>/<prefix>/...' to keys
+    os.chdir(workdir)
+    try:
+        local = os.path.join(BUCKET, PREFIX)
+        s3path = BUCKET + '/' + PREFIX + '/'
+        if not os.path.isdir(local):
+            print('generating %d files in %s' % (files, os.path.join(workdir, local)))
+            t = time.time()
+            make_tree(local, files, scale = scale)
+            generated = True
+            print('generated in %.1fs' % (time.time() - t))
+        shutil.rmtree('fakes3', ignore_errors = True)
+        shutil.rmtree('down', ignore_errors = True)
+
+        s3cl = FakeS3Client(os.path.join(workdir, 'fakes3'), latency = latency,
+                            bandwidth = bandwidth or None, throttle_rate = throttle)
+        report = OrderedDict()
+
+        with Phase(report, 'walk', s3cl) as phase:
+            walk = DirectoryWalk(local)
+            phase.files = len(walk.file)
+        n_files = len(walk.file)
+        n_dirs = len(walk.root)
+        nbytes = sum(int(v['size']) for v in walk.file.values())
+        ## requests a managed transfer of each file needs, multipart
+        ## uploads add a create and a complete request
+        sizes = [int(v['size']) for v in walk.file.values()]
+        gets = sum(1 if s < PART_SIZE else math.ceil(s / float(PART_SIZE)) for s in sizes)
+        puts = sum(1 if s < PART_SIZE else math.ceil(s / float(PART_SIZE)) + 2 for s in sizes)
+
+        util = S3SyncUtility()
+        with Phase(report, 'hash', s3cl, n_files, nbytes):
+            for f in walk.file:
+                util.md5(f)
+
+        def new_sync(local_path):
+            return SmartS3Sync(local = local_path, s3path = s3path, s3client = s3cl,
+                               log = logging.WARNING)
+
+        with Phase(report, 'upload', s3cl, n_files, nbytes):
+            new_sync(s3path).sync(fromS3 = False, show_progress = False)
+
+        s3_sync = new_sync(s3path)
+        with Phase(report, 'list', s3cl, n_files):
+            listing = s3_sync.queryS3(PREFIX + '/', return_all_objects = True)
+        n_objects = len(listing)
+        pages = max(1, math.ceil(n_objects / 1000.0))
+
+        local_keys = s3_sync.walk.toS3Keys(s3_sync.walk.file, s3path, isdir = False)
+        for k, v in local_keys.items():
+            v['ETag'] = util.md5(v['local'])
+        with Phase(report, 'diff', s3cl, n_files):
+            needs_sync = s3_sync.compare_etag(local_keys, listing)
+        if needs_sync:
+            print('diff found %d files that differ after upload' % len(needs_sync))
+
+        with Phase(report, 'verify', s3cl, n_files):
+            s3_sync.verify_sync(local_keys)
+
+        with Phase(report, 'noop_upload', s3cl, n_files, nbytes):
+            new_sync(s3path).sync(fromS3 = False, show_progress = False)
+
+        ## download into a second deon repo
+        os.makedirs('down')
+        os.chdir('down')
+        with Phase(report, 'download', s3cl, n_files, nbytes):
+            new_sync(s3path).sync(fromS3 = True, show_progress = False)
+
+        with Phase(report, 'noop_download', s3cl, n_files, nbytes):
+            new_sync(s3path).sync(fromS3 = True, show_progress = False)
+        os.chdir(workdir)
+
+        ## request budgets, prefix keys above the synced dir are created once
+        prefix_keys = len(s3_sync.keys)
+        budgets = {
+            'list': {'LIST': pages, 'HEAD': 0, 'GET': 0, 'PUT': 0},
+            'diff': {'LIST': 0, 'HEAD': 0, 'GET': 0, 'PUT': 0},
+            'verify': {'LIST': pages, 'HEAD': 0, 'GET': 0, 'PUT': 0},
+            'upload': {'LIST': 2 * pages, 'HEAD': prefix_keys, 'GET': 0,
+                       'PUT': prefix_keys + n_dirs + puts},
+            'noop_upload': {'LIST': pages, 'HEAD': 0, 'GET': 0, 'PUT': 0},
+            'download': {'LIST': 2 * pages, 'HEAD': n_files, 'GET': gets, 'PUT': 0},
+            'noop_download': {'LIST': pages, 'HEAD': 0, 'GET': 0, 'PUT': 0},
+        }
+        print('%d files, %d dirs, %.1f MB, latency %.3fs, bandwidth %s, throttle %.3f'
+              % (n_files, n_dirs, nbytes / 1e6, latency, bandwidth or 'unlimited', throttle))
+        print_report(report)
+        if json_report:
+            with open(os.path.join(cwd, json_report), 'w') as f:
+                json.dump(report, f, indent = 4)
+
+        violations = check_budgets(report, budgets)
+        if violations:
+            print('\nREQUEST BUDGET EXCEEDED')
+            for v in violations:
+                print('  ' + v)
+            sys.exit(1)
+        print('\nall request budgets met')
+    finally:
+        os.chdir(cwd)
+        if not keep:
+            if temporary:
+                shutil.rmtree(workdir, ignore_errors = True)
+            else:
+                for name in ['fakes3', 'down'] + ([BUCKET] if generated else []):
+                    shutil.rmtree(os.path.join(workdir, name), ignore_errors = True)
+
+
+@cli.command("hash")
+@click.option('--size', default=2048, help="Size of the hashed file in MB")
+@click.option('--threads', default="1,2,4,8", help="Thread counts to compare, comma separated")
+@click.option('--repeat', default=3, help="Runs per thread count, the fastest is reported")
+@click.option('--workdir', default=None, help="Directory for the file, default: a temp dir")
+def hash_bench(size, threads, repeat, workdir):
+    """md5 (multipart ETag) throughput of one large file by hashing threads"""
+    temporary = workdir is None
+    workdir = os.path.abspath(workdir or tempfile.mkdtemp(prefix = 'deon-bench-'))
+    os.makedirs(workdir, exist_ok = True)
+    path = os.path.join(workdir, 'large.bin')
+    try:
+        print('writing %d MB to %s' % (size, path))
+        rng = np.random.RandomState(0)
+        with open(path, 'wb') as f:
+            for i in range(size):
+                f.write(rng.bytes(1024 * 1024))
+        util = S3SyncUtility()
+        ## warm the page cache, the benchmark measures hashing, not the disk
+        etag = util.md5(path, threads = 1)
+        print('%-8s %9s %9s %8s' % ('threads', 'seconds', 'MB/s', 'speedup'))
+        base = None
+        for n in [int(t) for t in threads.split(',')]:
+            best = None
+            for i in range(repeat):
+                t = time.time()
+                result = util.md5(path, threads = n)
+                elapsed = time.time() - t
+                best = elapsed if best is None else min(best, elapsed)
+                if result != etag:
+                    print('ETag with %d threads differs: %s != %s' % (n, result, etag))
+                    sys.exit(1)
+            base = base or best
+            print('%-8d %9.2f %9.1f %7.2fx' % (n, best, size / best, base / best))
+        print('\nETag ' + etag)
+    finally:
+        if temporary:
+            shutil.rmtree(workdir, ignore_errors = True)
+        elif os.path.exists(path):
+            os.remove(path)
+
+@cli.command()
+@click.option('--files', default=100, help="Number of hdf5 files to generate")
+@click.option('--scale', default=0.1, help="Multiplier for the file size mix")
+@click.option('--workdir', default=None, help="Directory for the tree and mirror, default: a temp dir")
+def roundtrip(files, scale, workdir):
+    """Upload to and download from a LocalBackend mirror, compare the files"""
+    logging.basicConfig(level = logging.WARNING)
+    temporary = workdir is None
+    workdir = os.path.abspath(workdir or tempfile.mkdtemp(prefix = 'deon-bench-'))
+    os.makedirs(workdir, exist_ok = True)
+    cwd = os.getcwd()
+    generated = False
+    os.chdir(workdir)
+    try:
+        local = os.path.join(BUCKET, PREFIX)
+        s3path = BUCKET + '/' + PREFIX + '/'
+        if not os.path.isdir(local):
+            make_tree(local, files, scale = scale)
+            generated = True
+        shutil.rmtree('mirror', ignore_errors = True)
+        shutil.rmtree('down', ignore_errors = True)
+        backend = LocalBackend(os.path.join(workdir, 'mirror'))
+
+        def new_sync():
+            return SmartS3Sync(local = s3path, s3path = s3path, s3client = backend,
+                               log = logging.WARNING)
+
+        new_sync().sync(fromS3 = False, show_progress = False)
+        os.makedirs('down')
+        os.chdir('down')
+        new_sync().sync(fromS3 = True, show_progress = False)
+        os.chdir(workdir)
+
+        util = S3SyncUtility()
+        walk = DirectoryWalk(local)
+        mismatches = []
+        for f in walk.file:
+            down = os.path.join('down', f)
+            if not os.path.isfile(down) or util.md5(down) != util.md5(f):
+                mismatches.append(f)
+        print('%d files uploaded to and downloaded from %s' % (len(walk.file), backend.root))
+        if mismatches:
+            print('\nROUNDTRIP MISMATCH')
+            for f in mismatches:
+                print('  ' + f)
+            sys.exit(1)
+        print('\nall files match')
+    finally:
+        os.chdir(cwd)
+        if temporary:
+            shutil.rmtree(workdir, ignore_errors = True)
+        else:
+            for name in ['mirror', 'down'] + ([BUCKET] if generated else []):
+                shutil.rmtree(os.path.join(workdir, name), ignore_errors = True)
+
+
+if __name__ == "__main__":
+    cli()
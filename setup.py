@@ -26,7 +26,7 @@ setup (
  python_requires='>=3.4', # any python greater than 2.7
  entry_points='''
         [console_scripts]
-        deoncli=deon.__main__:cli
+        deoncli=deon.__main__:main
     ''',
  author="Ashvin Nair",
  keyword="data",